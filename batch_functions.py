@@ -0,0 +1,373 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import checkpoint_functions
+import progress_functions
+
+
+# A batch manifest (YAML, or JSON) lists PIV jobs, each a pair of DEMs with the
+# arguments and options of the 'piv' command. Options under 'defaults' apply to
+# every job that does not set them; relative paths are relative to the manifest:
+#
+#   defaults:
+#     template_size: 21
+#     step_size: 25
+#   jobs:
+#     - name: glacier_2001_2015
+#       before: example_data/height_2001.tif
+#       after: example_data/height_2015.tif
+#       prop: [example_data/uncertainty_2001.tif, example_data/uncertainty_2015.tif]
+#
+# Results are cached under a key made from the SHA-256 content hashes of the
+# input files and the options that change the results, in one directory per key:
+#   <cache>/<key>/manifest.json   the inputs and options of the key
+#   <cache>/<key>/vectors.npy, covariances.npy, metrics.json, log.txt
+# A job whose key is cached is not computed again; its result files are copied
+# to its output names. Jobs are computed in a shared pool of worker processes,
+# each in a <cache>/<key>.partial directory that is renamed when the job
+# completes, so a job interrupted or failed part way resumes from its PIV
+# checkpoint on the next run. The cache is kept under a size limit by removing
+# the least recently used results.
+
+required_job_keys = ['before', 'after', 'template_size', 'step_size']
+# the 'piv' options a job can set and their defaults
+job_options = {'prop': None, 'format': 'npy', 'jacobian': 'analytic', 'stream': False,
+               'levels': 1, 'search_radius': 3, 'min_overlap': 1.0, 'boundary': None,
+               'min_peak_ratio': 1.0, 'outlier_filter': None, 'outlier_threshold': 2.0,
+               'outlier_replace': 'remove', 'precision': 'float64', 'fft_workers': 1,
+               'prop_mode': 'linear', 'realizations': 100, 'seed': 0}
+# options that do not change the results and are left out of the cache key
+uncached_options = ['stream', 'fft_workers']
+entry_manifest_name = 'manifest.json'
+hash_index_name = 'file_hashes.json'
+
+
+def batch(manifest_file, cache_directory, cache_size, number_workers, summary_file=None):
+
+    batch_start = time.perf_counter()
+    jobs = read_batch_manifest(manifest_file)
+    if cache_directory is None:
+        cache_directory = os.path.join(os.path.dirname(os.path.abspath(manifest_file)), 'gpiv_cache')
+    os.makedirs(cache_directory, exist_ok=True)
+    max_cache_bytes = cache_size * 2**20
+
+    # input files are hashed once per batch, and only again when they change
+    hash_index = read_hash_index(cache_directory)
+    jobs_by_key = {}
+    for job in jobs:
+        key_start = time.perf_counter()
+        job['cache_manifest'] = get_cache_manifest(job, hash_index)
+        job['key'] = get_cache_key(job['cache_manifest'])
+        jobs_by_key.setdefault(job['key'], []).append(job)
+        job['result'] = {'name': job['name'], 'key': job['key'], 'status': 'pending',
+                         'seconds': time.perf_counter() - key_start}
+    write_hash_index(cache_directory, hash_index)
+
+    computed_keys = [key for key in jobs_by_key if not os.path.isdir(os.path.join(cache_directory, key))]
+    for key in jobs_by_key:
+        if key not in computed_keys:
+            for job in jobs_by_key[key]:
+                copy_cached_result(cache_directory, job, 'hit')
+    if computed_keys:
+        print("{} of {} jobs are cached. Computing {} PIV results with {} worker(s).".format(
+            len(jobs) - sum(len(jobs_by_key[key]) for key in computed_keys), len(jobs), len(computed_keys), number_workers))
+
+    number_evicted = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=number_workers) as executor:
+        futures = {}
+        for key in computed_keys:
+            partial_directory = os.path.join(cache_directory, key + '.partial')
+            futures[executor.submit(run_batch_job, partial_directory,
+                                    get_piv_arguments(jobs_by_key[key][0], os.path.join(partial_directory, '')))] = key
+        for number_completed, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            key = futures[future]
+            job_result = future.result()
+            first_job = jobs_by_key[key][0]
+            if job_result['status'] == 'failed':
+                for job in jobs_by_key[key]:
+                    job['result'].update(status='failed', message=job_result['message'])
+                first_job['result']['seconds'] += job_result['seconds']
+                print("[{}/{}] {} failed: {}".format(number_completed, len(computed_keys), first_job['name'], job_result['message']))
+                continue
+            store_cache_entry(cache_directory, key, first_job['cache_manifest'])
+            # jobs with the same inputs and options share the computed result
+            for job in jobs_by_key[key]:
+                copy_cached_result(cache_directory, job, 'miss' if job is first_job else 'hit')
+            first_job['result']['seconds'] += job_result['seconds']
+            print("[{}/{}] {} computed in {}".format(number_completed, len(computed_keys), first_job['name'],
+                                                     progress_functions.format_duration(job_result['seconds'])))
+            number_evicted += evict_cache_entries(cache_directory, max_cache_bytes, key)
+
+    cache_entries = get_cache_entries(cache_directory)
+    job_results = [job['result'] for job in jobs]
+    summary = {
+        'jobs': job_results,
+        'hits': sum(job_result['status'] == 'hit' for job_result in job_results),
+        'misses': sum(job_result['status'] == 'miss' for job_result in job_results),
+        'failed': sum(job_result['status'] == 'failed' for job_result in job_results),
+        'evicted': number_evicted,
+        'cache_entries': len(cache_entries),
+        'cache_bytes': sum(entry['bytes'] for entry in cache_entries),
+        'seconds': time.perf_counter() - batch_start}
+    print_batch_summary(summary, cache_directory, max_cache_bytes)
+    if summary_file:
+        with open(summary_file, 'w') as json_file:
+            json.dump(summary, json_file, indent=2)
+        print("Batch summary saved to file '{}'".format(summary_file))
+
+
+def read_batch_manifest(manifest_file):
+
+    # list of jobs with every option set and the paths made absolute
+    with open(manifest_file) as manifest:
+        if manifest_file.endswith('.json'):
+            batch_manifest = json.load(manifest)
+        else:
+            import yaml
+            batch_manifest = yaml.safe_load(manifest)
+    if not isinstance(batch_manifest, dict) or not batch_manifest.get('jobs'):
+        print("The batch manifest '{}' has no list of 'jobs'.".format(manifest_file))
+        sys.exit()
+
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_file))
+    defaults = batch_manifest.get('defaults') or {}
+    jobs = []
+    for job_index, manifest_job in enumerate(batch_manifest['jobs']):
+        job = dict(job_options, **defaults)
+        job.update(manifest_job)
+        job.setdefault('name', 'job{}'.format(job_index + 1))
+        unknown_keys = set(job) - set(required_job_keys) - set(job_options) - {'name', 'outname'}
+        missing_keys = [key for key in required_job_keys if key not in job]
+        if unknown_keys:
+            print("Job '{}' of the batch manifest has unknown options: {}.".format(job['name'], ', '.join(sorted(unknown_keys))))
+            sys.exit()
+        if missing_keys:
+            print("Job '{}' of the batch manifest is missing: {}.".format(job['name'], ', '.join(missing_keys)))
+            sys.exit()
+        if job['prop'] is not None and len(job['prop']) != 2:
+            print("The 'prop' option of job '{}' must list the 'before' and 'after' uncertainty files.".format(job['name']))
+            sys.exit()
+
+        job['outname'] = os.path.join(manifest_directory, job.get('outname') or job['name'])
+        for key in ('before', 'after', 'boundary'):
+            if job[key] is not None:
+                job[key] = os.path.join(manifest_directory, job[key])
+        if job['prop'] is not None:
+            job['prop'] = [os.path.join(manifest_directory, uncertainty_file) for uncertainty_file in job['prop']]
+        for input_file in get_job_input_files(job).values():
+            if not os.path.isfile(input_file):
+                print("Input file '{}' of job '{}' does not exist.".format(input_file, job['name']))
+                sys.exit()
+        jobs.append(job)
+
+    outnames = [job['outname'] for job in jobs]
+    if len(set(outnames)) != len(outnames):
+        print("The jobs of the batch manifest must have different names (or 'outname's).")
+        sys.exit()
+
+    return jobs
+
+
+def get_job_input_files(job):
+
+    input_files = {'before_height': job['before'], 'after_height': job['after']}
+    if job['prop'] is not None:
+        input_files['before_uncertainty'] = job['prop'][0]
+        input_files['after_uncertainty'] = job['prop'][1]
+    if job['boundary'] is not None:
+        input_files['boundary'] = job['boundary']
+    return input_files
+
+
+def get_cache_manifest(job, hash_index):
+
+    # the inputs, by content, and the options that change the results of a job
+    # (see checkpoint_functions.get_checkpoint_manifest)
+    parameters = {option: job[option] for option in ['template_size', 'step_size'] + list(job_options)
+                  if option not in uncached_options + ['prop', 'boundary']}
+    parameters['propagate'] = job['prop'] is not None
+    if not parameters['propagate']:
+        parameters['jacobian'] = None
+        parameters['prop_mode'] = None
+    if parameters['prop_mode'] != 'montecarlo':
+        parameters['realizations'] = None
+        parameters['seed'] = None
+    if parameters['levels'] == 1:
+        parameters['search_radius'] = None
+    return {'inputs': {name: get_indexed_sha256(input_file, hash_index)
+                       for name, input_file in get_job_input_files(job).items()},
+            'parameters': parameters}
+
+
+def get_cache_key(cache_manifest):
+
+    return hashlib.sha256(json.dumps(cache_manifest, sort_keys=True).encode()).hexdigest()
+
+
+def get_indexed_sha256(file_name, hash_index):
+
+    # content hash of a file, reused while its size and modification time are unchanged
+    file_status = os.stat(file_name)
+    index_key = os.path.abspath(file_name)
+    indexed = hash_index.get(index_key)
+    if indexed is None or indexed['size'] != file_status.st_size or indexed['mtime_ns'] != file_status.st_mtime_ns:
+        indexed = {'size': file_status.st_size, 'mtime_ns': file_status.st_mtime_ns,
+                   'sha256': checkpoint_functions.get_file_sha256(file_name)}
+        hash_index[index_key] = indexed
+    return indexed['sha256']
+
+
+def read_hash_index(cache_directory):
+
+    try:
+        with open(os.path.join(cache_directory, hash_index_name)) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_hash_index(cache_directory, hash_index):
+
+    checkpoint_functions.write_file_atomically(os.path.join(cache_directory, hash_index_name),
+                                               json.dumps(hash_index, indent=2).encode())
+
+
+def get_piv_arguments(job, output_base_name):
+
+    # keyword arguments of piv_functions.piv, which resumes the checkpoint of an
+    # earlier attempt and displays nothing
+    propagate = job['prop'] is not None
+    return {'before_height_file': job['before'],
+            'after_height_file': job['after'],
+            'template_size': job['template_size'],
+            'step_size': job['step_size'],
+            'before_uncertainty_file': job['prop'][0] if propagate else '',
+            'after_uncertainty_file': job['prop'][1] if propagate else '',
+            'propagate': propagate,
+            'output_base_name': output_base_name,
+            'progress_reporter': progress_functions.NullProgressReporter(),
+            'jacobian_method': job['jacobian'],
+            'number_workers': 1,
+            'stream': job['stream'],
+            'output_format': job['format'],
+            'pyramid_levels': job['levels'],
+            'search_radius': job['search_radius'],
+            'resume': True,
+            'min_overlap': job['min_overlap'],
+            'boundary_file': job['boundary'],
+            'outlier_filter_size': job['outlier_filter'],
+            'outlier_threshold': job['outlier_threshold'],
+            'outlier_replacement': job['outlier_replace'],
+            'min_peak_ratio': job['min_peak_ratio'],
+            'precision': job['precision'],
+            'fft_workers': job['fft_workers'],
+            'montecarlo_realizations': job['realizations'] if job['prop_mode'] == 'montecarlo' else None,
+            'montecarlo_seed': job['seed'],
+            'display': False}
+
+
+def run_batch_job(partial_directory, piv_arguments):
+
+    # Runs one job in a pool worker, with its messages written to a log file in
+    # the partial directory that holds its results
+    import piv_functions
+
+    job_start = time.perf_counter()
+    os.makedirs(partial_directory, exist_ok=True)
+    log_file_name = os.path.join(partial_directory, 'log.txt')
+    with open(log_file_name, 'w') as log_file, contextlib.redirect_stdout(log_file):
+        try:
+            piv_functions.piv(**piv_arguments)
+            status = 'computed'
+        except SystemExit:
+            status = 'failed'
+        except Exception as error:
+            print(repr(error))
+            status = 'failed'
+
+    job_result = {'status': status, 'seconds': time.perf_counter() - job_start}
+    if status == 'failed':
+        with open(log_file_name) as log_file:
+            log_lines = [line.strip() for line in log_file if line.strip()]
+        job_result['message'] = log_lines[-1] if log_lines else 'unknown error'
+    return job_result
+
+
+def store_cache_entry(cache_directory, key, cache_manifest):
+
+    partial_directory = os.path.join(cache_directory, key + '.partial')
+    checkpoint_functions.write_file_atomically(os.path.join(partial_directory, entry_manifest_name),
+                                               json.dumps(cache_manifest, indent=2, sort_keys=True).encode())
+    os.replace(partial_directory, os.path.join(cache_directory, key))
+
+
+def copy_cached_result(cache_directory, job, status):
+
+    # copies the result files of a cache entry to the output names of a job and
+    # marks the entry as recently used
+    copy_start = time.perf_counter()
+    entry_directory = os.path.join(cache_directory, job['key'])
+    for file_name in sorted(os.listdir(entry_directory)):
+        if file_name not in (entry_manifest_name, 'log.txt'):
+            shutil.copyfile(os.path.join(entry_directory, file_name), job['outname'] + '_' + file_name)
+    os.utime(os.path.join(entry_directory, entry_manifest_name))
+    with open(os.path.join(entry_directory, 'metrics.json')) as json_file:
+        job['result']['vectors'] = json.load(json_file)['vectors']
+    job['result']['status'] = status
+    job['result']['seconds'] += time.perf_counter() - copy_start
+
+
+def get_cache_entries(cache_directory):
+
+    # completed cache entries with their size and last use time
+    cache_entries = []
+    for key in os.listdir(cache_directory):
+        entry_directory = os.path.join(cache_directory, key)
+        manifest_file = os.path.join(entry_directory, entry_manifest_name)
+        if os.path.isdir(entry_directory) and os.path.isfile(manifest_file):
+            cache_entries.append({'key': key,
+                                  'last_used': os.stat(manifest_file).st_mtime,
+                                  'bytes': sum(os.path.getsize(os.path.join(entry_directory, file_name))
+                                               for file_name in os.listdir(entry_directory))})
+    return cache_entries
+
+
+def evict_cache_entries(cache_directory, max_cache_bytes, kept_key=None):
+
+    # removes the least recently used entries until the cache is within its size
+    # limit; kept_key, the entry just stored, is never removed. Returns the number
+    # of entries removed.
+    cache_entries = sorted(get_cache_entries(cache_directory), key=lambda entry: entry['last_used'])
+    cache_bytes = sum(entry['bytes'] for entry in cache_entries)
+    number_evicted = 0
+    for entry in cache_entries:
+        if cache_bytes <= max_cache_bytes:
+            break
+        if entry['key'] == kept_key:
+            continue
+        shutil.rmtree(os.path.join(cache_directory, entry['key']))
+        cache_bytes -= entry['bytes']
+        number_evicted += 1
+    return number_evicted
+
+
+def print_batch_summary(summary, cache_directory, max_cache_bytes):
+
+    print('{:<30} {:<7} {:>9} {:>8}'.format('Job', 'Result', 'Time', 'Vectors'))
+    for job_result in summary['jobs']:
+        print('{:<30} {:<7} {:>9} {:>8}'.format(
+            job_result['name'][:30], job_result['status'],
+            progress_functions.format_duration(job_result['seconds']) if job_result['seconds'] >= 1
+            else '{:.2f} s'.format(job_result['seconds']),
+            job_result.get('vectors', '-')))
+    print("{} jobs: {} cache hits, {} misses, {} failed in {}.".format(
+        len(summary['jobs']), summary['hits'], summary['misses'], summary['failed'],
+        progress_functions.format_duration(summary['seconds'])))
+    print("Cache '{}' holds {} results ({:.1f} of {:.0f} MB); {} evicted.".format(
+        cache_directory, summary['cache_entries'], summary['cache_bytes'] / 2**20,
+        max_cache_bytes / 2**20, summary['evicted']))
@@ -0,0 +1,283 @@
+import click
+import numpy as np
+import scipy.ndimage
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import piv_functions
+import result_functions
+
+
+# Synthetic DEM pairs with a known deformation are run through run_piv, first
+# without and then with uncertainty propagation. Each pass runs in a fresh
+# process so its peak memory can be measured. The recovered vectors are compared
+# with the true displacements, and the propagated covariances with the spread of
+# the vector errors caused by the noise added to the DEMs.
+
+profiles = {
+    'small': {'dem_sizes': [256],
+              'template_sizes': [16, 24],
+              'step_sizes': [8, 16]},
+    'large': {'dem_sizes': [1024, 2048],
+              'template_sizes': [32, 48],
+              'step_sizes': [16, 32]},
+}
+
+# displacements in pixels; rotations and shears are about the DEM center
+deformations = {
+    'translation': {'translation': (3.3, -2.7), 'rotation': 0.0, 'shear': 0.0},
+    'rotation': {'translation': (0.0, 0.0), 'rotation': 0.5, 'shear': 0.0},
+    'shear': {'translation': (0.0, 0.0), 'rotation': 0.0, 'shear': 0.01},
+}
+
+terrain_relief = 10.0 # standard deviation of the synthetic heights
+# standard deviation of the noise added to each DEM, also used as its uncertainty;
+# large enough to dominate the error of the sub-pixel fit, so the propagated
+# uncertainty can be compared with the spread of the vector errors
+height_noise = 1.0
+outlier_threshold = 1.0 # vector error, in pixels, above which a vector is an outlier
+
+
+@click.command()
+@click.option('--profile', type=click.Choice(sorted(profiles)), default='small', show_default=True, help='Set of DEM, template and step sizes to run.')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='JSON file for the results. Defaults to benchmark_<profile>_<time>.json.')
+@click.option('--workers', type=click.IntRange(1, None), default=1, show_default=True, help='Number of processes used by run_piv.')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed for the synthetic terrain and noise.')
+def benchmark(profile, output, workers, seed):
+    '''
+    Benchmarks the throughput and accuracy of PIV on synthetic DEM pairs.
+    '''
+    if not output:
+        output = 'benchmark_{}_{}.json'.format(profile, datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+
+    results = {'profile': profile,
+               'time': datetime.datetime.now().isoformat(timespec='seconds'),
+               'seed': seed,
+               'workers': workers,
+               'environment': get_environment(),
+               'cases': []}
+
+    with tempfile.TemporaryDirectory(prefix='gpiv_benchmark_') as dem_directory:
+        for dem_size in profiles[profile]['dem_sizes']:
+            for deformation_name, deformation in deformations.items():
+                dem_files = write_synthetic_dems(dem_directory, dem_size, deformation, seed)
+                for template_size in profiles[profile]['template_sizes']:
+                    for step_size in profiles[profile]['step_sizes']:
+                        case = {'dem_size': dem_size,
+                                'deformation': deformation_name,
+                                'template_size': template_size,
+                                'step_size': step_size}
+                        for pass_name, propagate in (('piv', False), ('prop', True)):
+                            case[pass_name] = run_pass_in_process(dem_files, dem_size, deformation,
+                                                                  template_size, step_size,
+                                                                  propagate, workers)
+                        print(format_case(case))
+                        results['cases'].append(case)
+
+    with open(output, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+    print("Benchmark results saved to file '{}'".format(output))
+
+
+def get_environment():
+
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def make_terrain(dem_size, rng):
+
+    # smooth multi-scale random surface, a little larger than the DEM so deformed
+    # DEMs can be sampled without running off the edge
+    padded_size = dem_size + dem_size//2
+    terrain = np.zeros((padded_size, padded_size))
+    for scale, weight in ((2, 0.15), (6, 0.35), (20, 1.0)):
+        terrain += weight * scipy.ndimage.gaussian_filter(rng.normal(size=terrain.shape), scale)
+    terrain *= terrain_relief / np.std(terrain)
+
+    return terrain
+
+
+def get_deformation_matrix(deformation):
+
+    angle = np.radians(deformation['rotation'])
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    shear = np.array([[1.0, deformation['shear']], [0.0, 1.0]])
+
+    return rotation @ shear
+
+
+def get_true_displacements(column_rows, dem_size, deformation):
+
+    # A point p of the 'before' DEM (column, row pixel coordinates) moves to
+    # center + M (p - center) + translation in the 'after' DEM.
+    center = (dem_size - 1) / 2
+    matrix = get_deformation_matrix(deformation)
+    moved = center + (column_rows - center) @ matrix.T + np.asarray(deformation['translation'])
+
+    return moved - column_rows
+
+
+def write_synthetic_dems(dem_directory, dem_size, deformation, seed):
+
+    rng = np.random.default_rng(seed)
+    terrain = make_terrain(dem_size, rng)
+    offset = (terrain.shape[0] - dem_size) // 2
+    rows, columns = np.mgrid[0:dem_size, 0:dem_size].astype(float)
+
+    # the 'after' height at q is the 'before' height at the point that moved to q
+    center = (dem_size - 1) / 2
+    inverse_matrix = np.linalg.inv(get_deformation_matrix(deformation))
+    column_rows = np.stack((columns.ravel(), rows.ravel()), axis=1)
+    sources = center + (column_rows - center - np.asarray(deformation['translation'])) @ inverse_matrix.T
+
+    before_height = terrain[offset:offset+dem_size, offset:offset+dem_size]
+    after_height = scipy.ndimage.map_coordinates(
+        terrain, [sources[:,1] + offset, sources[:,0] + offset], order=3).reshape(dem_size, dem_size)
+
+    dem_files = {}
+    for name, raster in (('before_height', before_height + rng.normal(scale=height_noise, size=before_height.shape)),
+                         ('after_height', after_height + rng.normal(scale=height_noise, size=after_height.shape)),
+                         ('uncertainty', np.full((dem_size, dem_size), height_noise))):
+        dem_files[name] = os.path.join(dem_directory, name + '.npy')
+        np.save(dem_files[name], raster)
+
+    return dem_files
+
+
+def run_pass_in_process(dem_files, dem_size, deformation, template_size, step_size, propagate, workers):
+
+    # a fresh process per pass, so the peak memory is that of the pass alone
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_pass, dem_files, dem_size, deformation,
+                               template_size, step_size, propagate, workers).result()
+
+
+def run_pass(dem_files, dem_size, deformation, template_size, step_size, propagate, workers):
+
+    before_height = np.load(dem_files['before_height'])
+    after_height = np.load(dem_files['after_height'])
+    if propagate:
+        before_uncertainty = np.load(dem_files['uncertainty'])
+        after_uncertainty = before_uncertainty
+    else:
+        before_uncertainty = []
+        after_uncertainty = []
+    # 1 m pixels with the upper left corner at (0, dem_size), so ground and pixel
+    # coordinates only differ in the direction of y
+    geo_transform = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, float(dem_size)], [0.0, 0.0, 1.0]])
+    baseline_rss = get_peak_rss()
+
+    with tempfile.TemporaryDirectory(prefix='gpiv_benchmark_') as output_directory:
+        output_base_name = os.path.join(output_directory, '')
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # file name messages
+            piv_functions.run_piv(before_height, before_uncertainty,
+                                  after_height, after_uncertainty,
+                                  geo_transform,
+                                  piv_functions.get_piv_options(template_size, step_size, propagate),
+                                  output_base_name, number_workers=workers)
+        elapsed = time.perf_counter() - start_time
+        peak_rss = get_peak_rss()
+
+        vectors = np.array(result_functions.read_vectors(
+            result_functions.get_result_file_name(output_base_name, 'vectors', 'npy')))
+        if propagate:
+            covariances = np.array(result_functions.read_covariances(
+                result_functions.get_result_file_name(output_base_name, 'covariances', 'npy')))
+
+    number_windows = np.prod(piv_functions.get_window_grid_shape((dem_size, dem_size), template_size, step_size))
+    pass_result = {'seconds': elapsed,
+                   'windows': int(number_windows),
+                   'windows_per_second': number_windows / elapsed if elapsed > 0 else None,
+                   'baseline_rss_mb': baseline_rss,
+                   'peak_rss_mb': peak_rss}
+    pass_result.update(get_vector_accuracy(vectors, dem_size, deformation))
+    if propagate:
+        pass_result.update(get_covariance_accuracy(vectors, covariances, dem_size, deformation))
+
+    return pass_result
+
+
+def get_peak_rss():
+
+    # peak resident memory of this process in MB; ru_maxrss is in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 2**20
+    return peak_rss / 2**10
+
+
+def get_vector_errors(vectors, dem_size, deformation):
+
+    # records hold ground coordinates with y up and dy positive down; convert the
+    # origins back to pixel (column, row) coordinates
+    column_rows = np.column_stack((vectors['x'], dem_size - vectors['y']))
+    true_displacements = get_true_displacements(column_rows, dem_size, deformation)
+
+    return np.column_stack((vectors['dx'], vectors['dy'])) - true_displacements
+
+
+def get_vector_accuracy(vectors, dem_size, deformation):
+
+    if len(vectors) == 0:
+        return {'vectors': 0}
+    errors = get_vector_errors(vectors, dem_size, deformation)
+    error_lengths = np.hypot(errors[:,0], errors[:,1])
+    inliers = error_lengths <= outlier_threshold
+
+    return {'vectors': int(len(vectors)),
+            'outlier_fraction': float(np.mean(~inliers)),
+            'median_error': float(np.median(error_lengths)),
+            'rmse_inliers': [float(value) for value in np.sqrt(np.mean(errors[inliers]**2, axis=0))] if inliers.any() else None}
+
+
+def get_covariance_accuracy(vectors, covariances, dem_size, deformation):
+
+    # The propagated standard deviations should match the spread of the vector
+    # errors caused by the DEM noise; ratios near 1 are good. The spread is taken
+    # about the mean error, as the sub-pixel fit has a small systematic bias.
+    if len(vectors) < 2:
+        return {}
+    errors = get_vector_errors(vectors, dem_size, deformation)
+    inliers = np.hypot(errors[:,0], errors[:,1]) <= outlier_threshold
+    if np.count_nonzero(inliers) < 2:
+        return {}
+    empirical_std = np.std(errors[inliers], axis=0)
+    propagated_std = np.sqrt(np.mean(np.diagonal(covariances['covariance'][inliers], axis1=1, axis2=2), axis=0))
+
+    return {'propagated_std': [float(value) for value in propagated_std],
+            'empirical_std': [float(value) for value in empirical_std],
+            'std_ratio': [float(value) for value in propagated_std / empirical_std]}
+
+
+def format_case(case):
+
+    summary = '{dem_size:5d} px {deformation:<12} template {template_size:3d} step {step_size:3d}'.format(**case)
+    for pass_name in ('piv', 'prop'):
+        pass_result = case[pass_name]
+        summary += '  {}: {:8.1f} windows/s {:7.1f} MB'.format(
+            pass_name, pass_result['windows_per_second'] or 0, pass_result['peak_rss_mb'])
+        if 'median_error' in pass_result:
+            summary += ' median error {:.3f} px'.format(pass_result['median_error'])
+    if 'std_ratio' in case['prop']:
+        summary += '  std ratio {:.2f} {:.2f}'.format(*case['prop']['std_ratio'])
+
+    return summary
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,84 @@
+import click
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Times 'gpiv --help' and an option error in fresh interpreters, which is the
+# start up cost paid by every gpiv call in a batch job, and checks that the heavy
+# scientific packages are not imported to get there. Exits with status 1 if the
+# median time is over the budget or a heavy package was imported.
+
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+commands = {
+    'help': ['--help'],
+    'piv_help': ['piv', '--help'],
+    'option_error': ['piv', '--workers', '0', 'before.tif', 'after.tif', '16', '8'],
+}
+
+heavy_modules = ['numpy', 'scipy', 'rasterio', 'matplotlib', 'skimage']
+
+# runs the gpiv click group as the console script does
+gpiv_script = 'import sys; import gpiv; sys.argv[0] = "gpiv"; gpiv.cli()'
+imported_modules_script = 'import sys, json; import gpiv; print(json.dumps(sorted(sys.modules)))'
+
+
+@click.command()
+@click.option('--repeats', type=click.IntRange(1, None), default=10, show_default=True, help='Number of timed runs of each command.')
+@click.option('--budget', type=click.FloatRange(0, None, min_open=True), default=0.5, show_default=True, help='Maximum median time, in seconds, of each command.')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Optional JSON file for the results.')
+def benchmark(repeats, budget, output):
+    '''
+    Benchmarks the start up time of the gpiv command line interface.
+    '''
+    results = {'budget': budget, 'repeats': repeats, 'commands': {}}
+
+    imported_heavy_modules = get_imported_heavy_modules()
+    results['imported_heavy_modules'] = imported_heavy_modules
+    passed = not imported_heavy_modules
+    if imported_heavy_modules:
+        print('Importing gpiv imports {}'.format(', '.join(imported_heavy_modules)))
+
+    for command_name, arguments in commands.items():
+        seconds = [time_command(arguments) for _ in range(repeats)]
+        median_seconds = statistics.median(seconds)
+        results['commands'][command_name] = {'median_seconds': median_seconds,
+                                             'min_seconds': min(seconds),
+                                             'max_seconds': max(seconds)}
+        within_budget = median_seconds <= budget
+        passed = passed and within_budget
+        print('{:<14} median {:6.3f} s  min {:6.3f} s  max {:6.3f} s  {}'.format(
+            command_name, median_seconds, min(seconds), max(seconds),
+            'ok' if within_budget else 'over the {:.3f} s budget'.format(budget)))
+
+    results['passed'] = passed
+    if output:
+        with open(output, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+        print("Benchmark results saved to file '{}'".format(output))
+
+    sys.exit(0 if passed else 1)
+
+
+def time_command(arguments):
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', gpiv_script] + arguments, cwd=repository_directory,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def get_imported_heavy_modules():
+
+    completed = subprocess.run([sys.executable, '-c', imported_modules_script], cwd=repository_directory,
+                               stdout=subprocess.PIPE, check=True)
+    imported_modules = json.loads(completed.stdout)
+    return [module for module in heavy_modules if module in imported_modules]
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,87 @@
+import rasterio
+import rasterio.features
+import rasterio.warp
+import numpy as np
+import json
+import sys
+
+
+# A processing boundary limits PIV to an area of interest. It is either a
+# GeoJSON file of polygons or a mask raster whose nonzero (and not nodata)
+# pixels are inside the area. Both are converted to a boolean mask on the pixel
+# grid of the DEMs; the PIV windows whose template centers fall on the mask are
+# the only ones computed (see piv_functions.get_window_selection).
+
+geojson_extensions = ('.geojson', '.json')
+
+
+def read_boundary_mask(boundary_file, raster_file):
+
+    with rasterio.open(raster_file) as raster_source:
+        raster_shape = raster_source.shape
+        raster_transform = raster_source.transform
+        raster_crs = raster_source.crs
+
+    if boundary_file.lower().endswith(geojson_extensions):
+        return rasterize_geojson(boundary_file, raster_shape, raster_transform)
+    return read_mask_raster(boundary_file, raster_shape, raster_transform, raster_crs)
+
+
+def rasterize_geojson(geojson_file, raster_shape, raster_transform):
+
+    # The polygon coordinates are taken to be in the coordinate system of the
+    # DEMs; GeoJSON files written by GIS software for projected data usually are,
+    # even though the GeoJSON specification asks for longitude and latitude.
+    with open(geojson_file) as json_file:
+        geojson = json.load(json_file)
+
+    if geojson.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in geojson['features'] if feature.get('geometry')]
+    elif geojson.get('type') == 'Feature':
+        geometries = [geojson['geometry']] if geojson.get('geometry') else []
+    else:
+        geometries = [geojson]
+    geometries = [geometry for geometry in geometries if geometry['type'] in ('Polygon', 'MultiPolygon')]
+    if not geometries:
+        print("The boundary file '{}' contains no polygons.".format(geojson_file))
+        sys.exit()
+
+    boundary_mask = rasterio.features.rasterize(((geometry, 1) for geometry in geometries),
+                                                out_shape=raster_shape,
+                                                transform=raster_transform,
+                                                fill=0, dtype='uint8')
+    return boundary_mask.astype(bool)
+
+
+def read_mask_raster(mask_file, raster_shape, raster_transform, raster_crs):
+
+    try:
+        mask_source = rasterio.open(mask_file)
+    except rasterio.errors.RasterioIOError:
+        print("The boundary file '{}' is neither a GeoJSON file nor a readable raster.".format(mask_file))
+        sys.exit()
+
+    with mask_source:
+        mask = (mask_source.read(1) != 0) & (mask_source.read_masks(1) > 0)
+
+        if mask_source.crs and raster_crs and mask_source.crs != raster_crs:
+            boundary_mask = np.zeros(raster_shape, dtype='uint8')
+            rasterio.warp.reproject(mask.astype('uint8'), boundary_mask,
+                                    src_transform=mask_source.transform, src_crs=mask_source.crs,
+                                    dst_transform=raster_transform, dst_crs=raster_crs,
+                                    resampling=rasterio.enums.Resampling.nearest)
+            return boundary_mask.astype(bool)
+
+        # same (or unspecified) coordinate system: nearest mask pixel of each DEM
+        # pixel center; both grids are north up, so rows and columns map separately
+        column_centers = raster_transform.c + (np.arange(raster_shape[1]) + 0.5) * raster_transform.a
+        row_centers = raster_transform.f + (np.arange(raster_shape[0]) + 0.5) * raster_transform.e
+        mask_columns = np.floor((column_centers - mask_source.transform.c) / mask_source.transform.a).astype(int)
+        mask_rows = np.floor((row_centers - mask_source.transform.f) / mask_source.transform.e).astype(int)
+
+    boundary_mask = np.zeros(raster_shape, dtype=bool)
+    inside_rows = (mask_rows >= 0) & (mask_rows < mask.shape[0])
+    inside_columns = (mask_columns >= 0) & (mask_columns < mask.shape[1])
+    boundary_mask[np.ix_(inside_rows, inside_columns)] = mask[np.ix_(mask_rows[inside_rows], mask_columns[inside_columns])]
+
+    return boundary_mask
@@ -0,0 +1,88 @@
+import numpy as np
+import hashlib
+import json
+import os
+import re
+import shutil
+
+
+# A checkpoint is a directory holding a manifest of the inputs and parameters of
+# a PIV run and one .npz file per completed tile of window rows:
+#   manifest.json
+#   rows_000000_000003.npz   (window rows 0, 1 and 2)
+# Resuming replays the saved tiles and only computes the missing window rows, so
+# the output files are the same as those of an uninterrupted run.
+
+manifest_file_name = 'manifest.json'
+tile_file_pattern = re.compile(r'rows_(\d+)_(\d+)\.npz$')
+
+
+class PivCheckpoint:
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+
+    def create(self):
+        os.makedirs(self.directory)
+        write_file_atomically(os.path.join(self.directory, manifest_file_name),
+                              json.dumps(self.manifest, indent=2, sort_keys=True).encode())
+
+    def matches(self):
+        with open(os.path.join(self.directory, manifest_file_name)) as manifest_file:
+            return json.load(manifest_file) == self.manifest
+
+    def get_completed_tiles(self):
+        completed_tiles = []
+        for file_name in os.listdir(self.directory):
+            match = tile_file_pattern.match(file_name)
+            if match:
+                completed_tiles.append(range(int(match.group(1)), int(match.group(2))))
+        return sorted(completed_tiles, key=lambda vt_counts: vt_counts[0])
+
+    def load(self, vt_counts):
+        with np.load(os.path.join(self.directory, get_tile_file_name(vt_counts))) as tile_file:
+            tile_result = {name: tile_file[name] for name in tile_file.files}
+        tile_result['last_vt_count'] = int(tile_result['last_vt_count'])
+        tile_result['metrics'] = json.loads(str(tile_result['metrics']))
+        return tile_result
+
+    def save(self, vt_counts, tile_result):
+        # written under a temporary name and renamed, so an interrupted save never
+        # leaves a partial tile behind
+        tile_file_name = os.path.join(self.directory, get_tile_file_name(vt_counts))
+        with open(tile_file_name + '.tmp', 'wb') as tile_file:
+            np.savez(tile_file, **dict(tile_result, metrics=json.dumps(tile_result['metrics'])))
+        os.replace(tile_file_name + '.tmp', tile_file_name)
+
+    def remove(self):
+        shutil.rmtree(self.directory)
+
+
+def get_tile_file_name(vt_counts):
+
+    return 'rows_{:06d}_{:06d}.npz'.format(vt_counts[0], vt_counts[-1]+1)
+
+
+def get_checkpoint_manifest(input_files, parameters):
+
+    # the inputs are identified by content, so a resume against regenerated or
+    # edited DEMs is rejected even if the file names are unchanged
+    return {'inputs': {name: get_file_sha256(input_file) for name, input_file in input_files.items()},
+            'parameters': parameters}
+
+
+def get_file_sha256(file_name):
+
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(2**20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def write_file_atomically(file_name, data):
+
+    with open(file_name + '.tmp', 'wb') as output_file:
+        output_file.write(data)
+    os.replace(file_name + '.tmp', file_name)
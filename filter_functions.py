@@ -0,0 +1,175 @@
+import numpy as np
+
+
+# Outlier filtering on the regular grid of PIV windows. Vector records are put
+# back on their (row, column) window grid, with gaps where no vector was found,
+# and every vector is compared with its N x N neighbourhood by the normalized
+# median test (Westerweel and Scarano, 2005): with U_m the median of the
+# neighbours (the center excluded) and r_m the median of their residuals
+# |U_i - U_m|, a vector is an outlier when
+#   sqrt(sum over x and y of (|U_0 - U_m| / (r_m + epsilon))**2) > threshold
+# The neighbourhoods are sliding window views of the NaN padded grid, so the
+# test is a few array operations however many vectors there are.
+
+median_test_epsilon = 0.1 # pixels; the expected noise of a correlation peak
+replacement_methods = ['remove', 'median', 'interpolate']
+interpolation_passes = 10
+# number of neighbourhood values sorted at once, which bounds the memory used
+chunk_values = 2**22
+
+
+def get_grid_indices(records, geo_transform, template_size, step_size):
+
+    # window (row, column) of each vector from its origin, which is the template
+    # center (see result_functions.get_vector_records)
+    center_offset = template_size - (1 - template_size % 2)*0.5
+    origin_columns = (records['x'] - geo_transform[0,2]) / geo_transform[0,0]
+    origin_rows = (geo_transform[1,2] - records['y']) / geo_transform[0,0]
+    grid_rows = np.rint((origin_rows - center_offset) / step_size).astype(int)
+    grid_columns = np.rint((origin_columns - center_offset) / step_size).astype(int)
+
+    return grid_rows, grid_columns
+
+
+def get_vector_grid(vector_records, geo_transform, template_size, step_size, grid_shape=None):
+
+    # (rows, columns, 2) masked array of (dx, dy) in ground units; windows without
+    # a vector are masked
+    grid_rows, grid_columns = get_grid_indices(vector_records, geo_transform, template_size, step_size)
+    if grid_shape is None:
+        grid_shape = (grid_rows.max(initial=-1) + 1, grid_columns.max(initial=-1) + 1)
+    vector_grid = np.full(tuple(grid_shape) + (2,), np.nan)
+    vector_grid[grid_rows, grid_columns, 0] = vector_records['dx']
+    vector_grid[grid_rows, grid_columns, 1] = vector_records['dy']
+
+    return np.ma.masked_invalid(vector_grid)
+
+
+def get_neighbourhoods(grid, neighbourhood_size, row_start, row_end):
+
+    # (rows, columns, N*N - 1) neighbours of the grid rows row_start to row_end,
+    # NaN outside the grid
+    half_size = neighbourhood_size // 2
+    padded_rows = np.pad(grid[max(0, row_start-half_size):row_end+half_size],
+                         ((half_size - min(row_start, half_size),
+                           max(0, row_end + half_size - grid.shape[0])),
+                          (half_size, half_size)),
+                         constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded_rows, (neighbourhood_size, neighbourhood_size))
+    windows = windows.reshape(windows.shape[:2] + (neighbourhood_size**2,))
+    center = neighbourhood_size**2 // 2
+    return np.concatenate((windows[..., :center], windows[..., center+1:]), axis=-1)
+
+
+def get_nan_median(stack):
+
+    # median over the last axis ignoring NaN, which np.sort places last; NaN
+    # where every value is NaN
+    stack = np.sort(stack, axis=-1)
+    number_valid = np.count_nonzero(~np.isnan(stack), axis=-1)[..., np.newaxis]
+    lower = np.take_along_axis(stack, np.maximum(number_valid - 1, 0) // 2, axis=-1)
+    upper = np.take_along_axis(stack, number_valid // 2, axis=-1)
+    median = (lower + upper)[..., 0] / 2
+    median[number_valid[..., 0] == 0] = np.nan
+
+    return median
+
+
+def get_neighbour_medians(grid, neighbourhood_size):
+
+    # median of the neighbours of every grid cell, the median of their absolute
+    # residuals from it and the number of neighbours, computed over chunks of
+    # grid rows
+    neighbour_medians = np.full(grid.shape, np.nan)
+    residual_medians = np.full(grid.shape, np.nan)
+    number_neighbours = np.zeros(grid.shape, dtype=int)
+    rows_per_chunk = max(1, chunk_values // max(1, grid.shape[1] * neighbourhood_size**2))
+    for row_start in range(0, grid.shape[0], rows_per_chunk):
+        row_end = min(row_start + rows_per_chunk, grid.shape[0])
+        neighbours = get_neighbourhoods(grid, neighbourhood_size, row_start, row_end)
+        median = get_nan_median(neighbours)
+        neighbour_medians[row_start:row_end] = median
+        residual_medians[row_start:row_end] = get_nan_median(np.abs(neighbours - median[..., np.newaxis]))
+        number_neighbours[row_start:row_end] = np.count_nonzero(~np.isnan(neighbours), axis=-1)
+
+    return neighbour_medians, residual_medians, number_neighbours
+
+
+def get_median_test_outliers(vector_grid, neighbourhood_size=3, threshold=2.0, epsilon=median_test_epsilon):
+
+    # Boolean grid of the vectors failing the normalized median test. vector_grid
+    # is a masked (rows, columns, 2) array in the units of epsilon. Vectors
+    # without at least two neighbours are not tested.
+    normalized_residuals = np.zeros(vector_grid.shape[:2])
+    for component in range(2):
+        grid = vector_grid[..., component].filled(np.nan)
+        neighbour_medians, residual_medians, number_neighbours = get_neighbour_medians(grid, neighbourhood_size)
+        normalized_residuals += (np.abs(grid - neighbour_medians) / (residual_medians + epsilon))**2
+
+    with np.errstate(invalid='ignore'):
+        return (np.sqrt(normalized_residuals) > threshold) & (number_neighbours >= 2) & ~vector_grid.mask[..., 0]
+
+
+def replace_outliers(vector_grid, outliers, neighbourhood_size=3, method='median'):
+
+    # Returns a copy of vector_grid with the outliers replaced by the median of
+    # their remaining neighbours ('median'), by repeated averages of their 3x3
+    # neighbours so clusters of outliers fill in from their edges ('interpolate'),
+    # or masked ('remove'). Outliers that cannot be replaced are masked.
+    replaced_grid = vector_grid.filled(np.nan)
+    replaced_grid[outliers] = np.nan
+    if method == 'median':
+        for component in range(2):
+            neighbour_medians, _, _ = get_neighbour_medians(replaced_grid[..., component], neighbourhood_size)
+            replaced_grid[outliers, component] = neighbour_medians[outliers]
+    elif method == 'interpolate':
+        remaining_rows, remaining_columns = np.nonzero(outliers)
+        neighbour_offsets = [(row_offset, column_offset)
+                             for row_offset in (-1, 0, 1) for column_offset in (-1, 0, 1)
+                             if row_offset or column_offset]
+        for _ in range(interpolation_passes):
+            if remaining_rows.size == 0:
+                break
+            padded_grid = np.pad(replaced_grid, ((1, 1), (1, 1), (0, 0)), constant_values=np.nan)
+            neighbours = np.stack([padded_grid[remaining_rows + 1 + row_offset, remaining_columns + 1 + column_offset]
+                                   for row_offset, column_offset in neighbour_offsets], axis=1)
+            number_valid = np.count_nonzero(~np.isnan(neighbours[..., 0]), axis=1)
+            filled = number_valid > 0
+            replaced_grid[remaining_rows[filled], remaining_columns[filled]] = (
+                np.nansum(neighbours[filled], axis=1) / number_valid[filled, np.newaxis])
+            remaining_rows = remaining_rows[~filled]
+            remaining_columns = remaining_columns[~filled]
+
+    return np.ma.masked_invalid(replaced_grid)
+
+
+def filter_vector_records(vector_records, covariance_records, geo_transform,
+                          template_size, step_size,
+                          neighbourhood_size=3, threshold=2.0, method='remove'):
+
+    # Applies the normalized median test to PIV result records and removes or
+    # replaces the outliers. Replaced vectors get NaN peak heights and ratios and
+    # keep the covariance propagated for the rejected match, moved to their new
+    # end location. Returns the filtered vector and covariance records (None if
+    # covariance_records is None) and the number of outliers found.
+    grid_rows, grid_columns = get_grid_indices(vector_records, geo_transform, template_size, step_size)
+    vector_grid = get_vector_grid(vector_records, geo_transform, template_size, step_size)
+    # the test is done in pixels, the units of the epsilon noise level
+    outliers = get_median_test_outliers(vector_grid / geo_transform[0,0], neighbourhood_size, threshold)
+    record_outliers = outliers[grid_rows, grid_columns]
+
+    replaced_grid = replace_outliers(vector_grid, outliers, neighbourhood_size, method)
+    kept = ~replaced_grid.mask[grid_rows, grid_columns, 0]
+    vector_records = np.array(vector_records[kept])
+    vector_records['dx'] = replaced_grid[grid_rows[kept], grid_columns[kept], 0]
+    vector_records['dy'] = replaced_grid[grid_rows[kept], grid_columns[kept], 1]
+    # replaced vectors do not come from a correlation peak
+    for name in ('peak_height', 'peak_ratio'):
+        if name in vector_records.dtype.names:
+            vector_records[name][record_outliers[kept]] = np.nan
+    if covariance_records is not None:
+        covariance_records = np.array(covariance_records[kept])
+        covariance_records['x'] = vector_records['x'] + vector_records['dx']
+        covariance_records['y'] = vector_records['y'] - vector_records['dy']  # dy is positive down
+
+    return vector_records, covariance_records, int(np.count_nonzero(record_outliers))
@@ -1,6 +1,12 @@
 import click
-import piv_functions
-import show_functions
+import importlib.util
+import progress_functions
+import metrics_functions
+
+
+# piv_functions and show_functions pull in rasterio, SciPy and matplotlib, which
+# take most of a second to import. They are imported in the commands that use
+# them, so 'gpiv --help' and option errors return immediately.
 
 
 @click.group()
@@ -14,8 +20,29 @@ def cli():
 @click.argument('template_size', type=click.IntRange(3, None))
 @click.argument('step_size', type=click.IntRange(1, None))
 @click.option('--prop', nargs=2, type=click.Path(exists=True, readable=True), help='Option to propagate error. Requires two arguments: 1) pre-event uncertainties in GeoTIFF format, 2) post-event uncertainties in GeoTIFF format.')
+@click.option('--prop-mode', type=click.Choice(['linear', 'montecarlo']), default='linear', show_default=True, help="How the DEM uncertainties are propagated with '--prop'. 'linear' propagates them through the derivatives of the correlation and of the sub-pixel peak fit; 'montecarlo' correlates '--realizations' noisy copies of every window and takes the covariance of their peaks, which stays valid where the correlation is far from linear but takes longer.")
+@click.option('--realizations', type=click.IntRange(2, None), default=100, show_default=True, help="Number of noise realizations per window with '--prop-mode montecarlo'.")
+@click.option('--seed', type=int, default=0, show_default=True, help="Seed of the '--prop-mode montecarlo' noise, so runs can be repeated.")
 @click.option('--outname', type=str, help='Optional base filename to use for output files.')
-def piv(before_height, after_height, template_size, step_size, prop, outname):
+@click.option('--format', 'output_format', type=click.Choice(['npy', 'json']), default='npy', show_default=True, help="Format of the output vector and covariance files. 'npy' files are written as the computation proceeds and are memory mapped when displayed; 'json' is the original text format.")
+@click.option('--jacobian', type=click.Choice(['analytic', 'numeric']), default='analytic', show_default=True, help="How the correlation Jacobian is computed when propagating error. 'numeric' uses the much slower finite difference reference.")
+@click.option('--workers', type=click.IntRange(1, None), default=1, show_default=True, help='Number of processes used to compute PIV. Rows of the window grid are split into tiles that are distributed over the processes.')
+@click.option('--precision', type=click.Choice(['float32', 'float64']), default='float64', show_default=True, help="Floating point precision of the heights, uncertainties and correlations. 'float32' halves the memory use and speeds up the correlation; see the Readme for its accuracy. Result files are always float64.")
+@click.option('--fft-workers', type=click.IntRange(1, None), default=1, show_default=True, help="Number of threads used by each process for the correlation FFTs. Use with '--workers 1' to spread the correlations over several cores without starting processes.")
+@click.option('--stream', is_flag=True, help='Read only the strip of raster rows needed by the windows being processed instead of loading the full rasters into memory. Use for DEMs larger than the available memory.')
+@click.option('--levels', type=click.IntRange(1, None), default=1, show_default=True, help='Number of image pyramid levels. With more than one level, displacements are first estimated on DEMs downsampled by powers of two and each finer level only searches around the displacement predicted by the coarser one, so large displacements can be found with small templates.')
+@click.option('--search-radius', type=click.IntRange(2, None), default=3, show_default=True, help="Number of pixels searched around the predicted displacement on the finer pyramid levels. Only used with '--levels' greater than 1.")
+@click.option('--min-overlap', type=click.FloatRange(0, 1, min_open=True), default=1.0, show_default=True, help='Minimum fraction of the template pixels that must be valid (not NaN or nodata) in both the template and the overlapping search area. Windows with missing pixels are correlated over their valid pixels only; lower values keep more windows near data gaps and edges.')
+@click.option('--boundary', type=click.Path(exists=True, readable=True), help='Processing boundary. Either a GeoJSON file of polygons in the coordinate system of the DEMs or a mask raster whose nonzero pixels are inside the area of interest. Only the windows whose templates are centered inside the boundary are computed.')
+@click.option('--min-peak-ratio', type=click.FloatRange(1, None), default=1.0, show_default=True, help='Minimum ratio of the correlation peak to the second highest peak. Ambiguous matches below it are rejected before any uncertainty propagation. The peak height and ratio of every vector are saved with it.')
+@click.option('--outlier-filter', type=click.IntRange(3, None), help='Flag outlier vectors with a normalized median test over the given (odd) size of neighbourhood of windows, e.g., 3 for the 8 surrounding windows.')
+@click.option('--outlier-threshold', type=click.FloatRange(0, None, min_open=True), default=2.0, show_default=True, help="Normalized median residual above which a vector is an outlier. Only used with '--outlier-filter'.")
+@click.option('--outlier-replace', type=click.Choice(['remove', 'median', 'interpolate']), default='remove', show_default=True, help="What to do with outlier vectors: 'remove' them, replace them with the 'median' of their neighbours or 'interpolate' them from their neighbours. Replaced vectors keep the covariance propagated for the original match. Only used with '--outlier-filter'.")
+@click.option('--resume', is_flag=True, help="Continue an interrupted run from its checkpoint. Completed window rows are saved to the '<outname>_checkpoint' directory while PIV runs and the directory is removed when the run finishes. The input files, template size, step size and options must match the interrupted run.")
+@click.option('--profiler', type=click.Choice(['cprofile', 'pyinstrument']), help="Profile the run with cProfile or pyinstrument (if installed) and save the profile next to the outputs. Only the main process is profiled, so use a single worker. Stage timings and skipped window counts are always saved to the metrics file.")
+@click.option('--progress', type=click.Choice(['text', 'plot', 'none']), default='text', show_default=True, help="How to report PIV progress. 'text' prints a progress bar with throughput and ETA and works without a display, 'plot' shows the current template and search area over the DEMs, 'none' is silent.")
+@click.option('--redraw-rate', type=click.FloatRange(0, None, min_open=True), default=2.0, show_default=True, help="Maximum number of redraws per second when using '--progress plot'.")
+def piv(before_height, after_height, template_size, step_size, prop, prop_mode, realizations, seed, outname, output_format, jacobian, workers, precision, fft_workers, stream, levels, search_radius, min_overlap, boundary, min_peak_ratio, outlier_filter, outlier_threshold, outlier_replace, resume, profiler, progress, redraw_rate):
     '''
     Runs PIV on a pair pre- and post-event DEMs.
 
@@ -25,6 +52,15 @@ def piv(before_height, after_height, template_size, step_size, prop, outname):
                TEMPLATE_SIZE  Size of square correlation template in pixels
                STEP_SIZE      Size of template step in pixels
     '''
+    if stream and progress == 'plot':
+        raise click.BadOptionUsage('progress', "'--progress plot' needs the full rasters in memory and cannot be combined with '--stream'.")
+
+    if outlier_filter is not None and outlier_filter % 2 == 0:
+        raise click.BadOptionUsage('outlier_filter', "'--outlier-filter' must be an odd neighbourhood size.")
+
+    if profiler == 'pyinstrument' and importlib.util.find_spec('pyinstrument') is None:
+        raise click.BadOptionUsage('profiler', "'--profiler pyinstrument' requires the pyinstrument package.")
+
     if prop:
         propagate = True
         before_uncertainty = prop[0]
@@ -39,16 +75,112 @@ def piv(before_height, after_height, template_size, step_size, prop, outname):
     else:
         output_base_name = ''
 
-    piv_functions.piv(before_height, after_height, 
-                      template_size, step_size, 
-                      before_uncertainty, after_uncertainty,
-                      propagate, output_base_name)
+    import piv_functions
+
+    piv_arguments = {'before_height_file': before_height,
+                     'after_height_file': after_height,
+                     'template_size': template_size,
+                     'step_size': step_size,
+                     'before_uncertainty_file': before_uncertainty,
+                     'after_uncertainty_file': after_uncertainty,
+                     'propagate': propagate,
+                     'output_base_name': output_base_name,
+                     'progress_reporter': progress_functions.get_progress_reporter(progress, redraw_rate),
+                     'jacobian_method': jacobian,
+                     'number_workers': workers,
+                     'stream': stream,
+                     'output_format': output_format,
+                     'pyramid_levels': levels,
+                     'search_radius': search_radius,
+                     'resume': resume,
+                     'min_overlap': min_overlap,
+                     'boundary_file': boundary,
+                     'outlier_filter_size': outlier_filter,
+                     'outlier_threshold': outlier_threshold,
+                     'outlier_replacement': outlier_replace,
+                     'min_peak_ratio': min_peak_ratio,
+                     'precision': precision,
+                     'fft_workers': fft_workers,
+                     'montecarlo_realizations': realizations if prop_mode == 'montecarlo' else None,
+                     'montecarlo_seed': seed}
+    if profiler:
+        metrics_functions.run_with_profiler(profiler, output_base_name, piv_functions.piv, **piv_arguments)
+    else:
+        piv_functions.piv(**piv_arguments)
+
+
+@click.command()
+@click.argument('template_size', type=click.IntRange(3, None))
+@click.argument('step_size', type=click.IntRange(1, None))
+@click.argument('heights', nargs=-1, required=True, type=click.Path(exists=True, readable=True))
+@click.option('--prop', 'uncertainties', multiple=True, type=click.Path(exists=True, readable=True), help='Option to propagate error. Give the uncertainties of each DEM in GeoTIFF format, in the order of the DEMs, with one --prop per DEM.')
+@click.option('--prop-mode', type=click.Choice(['linear', 'montecarlo']), default='linear', show_default=True, help="How the DEM uncertainties are propagated with '--prop', see 'gpiv piv --help'.")
+@click.option('--realizations', type=click.IntRange(2, None), default=100, show_default=True, help="Number of noise realizations per window with '--prop-mode montecarlo'.")
+@click.option('--seed', type=int, default=0, show_default=True, help="Seed of the '--prop-mode montecarlo' noise, so runs can be repeated.")
+@click.option('--pairs', 'pair_mode', type=click.Choice(['consecutive', 'all']), default='consecutive', show_default=True, help="Which pairs of DEMs to correlate: each DEM with the next one ('consecutive') or every DEM with every later one ('all').")
+@click.option('--outname', type=str, help='Optional base filename to use for output files.')
+@click.option('--jacobian', type=click.Choice(['analytic', 'numeric']), default='analytic', show_default=True, help="How the correlation Jacobian is computed when propagating error. 'numeric' uses the much slower finite difference reference.")
+@click.option('--precision', type=click.Choice(['float32', 'float64']), default='float64', show_default=True, help="Floating point precision of the heights, uncertainties and correlations. Result files are always float64.")
+@click.option('--fft-workers', type=click.IntRange(1, None), default=1, show_default=True, help='Number of threads used for the correlation FFTs.')
+@click.option('--min-overlap', type=click.FloatRange(0, 1, min_open=True), default=1.0, show_default=True, help='Minimum fraction of the template pixels that must be valid (not NaN or nodata) in both the template and the overlapping search area.')
+@click.option('--boundary', type=click.Path(exists=True, readable=True), help='Processing boundary. Either a GeoJSON file of polygons in the coordinate system of the DEMs or a mask raster whose nonzero pixels are inside the area of interest.')
+@click.option('--min-peak-ratio', type=click.FloatRange(1, None), default=1.0, show_default=True, help='Minimum ratio of the correlation peak to the second highest peak. Ambiguous matches below it are rejected before any uncertainty propagation.')
+@click.option('--progress', type=click.Choice(['text', 'none']), default='text', show_default=True, help="How to report PIV progress. 'text' prints a progress bar with throughput and ETA, 'none' is silent.")
+def series(template_size, step_size, heights, uncertainties, prop_mode, realizations, seed, pair_mode, outname, jacobian, precision, fft_workers, min_overlap, boundary, min_peak_ratio, progress):
+    '''
+    Runs PIV on a time series of DEMs.
+
+    \b
+    Arguments: TEMPLATE_SIZE  Size of square correlation template in pixels
+               STEP_SIZE      Size of template step in pixels
+               HEIGHTS        Two or more DEMs in GeoTIFF format, in time order
+    '''
+    if len(heights) < 2:
+        raise click.BadArgumentUsage('A time series needs at least two DEMs.')
+
+    if uncertainties and len(uncertainties) != len(heights):
+        raise click.BadOptionUsage('uncertainties', "'--prop' must be given once for each DEM.")
+
+    if outname:
+        output_base_name = outname + '_'
+    else:
+        output_base_name = ''
+
+    import series_functions
+
+    series_functions.series(list(heights), list(uncertainties),
+                            template_size, step_size, pair_mode, output_base_name,
+                            progress_functions.get_progress_reporter(progress),
+                            jacobian, min_overlap, boundary, min_peak_ratio,
+                            precision, fft_workers,
+                            realizations if prop_mode == 'montecarlo' else None, seed)
+
+
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True, readable=True))
+@click.option('--cache-dir', type=click.Path(file_okay=False), help="Directory of the result cache. Defaults to 'gpiv_cache' next to the manifest.")
+@click.option('--cache-size', type=click.IntRange(1, None), default=10240, show_default=True, help='Size limit of the result cache in MB. The least recently used results are removed to stay under it.')
+@click.option('--workers', type=click.IntRange(1, None), default=1, show_default=True, help='Number of processes used to compute the jobs. Each job runs in a single process.')
+@click.option('--summary', type=click.Path(dir_okay=False, writable=True), help='Optional JSON file for the summary of cache hits, misses and job timings.')
+def batch(manifest, cache_dir, cache_size, workers, summary):
+    '''
+    Runs the PIV jobs of a manifest, reusing cached results.
+
+    \b
+    Arguments: MANIFEST  YAML (or JSON) file listing the PIV jobs, see the Readme
+    '''
+    if not manifest.endswith('.json') and importlib.util.find_spec('yaml') is None:
+        raise click.BadArgumentUsage('YAML manifests require the PyYAML package; use a JSON manifest instead.')
+
+    import batch_functions
+
+    batch_functions.batch(manifest, cache_dir, cache_size, workers, summary)
 
 
 @click.command()
 @click.argument('background_image', type=click.Path(exists=True, readable=True))
-@click.option('--vec', type=click.Path(exists=True, readable=True), help="Option to overlay PIV vectors on the background image. Requires the json file of PIV vectors generated by the 'piv' command.")
-@click.option('--ell', type=click.Path(exists=True, readable=True), help="Option to overlay PIV uncertainty ellipses on the background image. Requires the json file of covariance matrices generated when running the 'piv' command with the 'prop' option.")
+@click.option('--vec', type=click.Path(exists=True, readable=True), help="Option to overlay PIV vectors on the background image. Requires the npy or json file of PIV vectors generated by the 'piv' command.")
+@click.option('--ell', type=click.Path(exists=True, readable=True), help="Option to overlay PIV uncertainty ellipses on the background image. Requires the npy or json file of covariance matrices generated when running the 'piv' command with the 'prop' option.")
 @click.option('--vecscale', type=float, help='Option to scale the displayed PIV vectors. Requires a numeric scale factor.')
 @click.option('--ellscale', type=float, help='Option to scale the displayed uncertainty ellipses. Requires a numeric scale factor.')
 def pivshow(background_image, vec, ell, vecscale, ellscale):
@@ -57,10 +189,14 @@ def pivshow(background_image, vec, ell, vecscale, ellscale):
     
     Arguments: BACKGROUND_IMAGE  Background image in GeoTIFF format
     '''
+    import show_functions
+
     show_functions.show(background_image, vec, ell, vecscale, ellscale)
 
 
 cli.add_command(piv)
+cli.add_command(series)
+cli.add_command(batch)
 cli.add_command(pivshow)
 
 # if __name__ == '__main__':
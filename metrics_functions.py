@@ -0,0 +1,73 @@
+import json
+import time
+
+
+# Run metrics are cumulative seconds per stage and window counts per skip reason:
+#   {'seconds': {'extract': 1.2, 'guard': 0.3, ...},
+#    'skipped': {'template_flat': 10, 'edge_peak': 3, ...}}
+# run_piv_tile collects them for its tile; run_piv merges the tiles (which may
+# have been computed in other processes) and writes the totals to a JSON file.
+
+skip_reasons = ['outside_boundary', 'template_flat', 'template_nan', 'search_outside', 'search_flat', 'search_nan', 'edge_peak', 'weak_peak']
+
+
+def new_metrics():
+
+    return {'seconds': {}, 'skipped': {reason: 0 for reason in skip_reasons}}
+
+
+def add_stage_time(metrics, stage, stage_start):
+
+    # adds the time since stage_start to the stage and returns the current time,
+    # which is the start of the next stage
+    now = time.perf_counter()
+    metrics['seconds'][stage] = metrics['seconds'].get(stage, 0.0) + now - stage_start
+    return now
+
+
+def add_skipped(metrics, reason, number_skipped):
+
+    metrics['skipped'][reason] += int(number_skipped)
+
+
+def merge_metrics(metrics, tile_metrics):
+
+    for stage, seconds in tile_metrics['seconds'].items():
+        metrics['seconds'][stage] = metrics['seconds'].get(stage, 0.0) + seconds
+    for reason, number_skipped in tile_metrics['skipped'].items():
+        metrics['skipped'][reason] = metrics['skipped'].get(reason, 0) + number_skipped
+
+
+def write_metrics(file_name, metrics):
+
+    with open(file_name, 'w') as json_file:
+        json.dump(metrics, json_file, indent=2)
+
+
+def run_with_profiler(profiler, profile_base_name, function, **arguments):
+
+    # Runs function(**arguments) under cProfile or pyinstrument. Only the main process is
+    # profiled, so use a single worker to see where the PIV computation goes.
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        result = profile.runcall(function, **arguments)
+        profile.dump_stats(profile_base_name + 'profile.pstats')
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+        print("Profile saved to file '{}'".format(profile_base_name + 'profile.pstats'))
+    else:
+        import pyinstrument
+
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            result = function(**arguments)
+        finally:
+            profile.stop()
+        with open(profile_base_name + 'profile.html', 'w') as html_file:
+            html_file.write(profile.output_html())
+        print("Profile saved to file '{}'".format(profile_base_name + 'profile.html'))
+
+    return result
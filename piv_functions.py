@@ -1,58 +1,286 @@
 import rasterio
 import numpy as np
 import sys
-from skimage.feature import match_template
-import matplotlib.pyplot as plt
-import matplotlib.patches
+import os
 import math
 import json
-import show_functions
+import tempfile
+import itertools
+import concurrent.futures
+import time
+import scipy.fft
+import scipy.ndimage
+import progress_functions
+import result_functions
+import checkpoint_functions
+import metrics_functions
+import boundary_functions
+import filter_functions
+
+
+# the Monte Carlo propagation searches this many pixels around each correlation
+# peak and perturbs at most this many search patch values at once
+montecarlo_search_radius = 3
+montecarlo_chunk_values = 2**22
 
 
 def piv(before_height_file, after_height_file,
         template_size, step_size,
         before_uncertainty_file, after_uncertainty_file,
-        propagate, output_base_name):
+        propagate, output_base_name,
+        progress_reporter=None, jacobian_method='analytic',
+        number_workers=1, stream=False, output_format='npy',
+        pyramid_levels=1, search_radius=3, resume=False, min_overlap=1.0,
+        boundary_file=None, outlier_filter_size=None, outlier_threshold=2.0,
+        outlier_replacement='remove', min_peak_ratio=1.0,
+        precision='float64', fft_workers=1, montecarlo_realizations=None,
+        montecarlo_seed=0, display=True):
+
+    # Runs PIV on a pair of DEM files and writes the result files; with display,
+    # the results are then shown over the 'before' DEM. With
+    # montecarlo_realizations, the uncertainty is propagated by Monte Carlo
+    # (see run_piv_tile) instead of linearized propagation.
+    if progress_reporter is None:
+        progress_reporter = progress_functions.TextProgressReporter()
+
+    vector_file = result_functions.get_result_file_name(output_base_name, 'vectors', output_format)
+    covariance_file = result_functions.get_result_file_name(output_base_name, 'covariances', output_format)
+
+    if stream:
+        # run_piv reads the strip of raster rows each tile needs directly from the files
+        geo_transform = get_geo_transform(before_height_file, after_height_file)
+        before_height = before_height_file
+        after_height = after_height_file
+        if propagate:
+            before_uncertainty = before_uncertainty_file
+            after_uncertainty = after_uncertainty_file
+        else:
+            before_uncertainty = []
+            after_uncertainty = []
+    else:
+        (before_height, before_uncertainty,
+         after_height, after_uncertainty,
+         geo_transform) = get_image_arrays(before_height_file,
+                                           before_uncertainty_file,
+                                           after_height_file,
+                                           after_uncertainty_file,
+                                           propagate, precision)
+
+    # only the windows whose templates are centered inside the boundary are computed
+    if boundary_file:
+        window_selection = get_window_selection(
+            boundary_functions.read_boundary_mask(boundary_file, before_height_file),
+            template_size, step_size)
+        if not window_selection.any():
+            print("No PIV windows are centered inside the boundary in '{}'.".format(boundary_file))
+            sys.exit()
+    else:
+        window_selection = None
 
-    (before_height, before_uncertainty, 
-     after_height, after_uncertainty, 
-     geo_transform) = get_image_arrays(before_height_file,
-                                       before_uncertainty_file,
-                                       after_height_file,
-                                       after_uncertainty_file,
-                                       propagate)
+    # completed tiles are saved as the run proceeds, so an interrupted run can be resumed
+    input_files = {'before_height': before_height_file, 'after_height': after_height_file}
+    if propagate:
+        input_files['before_uncertainty'] = before_uncertainty_file
+        input_files['after_uncertainty'] = after_uncertainty_file
+    if boundary_file:
+        input_files['boundary'] = boundary_file
+    options = get_piv_options(template_size, step_size, propagate, jacobian_method,
+                              pyramid_levels, search_radius, min_overlap, min_peak_ratio,
+                              precision, montecarlo_realizations, montecarlo_seed)
+    checkpoint = open_piv_checkpoint(output_base_name + 'checkpoint', input_files, options, resume)
+
+    if pyramid_levels > 1:
+        # the full resolution windows only search around the displacements found on
+        # the coarser levels
+        try:
+            predictors = get_pyramid_predictors(before_height, after_height, options,
+                                                fft_workers, verbose=True)
+        except ValueError as error:
+            print(error)
+            sys.exit()
+    else:
+        predictors = None
 
     if not propagate:
         print("Computing PIV.")
         run_piv(before_height, [],
                 after_height, [],
-                geo_transform, template_size, step_size,
-                False, output_base_name)
-        show_functions.show(before_height_file,
-                            output_base_name + 'vectors.json',
-                            None,
-                            1, 1)
+                geo_transform, options, output_base_name, progress_reporter,
+                number_workers, output_format, predictors, checkpoint,
+                window_selection, fft_workers)
+        checkpoint.remove()
+        if outlier_filter_size:
+            filter_result_files(vector_file, None, output_format, geo_transform,
+                                template_size, step_size,
+                                outlier_filter_size, outlier_threshold, outlier_replacement)
+        if display:
+            import show_functions
+            show_functions.show(before_height_file,
+                                vector_file,
+                                None,
+                                1, 1)
     else:
-        print("Computing bias variance.")
-        run_piv(before_height, [],
-                before_height, [],
-                geo_transform, template_size, step_size,
-                False, output_base_name)
-        xy_bias_variance = get_bias_variance(output_base_name)
-
-        print("Computing PIV and propagating uncertainty.")
-        run_piv(before_height, before_uncertainty,
-                after_height, after_uncertainty,
-                geo_transform, template_size, step_size,
-                True, output_base_name)
+        # the bias variance (the spread of vectors from correlating the 'before' DEM
+        # with itself) is computed in the same pass, sharing the template work
+        print("Computing PIV, bias variance and propagating uncertainty.")
+        run_result = run_piv(
+            before_height, before_uncertainty,
+            after_height, after_uncertainty,
+            geo_transform, options, output_base_name, progress_reporter,
+            number_workers, output_format, predictors, checkpoint,
+            window_selection, fft_workers)
+        xy_bias_variance = get_bias_variance(run_result['vector_statistics']['bias_vectors'])
 
         print("Adding bias variance to propagated PIV uncertainty.")
-        add_bias_variance(output_base_name, xy_bias_variance)
+        add_bias_variance(covariance_file, xy_bias_variance)
+        checkpoint.remove()
+        if outlier_filter_size:
+            filter_result_files(vector_file, covariance_file, output_format, geo_transform,
+                                template_size, step_size,
+                                outlier_filter_size, outlier_threshold, outlier_replacement)
+
+        if display:
+            import show_functions
+            show_functions.show(before_height_file,
+                                vector_file,
+                                covariance_file,
+                                1, 1)
+
+
+def compute_piv(before_height, after_height, geo_transform,
+                template_size, step_size,
+                before_uncertainty=None, after_uncertainty=None,
+                progress_reporter=None, jacobian_method='analytic',
+                number_workers=1, pyramid_levels=1, search_radius=3,
+                min_overlap=1.0, window_selection=None, min_peak_ratio=1.0,
+                precision='float64', fft_workers=1, montecarlo_realizations=None,
+                montecarlo_seed=0):
+
+    # Library entry point: PIV on in-memory DEM arrays (NaN marks missing heights)
+    # with a geo transform given as a 3x3 matrix or a rasterio Affine. The arrays
+    # are converted to the precision ('float32' or 'float64') used for the
+    # correlations, whose FFTs use fft_workers threads. Uncertainty is propagated,
+    # and the bias variance added, when both uncertainty arrays are given; with
+    # montecarlo_realizations the propagation is done by Monte Carlo (see
+    # run_piv_tile). Nothing is displayed and, with a single worker, nothing is
+    # read from or written to disk. Returns a result_functions.PivResults object,
+    # whose save and show methods write the usual result files and display them.
+    geo_transform = np.reshape(np.asarray(geo_transform, dtype=float), (3,3))
+    before_height = np.asarray(before_height, dtype=precision)
+    after_height = np.asarray(after_height, dtype=precision)
+    if before_height.ndim != 2 or before_height.shape != after_height.shape:
+        raise ValueError("The 'before' and 'after' DEMs must be 2D arrays of the same shape.")
+
+    if (before_uncertainty is None) != (after_uncertainty is None):
+        raise ValueError("Both or neither of the 'before' and 'after' uncertainties must be given.")
+    propagate = before_uncertainty is not None
+    if propagate:
+        before_uncertainty = np.asarray(before_uncertainty, dtype=precision)
+        after_uncertainty = np.asarray(after_uncertainty, dtype=precision)
+        if before_uncertainty.shape != before_height.shape or after_uncertainty.shape != before_height.shape:
+            raise ValueError("The uncertainties must have the same shape as the DEMs.")
+    else:
+        before_uncertainty = []
+        after_uncertainty = []
 
-        show_functions.show(before_height_file,
-                            output_base_name + 'vectors.json',
-                            output_base_name + 'covariances.json',
-                            1, 1)
+    options = get_piv_options(template_size, step_size, propagate, jacobian_method,
+                              pyramid_levels, search_radius, min_overlap, min_peak_ratio,
+                              precision, montecarlo_realizations, montecarlo_seed)
+    if pyramid_levels > 1:
+        predictors = get_pyramid_predictors(before_height, after_height, options, fft_workers)
+    else:
+        predictors = None
+
+    run_result = run_piv(before_height, before_uncertainty,
+                         after_height, after_uncertainty,
+                         geo_transform, options, None, progress_reporter,
+                         number_workers, predictors=predictors,
+                         window_selection=window_selection, fft_workers=fft_workers)
+    if propagate:
+        add_bias_variance_to_records(run_result['covariance_records'],
+                                     get_bias_variance(run_result['vector_statistics']['bias_vectors']))
+
+    return result_functions.PivResults(run_result['vector_records'],
+                                       run_result['covariance_records'],
+                                       run_result['metrics'],
+                                       {'geo_transform': geo_transform,
+                                        'template_size': template_size,
+                                        'step_size': step_size,
+                                        'shape': get_window_grid_shape(before_height.shape, template_size, step_size)})
+
+
+def get_piv_options(template_size, step_size, propagate=False, jacobian_method='analytic',
+                    pyramid_levels=1, search_radius=None, min_overlap=1.0, min_peak_ratio=1.0,
+                    precision=None, montecarlo_realizations=None, montecarlo_seed=0):
+
+    # The options that change the results of a run, as the one dict that piv,
+    # compute_piv and series_functions.series pass down to every tile, and that
+    # the checkpoint manifest holds. Options that do not apply are None: the
+    # Jacobian method and Monte Carlo options without propagate, the seed without
+    # realizations and, with a single pyramid level, the search radius, which is
+    # that of the full resolution windows around their pyramid predictors (the
+    # search areas extend half the template size around the templates without).
+    return {'template_size': template_size,
+            'step_size': step_size,
+            'propagate': propagate,
+            'jacobian_method': jacobian_method if propagate else None,
+            'pyramid_levels': pyramid_levels,
+            'search_radius': search_radius if pyramid_levels > 1 else None,
+            'min_overlap': min_overlap,
+            'min_peak_ratio': min_peak_ratio,
+            'precision': precision,
+            'montecarlo_realizations': montecarlo_realizations if propagate else None,
+            'montecarlo_seed': montecarlo_seed if propagate and montecarlo_realizations else None}
+
+
+def filter_result_files(vector_file, covariance_file, output_format, geo_transform,
+                        template_size, step_size,
+                        neighbourhood_size, threshold, replacement):
+
+    # normalized median outlier filter over the written results, which are
+    # rewritten in place (see filter_functions)
+    vector_records = np.array(result_functions.read_vectors(vector_file))
+    if covariance_file is None:
+        covariance_records = None
+    else:
+        covariance_records = np.array(result_functions.read_covariances(covariance_file))
+
+    print("Filtering outliers with a {0}x{0} normalized median test.".format(neighbourhood_size))
+    number_vectors = len(vector_records)
+    vector_records, covariance_records, number_outliers = filter_functions.filter_vector_records(
+        vector_records, covariance_records, geo_transform, template_size, step_size,
+        neighbourhood_size, threshold, replacement)
+    number_removed = number_vectors - len(vector_records)
+    print("{} outlier vectors found; {} replaced and {} removed.".format(
+        number_outliers, number_outliers - number_removed, number_removed))
+
+    for file_name, records in ((vector_file, vector_records), (covariance_file, covariance_records)):
+        if file_name is not None:
+            writer = result_functions.open_result_writer(file_name, records.dtype, output_format)
+            writer.write(records)
+            writer.close()
+
+
+def open_piv_checkpoint(checkpoint_directory, input_files, parameters, resume):
+
+    checkpoint = checkpoint_functions.PivCheckpoint(
+        checkpoint_directory,
+        checkpoint_functions.get_checkpoint_manifest(input_files, parameters))
+
+    if os.path.isdir(checkpoint_directory):
+        if not resume:
+            print("A checkpoint of an earlier PIV run exists in '{}'. Use '--resume' to continue that run or delete the directory to start over.".format(checkpoint_directory))
+            sys.exit()
+        if not checkpoint.matches():
+            print("The checkpoint in '{}' was made with different input files, template size, step size or options and cannot be resumed.".format(checkpoint_directory))
+            sys.exit()
+        print("Resuming PIV from checkpoint '{}'.".format(checkpoint_directory))
+    else:
+        if resume:
+            print("No checkpoint found in '{}'. Starting PIV from the beginning.".format(checkpoint_directory))
+        checkpoint.create()
+
+    return checkpoint
 
 
 def get_image_arrays(
@@ -60,171 +288,1344 @@ def get_image_arrays(
     before_uncertainty_file,
     after_height_file,
     after_uncertainty_file,
-    propagate):    
+    propagate, dtype=None):
+
+    geo_transform = get_geo_transform(before_height_file, after_height_file)
 
-    before_height_source = rasterio.open(before_height_file)
-    before_height = before_height_source.read(1)
-    after_height_source = rasterio.open(after_height_file)
-    after_height = after_height_source.read(1)
+    with rasterio.open(before_height_file) as before_height_source:
+        before_height = read_band(before_height_source, dtype=dtype)
+    with rasterio.open(after_height_file) as after_height_source:
+        after_height = read_band(after_height_source, dtype=dtype)
 
     if propagate:
-        before_uncertainty = rasterio.open(before_uncertainty_file).read(1)
-        after_uncertainty = rasterio.open(after_uncertainty_file).read(1)
+        with rasterio.open(before_uncertainty_file) as before_uncertainty_source:
+            before_uncertainty = read_band(before_uncertainty_source, False, dtype)
+        with rasterio.open(after_uncertainty_file) as after_uncertainty_source:
+            after_uncertainty = read_band(after_uncertainty_source, False, dtype)
     else:
         before_uncertainty = []
         after_uncertainty = []
 
+    return before_height, before_uncertainty, after_height, after_uncertainty, geo_transform
+
+
+def read_band(raster_source, nodata_as_nan=True, dtype=None, **read_arguments):
+
+    # first band of an open raster, by default with its nodata pixels set to NaN
+    # so gaps in the DEMs are handled by the masked correlation (uncertainty
+    # rasters are read as they are), optionally converted to dtype
+    if dtype is not None:
+        read_arguments['out_dtype'] = dtype
+    if not nodata_as_nan:
+        return raster_source.read(1, **read_arguments)
+    band = raster_source.read(1, masked=True, **read_arguments)
+    if not np.ma.is_masked(band):
+        return band.data
+    return band.astype(dtype or float).filled(np.nan)
+
+
+def get_geo_transform(before_height_file, after_height_file):
+
     # get raster coordinate transformation for later use
-    before_geo_transform = np.reshape(np.asarray(before_height_source.transform), (3,3))
-    after_geo_transform = np.reshape(np.asarray(after_height_source.transform), (3,3))
+    with rasterio.open(before_height_file) as before_height_source:
+        before_geo_transform = np.reshape(np.asarray(before_height_source.transform), (3,3))
+    with rasterio.open(after_height_file) as after_height_source:
+        after_geo_transform = np.reshape(np.asarray(after_height_source.transform), (3,3))
     if not np.array_equal(before_geo_transform, after_geo_transform):
         print("The extent and/or datum of the 'before' and 'after' DEMs is not equivalent.")
-        sys.exit()    
-
-    return before_height, before_uncertainty, after_height, after_uncertainty, before_geo_transform
+        sys.exit()
+
+    return before_geo_transform
+
+
+def get_raster_shape(raster):
+
+    # rasters are in-memory (or memory mapped) arrays or GeoTIFF file names
+    if isinstance(raster, str):
+        with rasterio.open(raster) as raster_source:
+            return raster_source.height, raster_source.width
+    return raster.shape
+
+
+def get_window_grid_shape(raster_shape, template_size, step_size):
+
+    # number of vertical and horizontal windows; the grid leaves room for a search
+    # area of twice the template size
+    search_size = template_size * 2
+    return (max(0, math.floor((raster_shape[0]-search_size) / step_size)),
+            max(0, math.floor((raster_shape[1]-search_size) / step_size)))
+
+
+def get_window_selection(boundary_mask, template_size, step_size):
+
+    # windows of the window grid whose template center pixel is inside the boundary
+    # mask; the center pixel of an even-sized template is the one below and right
+    # of the template center
+    number_vertical_computations, number_horizontal_computations = get_window_grid_shape(
+        boundary_mask.shape, template_size, step_size)
+    center_offset = math.ceil(template_size/2) + template_size//2
+    return boundary_mask[np.ix_(np.arange(number_vertical_computations)*step_size + center_offset,
+                                np.arange(number_horizontal_computations)*step_size + center_offset)]
+
+
+def read_raster_rows(raster, row_start, row_end, nodata_as_nan=False, dtype=None):
+
+    if len(raster) == 0: # no uncertainty raster
+        return []
+    if isinstance(raster, str):
+        with rasterio.open(raster) as raster_source:
+            return read_band(raster_source, nodata_as_nan, dtype, window=rasterio.windows.Window(0, row_start, raster_source.width, row_end-row_start))
+    if dtype is None:
+        return raster[row_start:row_end]
+    return raster[row_start:row_end].astype(dtype, copy=False)
+
+
+def iterate_raster_strips(raster, row_ranges, nodata_as_nan=False, dtype=None):
+
+    # Yields the raster rows of each (row_start, row_end) range. GeoTIFF rows that
+    # are shared with the previous range are kept instead of being read again, so
+    # consecutive window rows only read the rows that are new to them. Ranges
+    # usually move down the raster, but need not (see get_tile_raster_rows).
+    if len(raster) == 0 or not isinstance(raster, str):
+        for row_start, row_end in row_ranges:
+            yield read_raster_rows(raster, row_start, row_end, nodata_as_nan, dtype)
+        return
+
+    with rasterio.open(raster) as raster_source:
+        strip = np.empty((0, raster_source.width), dtype=dtype or raster_source.dtypes[0])
+        strip_start = 0
+        for row_start, row_end in row_ranges:
+            if row_start < strip_start or row_start >= strip_start + strip.shape[0]:
+                strip = strip[:0]
+                strip_start = row_start
+            else:
+                strip = strip[row_start-strip_start:]
+                strip_start = row_start
+            read_start = strip_start + strip.shape[0]
+            if row_end > read_start:
+                new_rows = read_band(raster_source, nodata_as_nan, dtype, window=rasterio.windows.Window(0, read_start, raster_source.width, row_end-read_start))
+                strip = np.concatenate((strip, new_rows))
+            yield strip[:row_end-strip_start]
+
+
+def get_tile_raster_rows(vt_counts, template_size, step_size, number_rows,
+                         search_radius=None, predictors=None):
+
+    # First and last+1 raster rows touched by the templates and search areas of a
+    # tile of window rows. Without predictors the templates lie inside the search
+    # areas; predicted search areas can move above or below their templates and
+    # are clipped to the raster (windows searching outside it are discarded).
+    if search_radius is None:
+        search_radius = math.ceil(template_size/2)
+    template_offset = math.ceil(template_size/2)
+    row_start = vt_counts[0]*step_size + template_offset - search_radius
+    row_end = vt_counts[-1]*step_size + template_offset + template_size + search_radius
+    if predictors is not None and predictors.size > 0:
+        row_start += min(0, int(predictors[..., 1].min()))
+        row_end += max(0, int(predictors[..., 1].max()))
+
+    return max(0, row_start), min(number_rows, row_end)
+
+
+def get_pyramid_predictors(before_height, after_height, options, fft_workers=1,
+                           verbose=False):
+
+    # Coarse-to-fine displacement estimates for the full resolution window grid.
+    # Pyramid level k holds the DEMs block averaged by 2**k, so the same template
+    # covers 2**k times more ground and finds 2**k times larger displacements. The
+    # coarsest level is searched like a single level run; every finer level only
+    # searches search_radius pixels around the displacement predicted by the level
+    # above it. Returns integer (dx, dy) full resolution pixel predictors for the
+    # window grid of the full resolution DEMs, for the options of
+    # get_piv_options, of which the levels use the correlation ones. Raises a
+    # ValueError when the coarsest level has no windows; with verbose, each
+    # level is announced.
+    template_size = options['template_size']
+    step_size = options['step_size']
+    number_levels = options['pyramid_levels']
+    precision = options['precision']
+    level_vectors = None
+    for level in range(number_levels-1, 0, -1):
+        factor = 2**level
+        if verbose:
+            print("Computing PIV on pyramid level {} (1/{} resolution).".format(level, factor))
+        level_before_height = read_raster_level(before_height, factor).astype(precision or float, copy=False)
+        level_after_height = read_raster_level(after_height, factor).astype(precision or float, copy=False)
+        grid_shape = get_window_grid_shape(level_before_height.shape, template_size, step_size)
+        if level_vectors is None:
+            if grid_shape[0] == 0 or grid_shape[1] == 0:
+                raise ValueError("The DEMs are too small for {} pyramid levels with a template size of {} pixels.".format(number_levels, template_size))
+            level_predictors = None
+            level_search_radius = None
+        else:
+            level_predictors = get_grid_predictors(level_vectors, grid_shape, template_size, step_size)
+            level_search_radius = options['search_radius']
+
+        with scipy.fft.set_workers(fft_workers):
+            tile_result = run_piv_tile(level_before_height, [],
+                                       level_after_height, [],
+                                       0, range(grid_shape[0]), grid_shape[1],
+                                       dict(options, propagate=False, search_radius=level_search_radius),
+                                       level_predictors)
+        level_vectors = get_vector_grid(tile_result, grid_shape, template_size, step_size)
+
+    grid_shape = get_window_grid_shape(get_raster_shape(before_height), template_size, step_size)
+    return get_grid_predictors(level_vectors, grid_shape, template_size, step_size)
+
+
+def read_raster_level(raster, factor):
+
+    # raster averaged over factor x factor pixel blocks; partial blocks at the
+    # right and bottom edges are dropped so level pixels stay aligned. Like the
+    # GDAL average resampling of files, NaN pixels are left out of the average.
+    if isinstance(raster, str):
+        with rasterio.open(raster) as raster_source:
+            number_rows = raster_source.height // factor
+            number_columns = raster_source.width // factor
+            return read_band(raster_source,
+                             window=rasterio.windows.Window(0, 0, number_columns*factor, number_rows*factor),
+                             out_shape=(number_rows, number_columns),
+                             resampling=rasterio.enums.Resampling.average)
+    number_rows = raster.shape[0] // factor
+    number_columns = raster.shape[1] // factor
+    blocks = raster[:number_rows*factor, :number_columns*factor].reshape(number_rows, factor, number_columns, factor)
+    valid = ~np.isnan(blocks)
+    if valid.all():
+        return blocks.mean(axis=(1,3))
+    number_valid = np.count_nonzero(valid, axis=(1,3))
+    block_sums = np.sum(np.where(valid, blocks, 0), axis=(1,3))
+    return np.where(number_valid > 0, block_sums / np.maximum(number_valid, 1), np.nan)
+
+
+def get_vector_grid(tile_result, grid_shape, template_size, step_size):
+
+    # places the vectors of a run_piv_tile result on the window grid; windows
+    # without a vector are NaN
+    vector_grid = np.full(grid_shape + (2,), np.nan)
+    grid_indices = np.rint((tile_result['origins'] - template_size + (1 - template_size % 2)*0.5) / step_size).astype(int)
+    vector_grid[grid_indices[:,1], grid_indices[:,0]] = tile_result['vectors']
+
+    return vector_grid
+
+
+def get_grid_predictors(coarse_vectors, grid_shape, template_size, step_size):
+
+    # Integer pixel predictors for a window grid from the vectors of the window
+    # grid one pyramid level coarser (half the resolution, same template and step
+    # sizes). Missing coarse vectors take the value of the nearest vector and a
+    # 3x3 median removes isolated outliers before the field is bilinearly
+    # interpolated at the window centers.
+    import scipy.ndimage
+
+    missing = np.isnan(coarse_vectors[..., 0])
+    if missing.all():
+        return np.zeros(grid_shape + (2,), dtype=int)
+    if missing.any():
+        nearest = scipy.ndimage.distance_transform_edt(missing, return_distances=False, return_indices=True)
+        coarse_vectors = coarse_vectors[nearest[0], nearest[1]]
+
+    # window centers in this level's pixels, then in the coarse level's pixels and
+    # finally as fractional coarse grid indices
+    center_offset = template_size - (1 - template_size % 2)*0.5
+    grid_rows, grid_columns = np.meshgrid(np.arange(grid_shape[0]), np.arange(grid_shape[1]), indexing='ij')
+    coarse_grid_rows = ((grid_rows*step_size + center_offset + 0.5)/2 - 0.5 - center_offset) / step_size
+    coarse_grid_columns = ((grid_columns*step_size + center_offset + 0.5)/2 - 0.5 - center_offset) / step_size
+
+    predictors = np.empty(grid_shape + (2,), dtype=int)
+    for component in range(2):
+        coarse_component = scipy.ndimage.median_filter(coarse_vectors[..., component], size=3, mode='nearest')
+        predictors[..., component] = np.rint(2*scipy.ndimage.map_coordinates(
+            coarse_component, [coarse_grid_rows, coarse_grid_columns], order=1, mode='nearest'))
+
+    return predictors
 
 
 def run_piv(before_height, before_uncertainty,
             after_height, after_uncertainty,
-            geo_transform, template_size,
-            step_size, propagate, output_base_name):
-    
-    piv_origins = []
-    piv_vectors = []
+            geo_transform, options, output_base_name,
+            progress_reporter=None, number_workers=1, output_format='npy',
+            predictors=None, checkpoint=None, window_selection=None,
+            fft_workers=1):
+
+    # Runs PIV with the options of get_piv_options, which every tile gets as they
+    # are (see run_piv_tile). Vectors (and covariances) are written to file as
+    # each tile completes. When output_base_name is None no files are written and
+    # the records are kept in memory instead. Returns a dict of the running
+    # statistics of the vectors (and, with propagate, of the bias pass vectors,
+    # see get_bias_variance), the in-memory vector and covariance records (None
+    # when written to file) and the run metrics.
+    # predictors are optional integer (dx, dy) pixel displacements for every
+    # window of the grid, shape (vertical, horizontal, 2); see run_piv_tile.
+    # With a checkpoint, every computed tile is saved to it and tiles saved by an
+    # earlier run are read back instead of being computed again. Stage timings and
+    # skipped window counts are written to a metrics file next to the outputs.
+    # window_selection, if given, is a boolean mask over the window grid of the
+    # windows to compute (see get_window_selection); the others are skipped
+    # without reading or correlating their pixels. The raster strips are converted
+    # to the precision option ('float32' or 'float64', if given), which the
+    # correlations and propagation carry through; the FFTs use fft_workers
+    # threads per process.
+    if progress_reporter is None:
+        progress_reporter = progress_functions.NullProgressReporter()
+    run_start = time.perf_counter()
+    metrics = metrics_functions.new_metrics()
+    template_size = options['template_size']
+    step_size = options['step_size']
+    propagate = options['propagate']
+    search_radius = options['search_radius']
+
+    if output_base_name is None:
+        output_format = 'memory'
+        vector_file = covariance_file = None
+    else:
+        vector_file = result_functions.get_result_file_name(output_base_name, 'vectors', output_format)
+        covariance_file = result_functions.get_result_file_name(output_base_name, 'covariances', output_format)
+    vector_writer = result_functions.open_result_writer(vector_file, result_functions.vector_dtype, output_format)
+    if propagate:
+        covariance_writer = result_functions.open_result_writer(covariance_file, result_functions.covariance_dtype, output_format)
+    vector_statistics = {'vectors': {'count': 0, 'mean': np.zeros(2), 'm2': np.zeros(2)}}
     if propagate:
-        peak_covariance = []
-        numeric_partial_derivative_increment = 0.000001
-
-    status_figure = plt.figure()
-    before_axis = plt.subplot(1, 2, 1)
-    after_axis = plt.subplot(1, 2, 2)
-
-    search_size = template_size * 2 # size of area to be searched for match in 'after' image
-    number_horizontal_computations = math.floor((before_height.shape[1]-search_size) / step_size)
-    number_vertical_computations = math.floor((before_height.shape[0]-search_size) / step_size)
-
-    for vt_count in range(number_vertical_computations):
-        for hz_count in range(number_horizontal_computations):
-
-            hz_template_start = int(hz_count*step_size + math.ceil(template_size/2))
-            hz_template_end = int(hz_count*step_size + math.ceil(template_size/2) + template_size)
-            vt_template_start = int(vt_count*step_size + math.ceil(template_size/2))
-            vt_template_end = int(vt_count*step_size + math.ceil(template_size/2) + template_size)
-            height_template = before_height[vt_template_start:vt_template_end, hz_template_start:hz_template_end].copy()
-            
-            hz_search_start = int(hz_count*step_size)
-            hz_search_end = int(hz_count*step_size + search_size + (template_size % 2)) # the modulo addition forces the search area to be symmetric around odd-sized templates
-            vt_search_start = int(vt_count*step_size)
-            vt_search_end = int(vt_count*step_size + search_size + (template_size % 2)) 
-            height_search = after_height[vt_search_start:vt_search_end, hz_search_start:hz_search_end].copy()            
-
-            show_piv_location(before_height, after_height,
-                              before_axis, after_axis,
-                              hz_template_start, vt_template_start,
-                              hz_search_start, vt_search_start,
-                              template_size, search_size)     
-
-            # guard against flat areas, which produce a divide by zero in the correlation
-            # guard agains NaN values, which breaks scipy's match_template function
-            if (np.max(height_template)-np.min(height_template) < 1e-10 or
-                    np.max(height_search)-np.min(height_search) < 1e-10 or
-                    np.isnan(height_template).any() or
-                    np.isnan(height_search).any()):
-                continue
-
-            normalized_cross_correlation = match_template(height_search, height_template) # uses FFT based correlation
-            correlation_max_idx = np.where(normalized_cross_correlation == np.max(normalized_cross_correlation))
-
-            # peak location on edges of correlation matrix breaks sub-pixel peak interpolation
-            if (correlation_max_idx[0][0]==0 or
-                    correlation_max_idx[1][0]==0 or 
-                    correlation_max_idx[0][0]==normalized_cross_correlation.shape[0]-1 or 
-                    correlation_max_idx[1][0]==normalized_cross_correlation.shape[1]-1): 
-                continue
-
-            subpixel_peak = get_subpixel_peak(normalized_cross_correlation[
-                correlation_max_idx[0][0]-1:correlation_max_idx[0][0]+2,
-                correlation_max_idx[1][0]-1:correlation_max_idx[1][0]+2])
-            
-            piv_origins.append(((hz_count*step_size + template_size - (1 - template_size % 2)*0.5), # modulo operator adjusts even-sized template origins to be between pixel centers
-                                (vt_count*step_size + template_size - (1 - template_size % 2)*0.5)))
-            piv_vectors.append(((correlation_max_idx[1][0] - math.ceil(template_size/2) + subpixel_peak[0]),
-                                (correlation_max_idx[0][0] - math.ceil(template_size/2) + subpixel_peak[1])))
+        vector_statistics['bias_vectors'] = {'count': 0, 'mean': np.zeros(2), 'm2': np.zeros(2)}
 
+    number_rows, number_columns = get_raster_shape(before_height)
+    number_vertical_computations, number_horizontal_computations = get_window_grid_shape(
+        (number_rows, number_columns), template_size, step_size)
+    if search_radius is None:
+        search_size = template_size * 2 # size of area to be searched for match in 'after' image
+    else:
+        search_size = template_size + 2*search_radius
+
+    if window_selection is None:
+        window_selection = np.ones((number_vertical_computations, number_horizontal_computations), dtype=bool)
+    metrics_functions.add_skipped(metrics, 'outside_boundary', np.count_nonzero(~window_selection))
+    # number of selected windows up to and including each window row, for progress
+    selected_windows = np.cumsum(np.count_nonzero(window_selection, axis=1))
+
+    progress_reporter.start(int(selected_windows[-1]) if selected_windows.size else 0,
+                            before_height, after_height,
+                            template_size, search_size)
+
+    # a few window rows per tile, so the raster strip statistics of a tile (see
+    # get_strip_statistics) are shared by several rows while the strip stays a
+    # small multiple of the search size when the rasters are read from file. The
+    # statistics depend on the strip, so the pool gets the same tiles as a serial
+    # run, which keeps its output identical to the serial one.
+    rows_per_tile = 4 * math.ceil(search_size / step_size)
+    if checkpoint is None:
+        completed_tiles = []
+    else:
+        completed_tiles = checkpoint.get_completed_tiles()
+    tiles = get_tiles(number_vertical_computations, rows_per_tile, completed_tiles,
+                      window_selection.any(axis=1))
+    computed_tiles = [vt_counts for vt_counts in tiles if vt_counts not in completed_tiles]
+
+    if number_workers > 1:
+        computed_tile_results = run_piv_tiles_in_pool(
+            before_height, before_uncertainty,
+            after_height, after_uncertainty,
+            computed_tiles, number_horizontal_computations,
+            options, number_workers, predictors, window_selection, fft_workers)
+    else:
+        tile_predictors = [get_tile_predictors(predictors, vt_counts) for vt_counts in computed_tiles]
+        tile_selections = [get_tile_predictors(window_selection, vt_counts) for vt_counts in computed_tiles]
+        row_ranges = [get_tile_raster_rows(vt_counts, template_size, step_size, number_rows,
+                                           search_radius, vt_predictors)
+                      for vt_counts, vt_predictors in zip(computed_tiles, tile_predictors)]
+        precision = options['precision']
+        raster_strips = zip(iterate_raster_strips(before_height, row_ranges, True, precision),
+                            iterate_raster_strips(before_uncertainty, row_ranges, False, precision),
+                            iterate_raster_strips(after_height, row_ranges, True, precision),
+                            iterate_raster_strips(after_uncertainty, row_ranges, False, precision))
+        computed_tile_results = (run_piv_tile(
+            *strips, row_range[0], vt_counts, number_horizontal_computations,
+            options, vt_predictors, vt_selection)
+            for strips, row_range, vt_counts, vt_predictors, vt_selection in zip(
+                raster_strips, row_ranges, computed_tiles, tile_predictors, tile_selections))
+
+    # tiles arrive in window grid order, so the written output matches the serial one;
+    # 'tiles' is the time spent waiting for tile results (reading the rasters and
+    # computing, or waiting for the workers) and 'write' the time spent after that
+    run_metrics = metrics_functions.new_metrics()
+    stage_start = time.perf_counter()
+    # the serial tiles are computed as they are consumed by this loop
+    with scipy.fft.set_workers(fft_workers):
+        for tile_result in get_tile_results(tiles, completed_tiles, computed_tile_results, checkpoint):
+            stage_start = metrics_functions.add_stage_time(run_metrics, 'tiles', stage_start)
+            metrics_functions.merge_metrics(metrics, tile_result['metrics'])
+            vector_records = result_functions.get_vector_records(
+                tile_result['origins'], tile_result['vectors'], geo_transform,
+                tile_result['peak_heights'], tile_result['peak_ratios'])
+            update_vector_statistics(vector_statistics['vectors'], tile_result['vectors']*geo_transform[0,0])
+            vector_writer.write(vector_records)
             if propagate:
-                uncertainty_template = before_uncertainty[vt_template_start:vt_template_end, hz_template_start:hz_template_end].copy()
-                uncertainty_search = after_uncertainty[vt_search_start:vt_search_end, hz_search_start:hz_search_end].copy()    
-
-                # propagate raster error into the 3x3 patch of correlation values that are centered on the correlation peak
-                correlation_covariance = propagate_pixel_into_correlation(
-                    height_template,
-                    uncertainty_template, 
-                    height_search[correlation_max_idx[0][0]-1:correlation_max_idx[0][0]+template_size+1, correlation_max_idx[1][0]-1:correlation_max_idx[1][0]+template_size+1], # templateSize+2 x templateSize+2 subarray of the search array,
-                    uncertainty_search[correlation_max_idx[0][0]-1:correlation_max_idx[0][0]+template_size+1, correlation_max_idx[1][0]-1:correlation_max_idx[1][0]+template_size+1], # templateSize+2 x templateSize+2 subarray of the search error array
-                    normalized_cross_correlation[correlation_max_idx[0][0]-1:correlation_max_idx[0][0]+2, correlation_max_idx[1][0]-1:correlation_max_idx[1][0]+2], # 3x3 array of correlation values centered on the correlation peak
-                    numeric_partial_derivative_increment) 
-
-                # propagate the correlation covariance into the subpixel peak location
-                subpixel_peak_covariance = propagate_correlation_into_subpixel_peak(
-                    normalized_cross_correlation[correlation_max_idx[0][0]-1:correlation_max_idx[0][0]+2, correlation_max_idx[1][0]-1:correlation_max_idx[1][0]+2],
-                    correlation_covariance,
-                    subpixel_peak,
-                    numeric_partial_derivative_increment)
-                
-                peak_covariance.append(subpixel_peak_covariance.tolist())   
-
-    plt.close(status_figure)
-
-    export_piv(piv_origins, piv_vectors,
-               geo_transform, output_base_name)
+                update_vector_statistics(vector_statistics['bias_vectors'], tile_result['bias_vectors']*geo_transform[0,0])
+                covariance_writer.write(result_functions.get_covariance_records(
+                    tile_result['origins'], tile_result['vectors'],
+                    tile_result['covariances'], geo_transform))
+            last_vt_count = tile_result['last_vt_count']
+            progress_reporter.update(int(selected_windows[last_vt_count]),
+                                     (int((number_horizontal_computations-1)*step_size + math.ceil(template_size/2)), int(last_vt_count*step_size + math.ceil(template_size/2))),
+                                     (int((number_horizontal_computations-1)*step_size), int(last_vt_count*step_size)))
+            stage_start = metrics_functions.add_stage_time(run_metrics, 'write', stage_start)
+
+    progress_reporter.finish()
+
+    vector_writer.close()
+    if propagate:
+        covariance_writer.close()
+    # the tile stage seconds are summed over all workers, the run seconds are wall clock
+    piv_metrics = {
+        'template_size': template_size,
+        'step_size': step_size,
+        'workers': number_workers,
+        'windows': number_horizontal_computations * number_vertical_computations,
+        'vectors': int(vector_statistics['vectors']['count']),
+        'skipped': metrics['skipped'],
+        'tile_stage_seconds': metrics['seconds'],
+        'run_seconds': dict(run_metrics['seconds'], total=time.perf_counter() - run_start),
+        'resumed_tiles': len(completed_tiles)}
+
+    if output_base_name is None:
+        return {'vector_statistics': vector_statistics,
+                'vector_records': vector_writer.records,
+                'covariance_records': covariance_writer.records if propagate else None,
+                'metrics': piv_metrics}
+
+    print("PIV displacement vectors saved to file '{}'".format(vector_file))
+    if propagate:
+        print("PIV covariance matrices saved to file '{}'".format(covariance_file))
+    metrics_file = output_base_name + 'metrics.json'
+    metrics_functions.write_metrics(metrics_file, piv_metrics)
+    print("PIV metrics saved to file '{}'".format(metrics_file))
+
+    return {'vector_statistics': vector_statistics,
+            'vector_records': None,
+            'covariance_records': None,
+            'metrics': piv_metrics}
+
+
+def run_piv_tile(before_height, before_uncertainty,
+                 after_height, after_uncertainty,
+                 strip_row_start, vt_counts, number_horizontal_computations,
+                 options, predictors=None, window_selection=None, epoch_caches=None):
+
+    # Computes the vectors (and covariances) for a tile of consecutive rows of the
+    # window grid with the options of get_piv_options. Tiles are independent of
+    # each other, so they can be computed in any order or in separate processes.
+    # The rasters only need to hold the strip of raster rows used by the tile (see
+    # get_tile_raster_rows), starting at raster row strip_row_start. With
+    # propagate, every template is also correlated against its own 'before' search
+    # area (the bias variance pass, see get_bias_searches), reusing the template
+    # statistics and spectra of the main correlation.
+    # The search areas extend search_radius pixels (by default half the template
+    # size) around the template. predictors, if given, hold an integer (dx, dy)
+    # pixel displacement for each window of the tile, shape (len(vt_counts),
+    # number_horizontal_computations, 2), that moves its 'after' search area.
+    # Windows with NaN pixels are correlated over their valid pixels (see
+    # correlate_masked_window_stacks) if at least min_overlap of the template
+    # pixels are valid. window_selection, if given, masks the windows of the tile
+    # rows to compute, shape (len(vt_counts), number_horizontal_computations).
+    # Every vector carries the height of its correlation peak and the ratio of
+    # that to the second highest peak (see get_peak_ratios); vectors with a peak
+    # ratio below min_peak_ratio are rejected before any uncertainty propagation.
+    # epoch_caches, if given, is a pair of dicts for the 'before' and 'after' DEM
+    # strips that hold their strip statistics and, per window row, the template
+    # spectra and bias pass vectors of the 'before' strip and, without
+    # predictors, the spectra of the search areas of the strips whose cache has
+    # 'share_search_spectra' set. Time series runs (see series_functions) share
+    # them between all the pairs of a DEM, so its work is not repeated for every
+    # pair it appears in.
+    # The covariances are propagated linearly (see propagate_linear_uncertainty)
+    # or, with montecarlo_realizations, by Monte Carlo (see
+    # propagate_montecarlo_uncertainty), with the noise of each window row drawn
+    # from a generator seeded by montecarlo_seed and the row, so the covariances
+    # do not depend on how the rows are split into tiles or processes.
+    # The tile result includes the time spent in each stage and
+    # the number of windows skipped for each reason (see metrics_functions).
+    metrics = metrics_functions.new_metrics()
+    stage_start = time.perf_counter()
+    piv_origins = [np.empty((0,2))]
+    piv_vectors = [np.empty((0,2))]
+    piv_peak_heights = [np.empty(0)]
+    piv_peak_ratios = [np.empty(0)]
+    peak_covariance = [np.empty((0,2,2))]
+    bias_vectors = [np.empty((0,2))]
+    template_size = options['template_size']
+    step_size = options['step_size']
+    propagate = options['propagate']
+    min_overlap = options['min_overlap']
+    template_offset = math.ceil(template_size/2) # template start relative to the window start
+    search_radius = options['search_radius']
+    if search_radius is None:
+        search_radius = template_offset
+    search_size = template_size + 2*search_radius
+    min_valid_pixels = min_overlap * template_size * template_size
+    # without a partial overlap, search areas with gaps are skipped as before: their
+    # correlation peak may lie at a position the gap makes invalid
+    if min_overlap < 1:
+        min_valid_search_pixels = min_valid_pixels
+    else:
+        min_valid_search_pixels = search_size * search_size
 
+    if epoch_caches is None:
+        before_cache, after_cache = {}, {}
+    else:
+        before_cache, after_cache = epoch_caches
+    before_row_cache = before_cache.setdefault('rows', {})
+    after_row_cache = after_cache.setdefault('rows', {})
+    # predictors move the search areas differently for every pair
+    cache_before_searches = predictors is None and before_cache.get('share_search_spectra', False)
+    cache_after_searches = predictors is None and after_cache.get('share_search_spectra', False)
+
+    # summed-area tables and window sums of the strips, shared by all rows of the tile
+    before_statistics = get_cached_strip_statistics(before_cache, before_height, template_size)
+    after_statistics = get_cached_strip_statistics(after_cache, after_height, template_size)
+    stage_start = metrics_functions.add_stage_time(metrics, 'statistics', stage_start)
+
+    # all windows in a row of the window grid are correlated together as one batch
+    for tile_row, vt_count in enumerate(vt_counts):
+        if window_selection is None:
+            hz_counts = np.arange(number_horizontal_computations)
+        else:
+            hz_counts = np.flatnonzero(window_selection[tile_row])
+        if hz_counts.size == 0:
+            continue
+        vt_template_start = vt_count*step_size + template_offset - strip_row_start
+        hz_template_starts = hz_counts*step_size + template_offset
+        if predictors is None:
+            search_shifts = np.zeros((hz_counts.size, 2), dtype=int)
+        else:
+            search_shifts = predictors[tile_row, hz_counts]
+        vt_template_starts = np.full(hz_counts.size, vt_template_start)
+        vt_search_starts = vt_template_start - search_radius + search_shifts[:,1]
+        hz_search_starts = hz_template_starts - search_radius + search_shifts[:,0]
+
+        # guard against flat areas, which produce a divide by zero in the correlation
+        # guard against windows with too few valid pixels to correlate; windows with
+        # some NaN values use the masked correlation
+        # guard against predicted search areas that leave the raster
+        template_flat, template_nan = get_flat_and_nan_windows(before_statistics, vt_template_starts, hz_template_starts, template_size, min_valid_pixels)
+        template_means, template_ssd = get_window_statistics(before_statistics, vt_template_starts, hz_template_starts, template_size)
+        template_flat |= ~template_nan & ~(template_ssd > 0) # nearly flat templates, lost to rounding
+        template_usable = ~(template_flat | template_nan)
+        template_gappy = get_table_window_sums(before_statistics['nan_counts'], vt_template_starts, hz_template_starts, template_size, template_size) > 0
+        inside = get_windows_inside(after_height.shape, vt_search_starts, hz_search_starts, search_size)
+        usable = template_usable & inside
+        search_flat, search_nan = get_flat_and_nan_windows(after_statistics, vt_search_starts[usable], hz_search_starts[usable], search_size, min_valid_search_pixels)
+        search_usable = ~(search_flat | search_nan)
+        usable[usable] = search_usable
+        gappy = template_gappy[usable] | (get_table_window_sums(after_statistics['nan_counts'], vt_search_starts[usable], hz_search_starts[usable], search_size, search_size) > 0)
+        metrics_functions.add_skipped(metrics, 'template_flat', np.count_nonzero(template_flat))
+        metrics_functions.add_skipped(metrics, 'template_nan', np.count_nonzero(template_nan))
+        metrics_functions.add_skipped(metrics, 'search_outside', np.count_nonzero(template_usable & ~inside))
+        metrics_functions.add_skipped(metrics, 'search_flat', np.count_nonzero(search_flat))
+        metrics_functions.add_skipped(metrics, 'search_nan', np.count_nonzero(search_nan))
+        stage_start = metrics_functions.add_stage_time(metrics, 'guard', stage_start)
+        height_templates = get_template_row_stack(before_height, vt_template_start, hz_template_starts, template_size)
+        height_searches = get_search_stack(after_height, vt_search_starts[usable], hz_search_starts[usable], search_size)
+        stage_start = metrics_functions.add_stage_time(metrics, 'extract', stage_start)
+        # the bias pass only depends on the 'before' strip, so a cached row is reused
+        row_cache = before_row_cache.setdefault(vt_count, {})
+        compute_bias = propagate and 'bias_vectors' not in row_cache
+        if propagate and not compute_bias:
+            bias_vectors.append(row_cache['bias_vectors'])
+        if compute_bias:
+            row_cache['bias_vectors'] = np.empty((0,2))
+            bias_usable, bias_gappy, bias_searches = get_bias_searches(
+                before_height, before_statistics, vt_template_starts, hz_template_starts,
+                template_usable, template_gappy, search_radius, search_size, min_valid_search_pixels)
+            correlated = usable | bias_usable
+            stage_start = metrics_functions.add_stage_time(metrics, 'bias', stage_start)
+        else:
+            correlated = usable
+        if not correlated.any():
+            continue
+
+        # template statistics and spectra are computed once for both correlations
+        if epoch_caches is None:
+            template_spectra = get_template_spectra(
+                select_windows(height_templates, correlated),
+                select_windows(template_means, correlated),
+                (search_size, search_size))
+        else:
+            template_spectra = get_cached_template_spectra(
+                row_cache, height_templates, template_means, correlated, search_size)
+        correlated_template_ssd = select_windows(template_ssd, correlated)
+        stage_start = metrics_functions.add_stage_time(metrics, 'correlate', stage_start)
+
+        if compute_bias and bias_usable.any():
+            row_cache['bias_vectors'] = get_bias_vectors(
+                before_statistics, row_cache, bias_usable, bias_gappy, bias_searches,
+                select_windows(height_templates, bias_usable),
+                select_windows(template_spectra, bias_usable[correlated]),
+                select_windows(correlated_template_ssd, bias_usable[correlated]),
+                vt_template_starts[bias_usable] - search_radius,
+                hz_template_starts[bias_usable] - search_radius,
+                search_radius, min_overlap, cache_before_searches)
+            bias_vectors.append(row_cache['bias_vectors'])
+            stage_start = metrics_functions.add_stage_time(metrics, 'bias', stage_start)
+
+        if not usable.any():
+            continue
+        hz_counts = hz_counts[usable]
+        search_shifts = search_shifts[usable]
+        vt_search_starts = vt_search_starts[usable]
+        hz_search_starts = hz_search_starts[usable]
+        height_templates = select_windows(height_templates, usable)
+        template_means = select_windows(template_means, usable)
+        template_ssd = select_windows(template_ssd, usable)
+
+        search_window_sums, search_window_sums2 = get_search_window_sums(
+            after_statistics, vt_search_starts, hz_search_starts,
+            template_size, search_size)
+        if cache_after_searches and not gappy.all():
+            search_complete = usable.copy()
+            search_complete[usable] = ~gappy
+            search_spectra = get_cached_search_spectra(
+                after_row_cache.setdefault(vt_count, {}),
+                select_windows(height_searches, ~gappy), search_complete)
+        else:
+            search_spectra = None
+
+        normalized_cross_correlations = correlate_windows(
+            height_searches,
+            height_templates,
+            select_windows(template_spectra, usable[correlated]),
+            select_windows(correlated_template_ssd, usable[correlated]),
+            search_window_sums, search_window_sums2,
+            gappy, min_overlap, search_spectra) # uses FFT based correlation
+        stage_start = metrics_functions.add_stage_time(metrics, 'correlate', stage_start)
+        interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks = locate_correlation_peaks(normalized_cross_correlations)
+        metrics_functions.add_skipped(metrics, 'edge_peak', np.count_nonzero(~interior))
+        peak_ratios = get_peak_ratios(select_windows(normalized_cross_correlations, interior), peak_rows, peak_columns)
+        strong = peak_ratios >= options['min_peak_ratio']
+        metrics_functions.add_skipped(metrics, 'weak_peak', np.count_nonzero(~strong))
+        accepted = interior.copy()
+        accepted[interior] = strong
+        peak_rows = peak_rows[strong]
+        peak_columns = peak_columns[strong]
+        peak_correlations = select_windows(peak_correlations, strong)
+        subpixel_peaks = [subpixel_peak[strong] for subpixel_peak in subpixel_peaks]
+        peak_ratios = peak_ratios[strong]
+        hz_counts = hz_counts[accepted]
+        search_shifts = search_shifts[accepted]
+        vt_search_starts = vt_search_starts[accepted]
+        hz_search_starts = hz_search_starts[accepted]
+        height_templates = select_windows(height_templates, accepted)
+        template_means = select_windows(template_means, accepted)
+        template_ssd = select_windows(template_ssd, accepted)
+
+        piv_origins.append(np.column_stack((
+            hz_counts*step_size + template_size - (1 - template_size % 2)*0.5, # modulo operator adjusts even-sized template origins to be between pixel centers
+            np.full(hz_counts.shape, vt_count*step_size + template_size - (1 - template_size % 2)*0.5))))
+        piv_vectors.append(np.column_stack((
+            peak_columns - search_radius + search_shifts[:,0] + subpixel_peaks[0],
+            peak_rows - search_radius + search_shifts[:,1] + subpixel_peaks[1])))
+        piv_peak_heights.append(peak_correlations[:,1,1])
+        piv_peak_ratios.append(peak_ratios)
+        stage_start = metrics_functions.add_stage_time(metrics, 'peaks', stage_start)
+
+        if not propagate:
+            continue
+        uncertainty_templates = get_template_row_stack(before_uncertainty, vt_template_start, hz_counts*step_size + template_offset, template_size)
+        if options['montecarlo_realizations']:
+            peak_covariance.append(propagate_montecarlo_uncertainty(
+                after_height, after_uncertainty,
+                height_templates, uncertainty_templates,
+                vt_search_starts, hz_search_starts, peak_rows, peak_columns,
+                search_radius, min_overlap, options['montecarlo_realizations'],
+                np.random.default_rng([options['montecarlo_seed'], vt_count])))
+        else:
+            peak_covariance.append(propagate_linear_uncertainty(
+                after_height, after_uncertainty, after_statistics,
+                height_templates, uncertainty_templates, template_means, template_ssd,
+                vt_search_starts + peak_rows, hz_search_starts + peak_columns,
+                peak_correlations, options['jacobian_method']))
+        stage_start = metrics_functions.add_stage_time(metrics, 'propagate', stage_start)
+
+    tile_result = {'origins': np.concatenate(piv_origins),
+                   'vectors': np.concatenate(piv_vectors),
+                   'peak_heights': np.concatenate(piv_peak_heights),
+                   'peak_ratios': np.concatenate(piv_peak_ratios),
+                   'last_vt_count': vt_counts[-1],
+                   'metrics': metrics}
     if propagate:
-        export_uncertainty(piv_origins, piv_vectors,
-                           peak_covariance, geo_transform, 
-                           output_base_name)
-
-
-def show_piv_location(
-    before_height, after_height,
-    before_axis, after_axis,
-    hz_template_start, vt_template_start,
-    hz_search_start, vt_search_start,
-    template_size, search_size):
-
-    plt.sca(before_axis)
-    plt.cla()
-    before_axis.set_title('Before')
-    before_axis.imshow(before_height, cmap=plt.cm.gray)
-    before_axis.add_patch(matplotlib.patches.Rectangle(
-        (hz_template_start, vt_template_start), 
-        template_size-1, 
-        template_size-1, 
-        linewidth=1, 
-        edgecolor='r',
-        fill=None))
-    
-    plt.sca(after_axis)
-    plt.cla()
-    after_axis.set_title('After')            
-    after_axis.imshow(after_height, cmap=plt.cm.gray)            
-    after_axis.add_patch(matplotlib.patches.Rectangle(
-        (hz_search_start,vt_search_start), 
-        search_size-1, 
-        search_size-1, 
-        linewidth=1, 
-        edgecolor='r',
-        fill=None))
+        tile_result['covariances'] = np.concatenate(peak_covariance)
+        tile_result['bias_vectors'] = np.concatenate(bias_vectors)
+
+    return tile_result
+
+
+def get_bias_searches(before_height, before_statistics, vt_template_starts, hz_template_starts,
+                      template_usable, template_gappy, search_radius, search_size,
+                      min_valid_search_pixels):
+
+    # The bias pass correlates every usable template of a window row with the
+    # search area around it in the 'before' DEM; the predictors do not move these
+    # bias searches. Returns the windows whose bias search is usable, whether
+    # their template or bias search has NaN pixels and the stack of their searches.
+    bias_usable = template_usable.copy()
+    vt_search_starts = vt_template_starts[bias_usable] - search_radius
+    hz_search_starts = hz_template_starts[bias_usable] - search_radius
+    search_flat, search_nan = get_flat_and_nan_windows(before_statistics, vt_search_starts, hz_search_starts,
+                                                       search_size, min_valid_search_pixels)
+    search_usable = ~(search_flat | search_nan)
+    bias_usable[bias_usable] = search_usable
+    vt_search_starts = vt_search_starts[search_usable]
+    hz_search_starts = hz_search_starts[search_usable]
+    bias_gappy = template_gappy[bias_usable] | (get_table_window_sums(before_statistics['nan_counts'],
+                                                                      vt_search_starts, hz_search_starts,
+                                                                      search_size, search_size) > 0)
+    bias_searches = get_search_stack(before_height, vt_search_starts, hz_search_starts, search_size)
+
+    return bias_usable, bias_gappy, bias_searches
+
+
+def get_bias_vectors(before_statistics, row_cache, bias_usable, bias_gappy, bias_searches,
+                     height_templates, template_spectra, template_ssd,
+                     vt_search_starts, hz_search_starts, search_radius, min_overlap,
+                     cache_search_spectra):
+
+    # Bias pass vectors of the windows of a row with a usable bias search (see
+    # get_bias_searches), from the template spectra and sums of squared
+    # deviations of the main correlation. The bias searches are the search areas
+    # of the 'before' DEM in the pairs it is the 'after' DEM of, so with
+    # cache_search_spectra their spectra are shared through row_cache.
+    template_size = height_templates.shape[1]
+    search_size = bias_searches.shape[1]
+    bias_window_sums, bias_window_sums2 = get_search_window_sums(
+        before_statistics, vt_search_starts, hz_search_starts,
+        template_size, search_size)
+    if cache_search_spectra and not bias_gappy.all():
+        bias_complete = bias_usable.copy()
+        bias_complete[bias_usable] = ~bias_gappy
+        bias_search_spectra = get_cached_search_spectra(
+            row_cache, select_windows(bias_searches, ~bias_gappy), bias_complete)
+    else:
+        bias_search_spectra = None
+    bias_correlations = correlate_windows(
+        bias_searches, height_templates, template_spectra, template_ssd,
+        bias_window_sums, bias_window_sums2,
+        bias_gappy, min_overlap, bias_search_spectra)
+    interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks = locate_correlation_peaks(bias_correlations)
+
+    return np.column_stack((peak_columns - search_radius + subpixel_peaks[0],
+                            peak_rows - search_radius + subpixel_peaks[1]))
+
+
+def get_cached_template_spectra(row_cache, height_templates, template_means, correlated, search_size):
+
+    # the spectra of a row's templates are shared by every pair with the same
+    # 'before' DEM; each pair only computes those no earlier pair needed
+    spectra_computed = row_cache.setdefault('spectra_computed', np.zeros(correlated.shape, dtype=bool))
+    missing = correlated & ~spectra_computed
+    if missing.any():
+        missing_spectra = get_template_spectra(
+            select_windows(height_templates, missing),
+            select_windows(template_means, missing),
+            (search_size, search_size))
+        if missing.all():
+            row_cache['template_spectra'] = missing_spectra
+        else:
+            if 'template_spectra' not in row_cache:
+                row_cache['template_spectra'] = np.empty((correlated.size,) + missing_spectra.shape[1:], dtype=missing_spectra.dtype)
+            row_cache['template_spectra'][missing] = missing_spectra
+        spectra_computed |= missing
+
+    return select_windows(row_cache['template_spectra'], correlated)
+
+
+def propagate_linear_uncertainty(after_height, after_uncertainty, after_statistics,
+                                 height_templates, uncertainty_templates,
+                                 template_means, template_ssd,
+                                 vt_peak_starts, hz_peak_starts,
+                                 peak_correlations, jacobian_method):
+
+    # Linearized propagation of the raster uncertainty into the covariances of the
+    # subpixel peaks of a window row. The peak starts are the raster positions of
+    # the template sized search subareas at the correlation peaks.
+    numeric_partial_derivative_increment = 0.000001
+    template_size = height_templates.shape[1]
+    template_volume = template_size * template_size
+
+    # the templates and the (template size + 2) square search subareas that
+    # produce the 3x3 patches of correlation values centered on the peaks
+    vt_patch_starts = vt_peak_starts - 1
+    hz_patch_starts = hz_peak_starts - 1
+
+    # means and sums of squared deviations of the 3x3 template-sized search
+    # subareas of each patch
+    patch_offsets = np.arange(3)
+    subarea_means, subarea_ssd = get_window_statistics(
+        after_statistics,
+        vt_patch_starts[:, np.newaxis, np.newaxis] + patch_offsets[:, np.newaxis],
+        hz_patch_starts[:, np.newaxis, np.newaxis] + patch_offsets,
+        template_size)
+
+    # propagate raster error into the 3x3 patches of correlation values
+    correlation_covariances = propagate_pixels_into_correlations(
+        height_templates,
+        uncertainty_templates,
+        get_search_stack(after_height, vt_patch_starts, hz_patch_starts, template_size+2),
+        get_search_stack(after_uncertainty, vt_patch_starts, hz_patch_starts, template_size+2),
+        peak_correlations,
+        numeric_partial_derivative_increment,
+        jacobian_method,
+        (template_means, np.sqrt(template_ssd / template_volume),
+         subarea_means, np.sqrt(subarea_ssd / template_volume)))
+
+    # propagate the correlation covariances into the subpixel peak locations
+    return propagate_correlations_into_subpixel_peaks(
+        peak_correlations,
+        correlation_covariances)
+
+
+def propagate_montecarlo_uncertainty(after_height, after_uncertainty,
+                                     height_templates, uncertainty_templates,
+                                     vt_search_starts, hz_search_starts,
+                                     peak_rows, peak_columns, search_radius, min_overlap,
+                                     number_realizations, random_generator):
+
+    # Monte Carlo propagation of the raster uncertainty into the covariances of
+    # the subpixel peaks of a window row (see get_montecarlo_peak_covariances),
+    # from search patches around the peaks that are kept inside the search areas.
+    template_size = height_templates.shape[1]
+    search_size = template_size + 2*search_radius
+    patch_radius = min(montecarlo_search_radius, search_radius)
+    patch_size = template_size + 2*patch_radius
+    vt_patch_starts = np.clip(vt_search_starts + peak_rows - patch_radius,
+                              vt_search_starts, vt_search_starts + search_size - patch_size)
+    hz_patch_starts = np.clip(hz_search_starts + peak_columns - patch_radius,
+                              hz_search_starts, hz_search_starts + search_size - patch_size)
+
+    return get_montecarlo_peak_covariances(
+        height_templates,
+        uncertainty_templates,
+        get_search_stack(after_height, vt_patch_starts, hz_patch_starts, patch_size),
+        get_search_stack(after_uncertainty, vt_patch_starts, hz_patch_starts, patch_size),
+        number_realizations,
+        random_generator,
+        min_overlap)
+
+
+def run_piv_tiles_in_pool(before_height, before_uncertainty,
+                          after_height, after_uncertainty,
+                          tiles, number_horizontal_computations,
+                          options, number_workers, predictors=None,
+                          window_selection=None, fft_workers=1):
+
+    # In-memory rasters are written once to memory mapped .npy files that every
+    # worker maps read-only, rather than being pickled into each task; GeoTIFF
+    # rasters are read strip by strip by the workers themselves.
+    number_rows = get_raster_shape(before_height)[0]
+
+    with tempfile.TemporaryDirectory(prefix='gpiv_') as raster_directory:
+        raster_files = {}
+        saved_files = {}
+        for name, raster in (('before_height', before_height),
+                             ('before_uncertainty', before_uncertainty),
+                             ('after_height', after_height),
+                             ('after_uncertainty', after_uncertainty)):
+            if len(raster) == 0:
+                raster_files[name] = None
+            elif isinstance(raster, str):
+                raster_files[name] = raster
+            elif id(raster) in saved_files: # the same raster passed twice
+                raster_files[name] = saved_files[id(raster)]
+            else:
+                raster_files[name] = os.path.join(raster_directory, name + '.npy')
+                np.save(raster_files[name], raster)
+                saved_files[id(raster)] = raster_files[name]
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=number_workers,
+                initializer=load_worker_rasters,
+                initargs=(raster_files,)) as executor:
+            # map() yields results in submission order, i.e., window grid order
+            yield from executor.map(
+                run_piv_tile_in_worker,
+                tiles,
+                [get_tile_predictors(predictors, vt_counts) for vt_counts in tiles],
+                [get_tile_predictors(window_selection, vt_counts) for vt_counts in tiles],
+                itertools.repeat(number_rows),
+                itertools.repeat(number_horizontal_computations),
+                itertools.repeat(options),
+                itertools.repeat(fft_workers))
+
+
+worker_rasters = {}
+
+
+def load_worker_rasters(raster_files):
+
+    for name, raster_file in raster_files.items():
+        if raster_file is None:
+            worker_rasters[name] = []
+        elif raster_file.endswith('.npy'):
+            worker_rasters[name] = np.load(raster_file, mmap_mode='r')
+        else:
+            worker_rasters[name] = raster_file
+
+
+def run_piv_tile_in_worker(vt_counts, predictors, window_selection, number_rows,
+                           number_horizontal_computations, options, fft_workers):
+
+    row_start, row_end = get_tile_raster_rows(vt_counts, options['template_size'], options['step_size'],
+                                              number_rows, options['search_radius'], predictors)
+    precision = options['precision']
+    with scipy.fft.set_workers(fft_workers):
+        return run_piv_tile(read_raster_rows(worker_rasters['before_height'], row_start, row_end, True, precision),
+                            read_raster_rows(worker_rasters['before_uncertainty'], row_start, row_end, False, precision),
+                            read_raster_rows(worker_rasters['after_height'], row_start, row_end, True, precision),
+                            read_raster_rows(worker_rasters['after_uncertainty'], row_start, row_end, False, precision),
+                            row_start, vt_counts, number_horizontal_computations,
+                            options, predictors, window_selection)
+
+
+def get_tiles(number_vertical_computations, rows_per_tile, completed_tiles, selected_rows=None):
+
+    # Splits the window rows into tiles of up to rows_per_tile rows, in window grid
+    # order. Completed tiles (from a checkpoint) are kept as they are and only the
+    # rows between them are split up. Rows that are not selected (no windows inside
+    # the processing boundary) are left out, so a tile never spans them.
+    if selected_rows is None:
+        selected_rows = np.ones(number_vertical_computations, dtype=bool)
+    tiles = []
+    vt_start = 0
+    for completed_vt_counts in completed_tiles + [range(number_vertical_computations, number_vertical_computations)]:
+        # runs of consecutive selected rows between the completed tiles
+        run_edges = np.flatnonzero(np.diff(np.concatenate(([False], selected_rows[vt_start:completed_vt_counts.start], [False])).astype(int)))
+        for run_start, run_stop in (run_edges.reshape(-1, 2) + vt_start):
+            for tile_start in range(run_start, run_stop, rows_per_tile):
+                tiles.append(range(int(tile_start), int(min(tile_start+rows_per_tile, run_stop))))
+        if len(completed_vt_counts) > 0:
+            tiles.append(completed_vt_counts)
+        vt_start = completed_vt_counts.stop
+
+    return tiles
+
+
+def get_tile_results(tiles, completed_tiles, computed_tile_results, checkpoint):
+
+    # tile results in window grid order, read from the checkpoint or computed
+    for vt_counts in tiles:
+        if vt_counts in completed_tiles:
+            yield checkpoint.load(vt_counts)
+        else:
+            tile_result = next(computed_tile_results)
+            if checkpoint is not None:
+                checkpoint.save(vt_counts, tile_result)
+            yield tile_result
+
+
+def get_tile_predictors(predictors, vt_counts):
+
+    # the rows of the grid predictors (or of another array over the window grid,
+    # such as the window selection) used by a tile of window rows
+    if predictors is None:
+        return None
+    return predictors[vt_counts[0]:vt_counts[-1]+1]
+
+
+def get_template_row_stack(before_height, vt_template_start, hz_template_starts, template_size):
+
+    # strided (zero-copy) view of every template along the raster rows covered by
+    # one row of the window grid; indexing by the template starts gathers the templates
+    template_views = np.lib.stride_tricks.sliding_window_view(
+        before_height[vt_template_start:vt_template_start+template_size, :], (template_size, template_size))[0]
+
+    return template_views[hz_template_starts]
+
+
+def get_search_stack(after_height, vt_search_starts, hz_search_starts, search_size):
+
+    # Gathers the search areas starting at the given strip rows and raster columns
+    # from a strided view of the rows they cover. Unless predictors move them, the
+    # search areas of a grid row all start on the same row.
+    if vt_search_starts.size == 0:
+        return np.empty((0, search_size, search_size), dtype=after_height.dtype)
+    vt_strip_start = vt_search_starts.min()
+    search_views = np.lib.stride_tricks.sliding_window_view(
+        after_height[vt_strip_start:vt_search_starts.max()+search_size, :], (search_size, search_size))
+
+    return search_views[vt_search_starts - vt_strip_start, hz_search_starts]
+
+
+def get_windows_inside(raster_shape, vt_starts, hz_starts, window_size):
+
+    return ((vt_starts >= 0) & (vt_starts + window_size <= raster_shape[0]) &
+            (hz_starts >= 0) & (hz_starts + window_size <= raster_shape[1]))
+
+
+def select_windows(stack, selected):
+
+    # boolean selection from a stack of windows, skipping the copy when all are selected
+    if selected.all():
+        return stack
+    return stack[selected]
+
+
+def get_strip_statistics(height_strip, template_size):
+
+    # Summed-area tables (integral images) of a raster strip, built once per tile.
+    # The count of NaN pixels gives the NaN check of any window in constant time,
+    # and the sums and sums of squares of every template-sized window give the
+    # window means and variances used to normalize the correlation. The height
+    # ranges for the flat check are added for each window size on first use
+    # (see get_window_ranges).
+    nan_pixels = np.isnan(height_strip)
+
+    # NaN pixels are left out of the sums (windows with NaN pixels are correlated by
+    # correlate_masked_window_stacks). Offsetting by the strip mean limits cancellation error in
+    # the sum of squares; the correlation denominator does not depend on the offset.
+    # The running sums are float64 whatever the precision of the strip.
+    if nan_pixels.all():
+        offset = 0.0
+    else:
+        offset = np.mean(height_strip[~nan_pixels], dtype=np.float64)
+    values = np.where(nan_pixels, 0, height_strip - offset).astype(np.float64, copy=False)
+
+    return {'offset': offset,
+            'nan_counts': get_summed_area_table(nan_pixels),
+            'window_sums': get_window_sums(values[np.newaxis], template_size, template_size)[0],
+            'window_sums2': get_window_sums(values[np.newaxis]**2, template_size, template_size)[0],
+            'height_strip': height_strip,
+            'window_ranges': {}}
+
 
-    plt.pause(0.1)
+def get_cached_strip_statistics(strip_cache, height_strip, template_size):
+
+    # strip statistics, computed once per cache (see run_piv_tile)
+    if 'statistics' not in strip_cache:
+        strip_cache['statistics'] = get_strip_statistics(height_strip, template_size)
+    return strip_cache['statistics']
+
+
+def get_summed_area_table(array):
+
+    # table[i, j] is the sum of array[:i, :j]
+    table = np.zeros((array.shape[0]+1, array.shape[1]+1), dtype=np.int64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+
+    return table
+
+
+def get_table_window_sums(table, vt_starts, hz_starts, window_rows, window_columns):
+
+    return (table[vt_starts + window_rows, hz_starts + window_columns] -
+            table[vt_starts, hz_starts + window_columns] -
+            table[vt_starts + window_rows, hz_starts] +
+            table[vt_starts, hz_starts])
+
+
+def get_window_ranges(strip_statistics, window_size):
+
+    # Difference between the highest and lowest valid (not NaN) height of every
+    # window_size square window of the strip, indexed by the window start. The
+    # sliding maxima and minima are separable, so each is two 1D filters over the
+    # strip; they are computed once per window size and strip.
+    window_ranges = strip_statistics['window_ranges']
+    if window_size not in window_ranges:
+        height_strip = strip_statistics['height_strip']
+        valid_pixels = ~np.isnan(height_strip)
+        maxima = np.where(valid_pixels, height_strip, -np.inf)
+        minima = np.where(valid_pixels, height_strip, np.inf)
+        # the filters are centered on window_size // 2, so the window starting at
+        # a pixel is stored that far after it
+        window_center = window_size // 2
+        for axis in (0, 1):
+            number_starts = height_strip.shape[axis] - window_size + 1
+            starts = [slice(None), slice(None)]
+            starts[axis] = slice(window_center, window_center + max(0, number_starts))
+            maxima = scipy.ndimage.maximum_filter1d(maxima, window_size, axis=axis)[tuple(starts)]
+            minima = scipy.ndimage.minimum_filter1d(minima, window_size, axis=axis)[tuple(starts)]
+        window_ranges[window_size] = maxima - minima
+
+    return window_ranges[window_size]
+
+
+def get_flat_and_nan_windows(strip_statistics, vt_starts, hz_starts, window_size, min_valid_pixels):
+
+    # masks of the windows with fewer than min_valid_pixels valid (not NaN) pixels
+    # and of the (other) windows whose valid heights span less than 1e-10
+    valid_pixels = window_size*window_size - get_table_window_sums(strip_statistics['nan_counts'], vt_starts, hz_starts, window_size, window_size)
+    nan_windows = valid_pixels < min_valid_pixels
+    flat_windows = (get_window_ranges(strip_statistics, window_size)[vt_starts, hz_starts] < 1e-10) & ~nan_windows
+
+    return flat_windows, nan_windows
+
+
+def get_window_statistics(strip_statistics, vt_starts, hz_starts, template_size):
+
+    # means and sums of squared deviations of the valid pixels of the
+    # template-sized windows starting at the given strip rows and columns
+    valid_pixels = template_size*template_size - get_table_window_sums(strip_statistics['nan_counts'], vt_starts, hz_starts, template_size, template_size)
+    valid_pixels = np.maximum(valid_pixels, 1)
+    window_sums = strip_statistics['window_sums'][vt_starts, hz_starts]
+    window_sums2 = strip_statistics['window_sums2'][vt_starts, hz_starts]
+    window_means = window_sums / valid_pixels + strip_statistics['offset']
+    window_ssd = np.maximum(window_sums2 - window_sums**2 / valid_pixels, 0)
+
+    return window_means, window_ssd
+
+
+def get_search_window_sums(strip_statistics, vt_search_starts, hz_search_starts, template_size, search_size):
+
+    # Sums and sums of squares of every template-sized window inside each search
+    # area, gathered from the window sums of the whole strip.
+    output_size = search_size - template_size + 1
+    window_sums = np.lib.stride_tricks.sliding_window_view(strip_statistics['window_sums'], (output_size, output_size))
+    window_sums2 = np.lib.stride_tricks.sliding_window_view(strip_statistics['window_sums2'], (output_size, output_size))
+
+    return window_sums[vt_search_starts, hz_search_starts], window_sums2[vt_search_starts, hz_search_starts]
+
+
+def get_template_spectra(height_templates, template_means, search_shape):
+
+    # complex conjugate spectra of the zero mean templates, zero padded to the
+    # search area size
+    zero_mean_templates = height_templates - template_means[:, np.newaxis, np.newaxis].astype(height_templates.dtype)
+    template_spectra = np.conj(scipy.fft.rfft2(zero_mean_templates, s=search_shape, axes=(1,2)))
+
+    return template_spectra
+
+
+def get_cached_search_spectra(row_cache, height_searches, searched):
+
+    # Spectra of search areas of a window row, kept in the row cache of their DEM
+    # strip (see run_piv_tile) so the pairs that search the same areas of a DEM
+    # share them. searched masks the windows of the row whose search areas are in
+    # height_searches; only the spectra no earlier pair needed are computed.
+    computed = row_cache.setdefault('search_spectra_computed', np.zeros(searched.shape, dtype=bool))
+    missing = searched & ~computed
+    if missing.any():
+        missing_spectra = scipy.fft.rfft2(select_windows(height_searches, missing[searched]), axes=(1,2))
+        if missing.all():
+            row_cache['search_spectra'] = missing_spectra
+        else:
+            if 'search_spectra' not in row_cache:
+                row_cache['search_spectra'] = np.empty((searched.size,) + missing_spectra.shape[1:], dtype=missing_spectra.dtype)
+            row_cache['search_spectra'][missing] = missing_spectra
+        computed |= missing
+
+    return select_windows(row_cache['search_spectra'], searched)
+
+
+def correlate_window_stacks(height_searches,
+                            template_spectra, template_ssd, template_shape,
+                            search_window_sums, search_window_sums2,
+                            search_spectra=None):
+
+    # Batched equivalent of skimage's match_template (Lewis, "Fast Normalized
+    # Cross-Correlation") for stacks of search areas and templates. The search area
+    # is larger than the template, so a circular correlation the size of the search
+    # area is free of wrap-around for every valid template position.
+    number_windows, search_rows, search_columns = height_searches.shape
+    template_rows, template_columns = template_shape
+    template_volume = template_rows * template_columns
+    output_rows = search_rows - template_rows + 1
+    output_columns = search_columns - template_columns + 1
+
+    # the template is zero mean, so correlating it with the raw search area equals
+    # the numerator of the normalized cross correlation; search_spectra, if given,
+    # are the spectra of height_searches computed earlier (see get_search_spectra)
+    if search_spectra is None:
+        search_spectra = scipy.fft.rfft2(height_searches, axes=(1,2))
+        search_spectra *= template_spectra
+    else:
+        search_spectra = search_spectra * template_spectra
+    numerator = get_inverse_correlation(search_spectra, search_columns, output_rows, output_columns)
+
+    denominator = search_window_sums2 - search_window_sums**2 / template_volume
+    denominator *= template_ssd[:, np.newaxis, np.newaxis]
+    np.maximum(denominator, 0, out=denominator) # sqrt of negative number not allowed
+    np.sqrt(denominator, out=denominator)
+
+    normalized_cross_correlations = np.zeros_like(numerator)
+    np.divide(numerator, denominator, out=normalized_cross_correlations,
+              where=denominator > np.finfo(numerator.dtype).eps)
+
+    return normalized_cross_correlations
+
+
+def correlate_windows(height_searches, height_templates,
+                      template_spectra, template_ssd,
+                      search_window_sums, search_window_sums2,
+                      gappy_windows, min_overlap, search_spectra=None):
+
+    # normalized cross correlations of a stack of windows; windows with NaN pixels
+    # in their template or search area (gappy_windows) use the masked correlation.
+    # search_spectra, if given, are the spectra of the search areas of the windows
+    # that are not gappy (see get_cached_search_spectra).
+    if not gappy_windows.any():
+        return correlate_window_stacks(height_searches, template_spectra, template_ssd,
+                                       height_templates.shape[1:],
+                                       search_window_sums, search_window_sums2,
+                                       search_spectra)
+
+    output_rows = height_searches.shape[1] - height_templates.shape[1] + 1
+    output_columns = height_searches.shape[2] - height_templates.shape[2] + 1
+    normalized_cross_correlations = np.empty((len(height_searches), output_rows, output_columns))
+    complete_windows = ~gappy_windows
+    if complete_windows.any():
+        normalized_cross_correlations[complete_windows] = correlate_window_stacks(
+            height_searches[complete_windows], template_spectra[complete_windows],
+            template_ssd[complete_windows], height_templates.shape[1:],
+            search_window_sums[complete_windows], search_window_sums2[complete_windows],
+            search_spectra)
+    normalized_cross_correlations[gappy_windows] = correlate_masked_window_stacks(
+        height_searches[gappy_windows], height_templates[gappy_windows], min_overlap)
+
+    return normalized_cross_correlations
+
+
+def correlate_masked_window_stacks(height_searches, height_templates, min_overlap):
+
+    # Masked normalized cross correlation (Padfield, "Masked Object Registration
+    # in the Fourier Domain") for stacks of search areas and templates with NaN
+    # pixels. At each template position only the pixels that are valid in both
+    # the template and the overlapping search subarea are correlated, so every
+    # sum of the correlation becomes a correlation of the masked arrays with the
+    # masks, computed by FFT like correlate_window_stacks. Positions where fewer
+    # than min_overlap of the template pixels overlap, or where the overlapping
+    # pixels are flat, are NaN.
+    number_windows, search_rows, search_columns = height_searches.shape
+    template_rows, template_columns = height_templates.shape[1:]
+    output_rows = search_rows - template_rows + 1
+    output_columns = search_columns - template_columns + 1
+    search_valid = ~np.isnan(height_searches)
+    template_valid = ~np.isnan(height_templates)
+
+    # offset by the means of the valid pixels to limit cancellation error in the
+    # sums of squares; the correlation does not depend on the offsets
+    searches = np.where(search_valid, height_searches - np.nanmean(height_searches, axis=(1,2), keepdims=True), 0)
+    templates = np.where(template_valid, height_templates - np.nanmean(height_templates, axis=(1,2), keepdims=True), 0)
+
+    search_spectra = scipy.fft.rfft2(np.stack((search_valid, searches, searches**2)), axes=(2,3))
+    template_spectra = np.conj(scipy.fft.rfft2(np.stack((template_valid, templates, templates**2)),
+                                            s=(search_rows, search_columns), axes=(2,3)))
+    # overlap counts, search sums and sums of squares, template sums and sums of
+    # squares, and cross products over the overlapping pixels of each position
+    (overlap_counts, search_sums, search_sums2,
+     template_sums, template_sums2, cross_sums) = get_inverse_correlation(
+        search_spectra[[0, 1, 2, 0, 0, 1]] * template_spectra[[0, 0, 0, 1, 2, 1]],
+        search_columns, output_rows, output_columns)
+    overlap_counts = np.rint(overlap_counts)
+    number_overlapping = np.maximum(overlap_counts, 1)
+
+    numerator = cross_sums - search_sums * template_sums / number_overlapping
+    denominator = ((search_sums2 - search_sums**2 / number_overlapping) *
+                   (template_sums2 - template_sums**2 / number_overlapping))
+    np.maximum(denominator, 0, out=denominator) # sqrt of negative number not allowed
+    np.sqrt(denominator, out=denominator)
+
+    normalized_cross_correlations = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=normalized_cross_correlations,
+              where=(denominator > np.finfo(numerator.dtype).eps) &
+                    (overlap_counts >= min_overlap * template_rows * template_columns))
+
+    return normalized_cross_correlations
+
+
+def get_inverse_correlation(correlation_spectra, search_columns, output_rows, output_columns):
+
+    # inverse of the rfft2 correlation spectra over the last two axes, keeping the
+    # output_rows x output_columns positions where the template lies inside the
+    # search area; only the first output_rows rows of the inverse transform are
+    # needed, so the column transform is truncated before the (more expensive)
+    # row transform
+    correlations = scipy.fft.ifft(correlation_spectra, axis=-2)[..., :output_rows, :]
+    return scipy.fft.irfft(correlations, n=search_columns, axis=-1)[..., :output_columns]
+
+
+def get_window_sums(stack, window_rows, window_columns):
+
+    # sums over every window_rows x window_columns window of each array in the stack
+    window_sum = np.cumsum(stack, axis=1)
+    window_sum = np.concatenate((window_sum[:, window_rows-1:window_rows], window_sum[:, window_rows:] - window_sum[:, :-window_rows]), axis=1)
+    window_sum = np.cumsum(window_sum, axis=2)
+    window_sum = np.concatenate((window_sum[:, :, window_columns-1:window_columns], window_sum[:, :, window_columns:] - window_sum[:, :, :-window_columns]), axis=2)
+
+    return window_sum
+
+
+def locate_correlation_peaks(normalized_cross_correlations):
+
+    # Returns the correlation peaks that are not on the edge of the correlation
+    # arrays (a mask over the input stack), and for those the peak indices, the 3x3
+    # arrays of correlation values centered on the peaks and the sub-pixel peaks.
+    # NaN correlations (positions without enough valid pixels in a masked
+    # correlation) are treated like the edge of the array.
+    number_windows, number_rows, number_columns = normalized_cross_correlations.shape
+    missing = np.isnan(normalized_cross_correlations)
+    if missing.any():
+        normalized_cross_correlations = np.where(missing, -np.inf, normalized_cross_correlations)
+
+    # first maximum in row-major order, matching np.where(ncc == np.max(ncc))[.][0]
+    peak_indices = np.argmax(normalized_cross_correlations.reshape(number_windows, -1), axis=1)
+    peak_rows = peak_indices // number_columns
+    peak_columns = peak_indices % number_columns
+
+    # peak location on edges of correlation matrix breaks sub-pixel peak interpolation
+    interior = ((peak_rows > 0) &
+                (peak_columns > 0) &
+                (peak_rows < number_rows-1) &
+                (peak_columns < number_columns-1))
+    peak_rows = peak_rows[interior]
+    peak_columns = peak_columns[interior]
+
+    offsets = np.arange(-1, 2)
+    peak_correlations = normalized_cross_correlations[
+        np.flatnonzero(interior)[:, np.newaxis, np.newaxis],
+        peak_rows[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis],
+        peak_columns[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]]
+    if missing.any():
+        complete = np.isfinite(peak_correlations).all(axis=(1,2))
+        interior[interior] = complete
+        peak_rows = peak_rows[complete]
+        peak_columns = peak_columns[complete]
+        peak_correlations = peak_correlations[complete]
+    subpixel_peaks = get_subpixel_peak(peak_correlations)
+
+    return interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks
+
+
+def get_peak_ratios(normalized_cross_correlations, peak_rows, peak_columns):
+
+    # Ratio of each correlation peak to the highest other local maximum of its
+    # correlation array, a measure of how unambiguous the match is. Local maxima
+    # are the values not below any of their 8 neighbours, so the slopes of the
+    # main peak do not count as second peaks. The ratio is infinite when there is
+    # no other positive peak. NaN correlations are ignored.
+    number_windows, number_rows, number_columns = normalized_cross_correlations.shape
+    padded = np.pad(np.nan_to_num(normalized_cross_correlations, nan=-np.inf),
+                    ((0,0), (1,1), (1,1)), constant_values=-np.inf)
+    correlations = padded[:, 1:-1, 1:-1]
+    local_maxima = np.isfinite(correlations)
+    for row_offset in range(3):
+        for column_offset in range(3):
+            if row_offset != 1 or column_offset != 1:
+                local_maxima &= correlations >= padded[:, row_offset:row_offset+number_rows,
+                                                          column_offset:column_offset+number_columns]
+    window_indices = np.arange(number_windows)
+    local_maxima[window_indices, peak_rows, peak_columns] = False
+    second_peaks = np.max(np.where(local_maxima, correlations, -np.inf), axis=(1,2), initial=-np.inf)
+
+    peak_ratios = np.full(number_windows, np.inf)
+    positive = second_peaks > 0
+    peak_ratios[positive] = correlations[window_indices, peak_rows, peak_columns][positive] / second_peaks[positive]
+
+    return peak_ratios
 
 
 def get_subpixel_peak(normalized_cross_correlation):
 
-    dx = (normalized_cross_correlation[1,2] - normalized_cross_correlation[1,0]) / 2
-    dxx = normalized_cross_correlation[1,2] + normalized_cross_correlation[1,0] - 2*normalized_cross_correlation[1,1]
-    dy = (normalized_cross_correlation[2,1] - normalized_cross_correlation[0,1]) / 2
-    dyy = normalized_cross_correlation[2,1] + normalized_cross_correlation[0,1] - 2*normalized_cross_correlation[1,1]
-    dxy = (normalized_cross_correlation[2,2] - normalized_cross_correlation[2,0] - normalized_cross_correlation[0,2] + normalized_cross_correlation[0,0]) / 4
+    # accepts a single 3x3 array or a stack of them (..., 3, 3)
+    dx = (normalized_cross_correlation[...,1,2] - normalized_cross_correlation[...,1,0]) / 2
+    dxx = normalized_cross_correlation[...,1,2] + normalized_cross_correlation[...,1,0] - 2*normalized_cross_correlation[...,1,1]
+    dy = (normalized_cross_correlation[...,2,1] - normalized_cross_correlation[...,0,1]) / 2
+    dyy = normalized_cross_correlation[...,2,1] + normalized_cross_correlation[...,0,1] - 2*normalized_cross_correlation[...,1,1]
+    dxy = (normalized_cross_correlation[...,2,2] - normalized_cross_correlation[...,2,0] - normalized_cross_correlation[...,0,2] + normalized_cross_correlation[...,0,0]) / 4
     
     # hz_delta is postive left-to-right; vt_delta is postive top-to-bottom
     hz_delta = -(dyy*dx - dxy*dy) / (dxx*dyy - dxy*dxy)
@@ -233,41 +1634,177 @@ def get_subpixel_peak(normalized_cross_correlation):
     return [hz_delta, vt_delta]
 
 
-def propagate_pixel_into_correlation(
-    height_template,
-    uncertainty_template, 
-    height_search,
-    uncertainty_search,
-    normalized_cross_correlation,
-    numeric_partial_diff_increment):
-
-    template_covariance_vector = np.square(uncertainty_template.reshape(uncertainty_template.size,)) # convert array to vector, row-by-row, and square the standard deviations into variances
-    search_covariance_vector = np.square(uncertainty_search.reshape(uncertainty_search.size,))
-    covariance_matrix = np.diag(np.hstack((template_covariance_vector, search_covariance_vector)))
-
-    jacobian = get_correlation_jacobian(height_template, height_search, normalized_cross_correlation, numeric_partial_diff_increment)    
-    # Propagate the template and search area errors into the 9 correlation elements
-    # The covariance order is by row of the normalized_cross_correlation (ncc) array (i.e., ncc[0,0], ncc[0,1], ncc[0,2], ncc[1,0], ncc[1,1], ...)
-    correlation_covariance = np.matmul(jacobian,np.matmul(covariance_matrix,jacobian.T))
-
-    return correlation_covariance
-
-
-def get_correlation_jacobian(template,
+def propagate_pixels_into_correlations(
+    height_templates,
+    uncertainty_templates,
+    height_searches,
+    uncertainty_searches,
+    normalized_cross_correlations,
+    numeric_partial_diff_increment,
+    jacobian_method='analytic',
+    window_statistics=None):
+
+    # Stacks of templates and of the templateSize+2 x templateSize+2 search subareas
+    # around the correlation peaks in, stack of 9x9 correlation covariances out.
+    # window_statistics optionally holds the template means and standard deviations
+    # and the 3x3 search subarea means and standard deviations of each window.
+    # The covariance order is by row of each normalized_cross_correlation (ncc)
+    # array (i.e., ncc[0,0], ncc[0,1], ncc[0,2], ncc[1,0], ncc[1,1], ...)
+    number_windows, number_template_rows, number_template_columns = height_templates.shape
+    number_pixels = number_template_rows*number_template_columns + height_searches.shape[1]*height_searches.shape[2]
+    correlation_covariances = np.empty((number_windows, 9, 9))
+
+    # the Jacobians are built for chunks of windows to bound their memory use
+    chunk_size = max(1, 2**22 // (9*number_pixels))
+    for chunk_start in range(0, number_windows, chunk_size):
+        chunk = slice(chunk_start, chunk_start+chunk_size)
+        if jacobian_method == 'numeric':
+            # finite differences need float64 whatever the precision of the heights
+            jacobians = np.stack([get_numeric_correlation_jacobian(
+                height_template.astype(np.float64), height_search.astype(np.float64),
+                normalized_cross_correlation, numeric_partial_diff_increment)
+                for height_template, height_search, normalized_cross_correlation in zip(
+                    height_templates[chunk], height_searches[chunk], normalized_cross_correlations[chunk])])
+        else:
+            if window_statistics is None:
+                chunk_statistics = None
+            else:
+                chunk_statistics = [statistic[chunk] for statistic in window_statistics]
+            jacobians = get_correlation_jacobians(height_templates[chunk], height_searches[chunk], chunk_statistics)
+
+        # the pixel errors are independent, so their covariance matrix is diagonal and
+        # J*C*J' reduces to scaling the Jacobian columns by the pixel variances
+        # NaN height pixels are not correlated and add no variance
+        pixel_variances = np.concatenate((
+            np.square(uncertainty_templates[chunk].reshape(len(jacobians), -1)),
+            np.square(uncertainty_searches[chunk].reshape(len(jacobians), -1))), axis=1)
+        pixel_variances[np.concatenate((
+            np.isnan(height_templates[chunk].reshape(len(jacobians), -1)),
+            np.isnan(height_searches[chunk].reshape(len(jacobians), -1))), axis=1)] = 0
+        correlation_covariances[chunk] = np.matmul(jacobians * pixel_variances[:, np.newaxis, :],
+                                                   jacobians.transpose(0, 2, 1))
+
+    return correlation_covariances
+
+
+def get_correlation_jacobians(templates, searches, window_statistics=None):
+
+    # Closed-form partial derivatives of the zero-normalized cross correlation
+    #   ncc = sum(t_hat * s_hat) / N,  t_hat = (t - mean(t)) / std(t),  s_hat likewise
+    # for the 3x3 correlation cells centered on the peak. Differentiating gives
+    #   d(ncc)/d(t_k) = (s_hat_k - ncc * t_hat_k) / (N * std(t))
+    #   d(ncc)/d(s_k) = (t_hat_k - ncc * s_hat_k) / (N * std(s))
+    # Takes stacks of templates and search subareas; the layout of each Jacobian
+    # matches get_numeric_correlation_jacobian. The means and standard deviations
+    # are computed here unless given by window_statistics (see
+    # propagate_pixels_into_correlations). For windows with NaN pixels, N, the
+    # means and the standard deviations of each cell are those of the pixels that
+    # are valid in both the template and the search subarea (the masked
+    # correlation), and the other pixels have zero partial derivatives.
+    number_windows, number_template_rows, number_template_columns = templates.shape
+    number_search_rows, number_search_columns = searches.shape[1:]
+    template_size = number_template_rows * number_template_columns
+    search_size = number_search_rows * number_search_columns
+
+    # windows x 3 x 3 x template_rows x template_columns view of the search subareas
+    search_subareas = np.lib.stride_tricks.sliding_window_view(searches, (number_template_rows, number_template_columns), axis=(1,2))
+
+    if window_statistics is None:
+        template_means = np.mean(templates, axis=(1,2))
+        template_std = np.std(templates, axis=(1,2))
+        search_subarea_means = np.mean(search_subareas, axis=(3,4))
+        search_subarea_std = np.std(search_subareas, axis=(3,4))
+    else:
+        template_means, template_std, search_subarea_means, search_subarea_std = window_statistics
+    template_means = template_means[:, np.newaxis, np.newaxis]
+    template_std = template_std[:, np.newaxis, np.newaxis]
+    number_overlapping = template_size
+
+    gappy_windows = np.isnan(templates).any(axis=(1,2)) | np.isnan(searches).any(axis=(1,2))
+    if gappy_windows.any():
+        # one template mean and standard deviation per correlation cell
+        cell_shape = (number_windows, 3, 3)
+        template_means = np.broadcast_to(template_means, cell_shape).copy()
+        template_std = np.broadcast_to(template_std, cell_shape).copy()
+        search_subarea_means = search_subarea_means.copy()
+        search_subarea_std = search_subarea_std.copy()
+        number_overlapping = np.full(cell_shape, template_size)
+
+        gappy_templates = np.broadcast_to(templates[gappy_windows, np.newaxis, np.newaxis], search_subareas[gappy_windows].shape)
+        gappy_overlap = ~np.isnan(gappy_templates) & ~np.isnan(search_subareas[gappy_windows])
+        number_overlapping[gappy_windows] = np.count_nonzero(gappy_overlap, axis=(3,4))
+        template_means[gappy_windows], template_std[gappy_windows] = get_masked_mean_and_std(gappy_templates, gappy_overlap)
+        search_subarea_means[gappy_windows], search_subarea_std[gappy_windows] = get_masked_mean_and_std(search_subareas[gappy_windows], gappy_overlap)
+        number_overlapping = number_overlapping[..., np.newaxis, np.newaxis]
+
+    template_std = template_std[..., np.newaxis, np.newaxis]
+    search_subarea_std = search_subarea_std[..., np.newaxis, np.newaxis]
+    normalized_templates = (templates[:, np.newaxis, np.newaxis] - template_means[..., np.newaxis, np.newaxis]) / template_std
+    normalized_search_subareas = (search_subareas - search_subarea_means[..., np.newaxis, np.newaxis]) / search_subarea_std
+    if gappy_windows.any():
+        overlap = ~np.isnan(normalized_templates) & ~np.isnan(normalized_search_subareas)
+        normalized_templates = np.where(overlap, normalized_templates, 0)
+        normalized_search_subareas = np.where(overlap, normalized_search_subareas, 0)
+
+    correlation = np.sum(normalized_templates * normalized_search_subareas, axis=(3,4), keepdims=True) / number_overlapping
+
+    template_partial_derivatives = (normalized_search_subareas - correlation*normalized_templates) / (number_overlapping * template_std)
+    subarea_partial_derivatives = (normalized_templates - correlation*normalized_search_subareas) / (number_overlapping * search_subarea_std)
+
+    # place each subarea's partial derivatives at its offset within the full search array
+    search_partial_derivatives = np.zeros((number_windows, 3, 3, number_search_rows, number_search_columns))
+    correlation_rows = np.arange(3)[:, np.newaxis, np.newaxis, np.newaxis]
+    correlation_columns = np.arange(3)[np.newaxis, :, np.newaxis, np.newaxis]
+    search_partial_derivatives[
+        :,
+        correlation_rows,
+        correlation_columns,
+        correlation_rows + np.arange(number_template_rows)[:, np.newaxis],
+        correlation_columns + np.arange(number_template_columns)] = subarea_partial_derivatives
+
+    jacobians = np.empty((number_windows, 9, template_size + search_size))
+    jacobians[:, :, 0:template_size] = template_partial_derivatives.reshape(number_windows, 9, template_size)
+    jacobians[:, :, template_size:] = search_partial_derivatives.reshape(number_windows, 9, search_size)
+
+    return jacobians
+
+
+def get_masked_mean_and_std(values, valid):
+
+    # means and standard deviations over the last two axes of the valid values
+    number_valid = np.count_nonzero(valid, axis=(-2,-1))
+    means = np.sum(np.where(valid, values, 0), axis=(-2,-1)) / number_valid
+    deviations = np.where(valid, values - means[..., np.newaxis, np.newaxis], 0)
+    std = np.sqrt(np.sum(deviations**2, axis=(-2,-1)) / number_valid)
+
+    return means, std
+
+
+def get_numeric_correlation_jacobian(template,
     search,
     normalized_cross_correlation,
     numeric_partial_derivative_increment):
 
+    # Finite difference reference for get_correlation_jacobian. Much slower, kept
+    # for validating the closed-form derivatives ('--jacobian numeric'). Each
+    # correlation cell only uses the pixels that are valid in both the template
+    # and the search subarea; the NaN-ignoring statistics below make the
+    # perturbation of any other pixel a no-op.
+
     number_template_rows, number_template_columns = template.shape
     number_search_rows, number_search_columns = search.shape
     jacobian = np.zeros((9, template.size + search.size))
-    normalized_template = (template - np.mean(template)) / (np.std(template))
 
     # cycle through the 3x3 correlation array
     for row_correlation in range(3):
         for col_correlation in range(3):
             search_subarea = search[row_correlation:row_correlation+number_template_rows, col_correlation:col_correlation+number_template_columns]
-            normalized_search_subarea = (search_subarea - np.mean(search_subarea)) / (np.std(search_subarea))
+            overlap = ~np.isnan(template) & ~np.isnan(search_subarea)
+            number_overlapping = np.count_nonzero(overlap)
+            cell_template = np.where(overlap, template, np.nan)
+            search_subarea = np.where(overlap, search_subarea, np.nan)
+            normalized_template = (cell_template - np.nanmean(cell_template)) / (np.nanstd(cell_template))
+            normalized_search_subarea = (search_subarea - np.nanmean(search_subarea)) / (np.nanstd(search_subarea))
 
             template_partial_derivatives = np.zeros((number_template_rows, number_template_columns))
             search_partial_derivatives = np.zeros((number_search_rows, number_search_columns))
@@ -276,17 +1813,17 @@ def get_correlation_jacobian(template,
             # its partial derivate with respect to the normalized cross correlation
             for row_template in range(number_template_rows):
                 for col_template in range(number_template_columns):
-                    perturbed_template = template.copy()
+                    perturbed_template = cell_template.copy()
                     perturbed_template[row_template,col_template] += numeric_partial_derivative_increment
                     perturbed_search_subarea = search_subarea.copy()
                     perturbed_search_subarea[row_template,col_template] += numeric_partial_derivative_increment
 
-                    # spatial domain normalized cross correlation (i.e., does not use the FFT)
-                    # about 20x faster than using skimage's FFT based match_template method
-                    normalized_perturbed_template = (perturbed_template - np.mean(perturbed_template)) / (np.std(perturbed_template))
-                    normalized_perturbed_search_subarea = (perturbed_search_subarea - np.mean(perturbed_search_subarea)) / (np.std(perturbed_search_subarea))
-                    perturbed_template_normalized_cross_correlation = np.sum(normalized_perturbed_template * normalized_search_subarea) / template.size
-                    perturbed_search_subarea_normalized_cross_correlation = np.sum(normalized_template * normalized_perturbed_search_subarea) / template.size
+                    # spatial domain normalized cross correlation of the single perturbed cell
+                    # (i.e., does not use the FFT)
+                    normalized_perturbed_template = (perturbed_template - np.nanmean(perturbed_template)) / (np.nanstd(perturbed_template))
+                    normalized_perturbed_search_subarea = (perturbed_search_subarea - np.nanmean(perturbed_search_subarea)) / (np.nanstd(perturbed_search_subarea))
+                    perturbed_template_normalized_cross_correlation = np.nansum(normalized_perturbed_template * normalized_search_subarea) / number_overlapping
+                    perturbed_search_subarea_normalized_cross_correlation = np.nansum(normalized_template * normalized_perturbed_search_subarea) / number_overlapping
                     
                     # storage location adjustment by row_correlation and col_correlation accounts for the larger size of the search area than the template area
                     template_partial_derivatives[row_template, col_template] = (perturbed_template_normalized_cross_correlation - normalized_cross_correlation[row_correlation,col_correlation]) / numeric_partial_derivative_increment
@@ -300,95 +1837,152 @@ def get_correlation_jacobian(template,
     return jacobian
 
 
-def propagate_correlation_into_subpixel_peak(
-    correlation,
-    correlation_covariance,
-    subpixel_peak,
-    numeric_partial_derivative_increment):
-
-    jacobian = np.zeros((2,9))
-
-    # cycle through the 3x3 correlation array, row-by-row, and create the jacobian matrix
-    for row_correlation in range(3):
-        for col_correlation in range(3):
-            perturbed_correlation = correlation.copy()
-            perturbed_correlation[row_correlation,col_correlation] += numeric_partial_derivative_increment            
-            perturbed_hz_delta, perturbed_vt_delta = get_subpixel_peak(perturbed_correlation)            
-            jacobian[0,row_correlation*3+col_correlation] = (perturbed_hz_delta - subpixel_peak[0]) / numeric_partial_derivative_increment
-            jacobian[1,row_correlation*3+col_correlation] = (perturbed_vt_delta - subpixel_peak[1]) / numeric_partial_derivative_increment
-    
-    # propagate the 3x3 array of correlation uncertainties into the sub-pixel U and V direction offsets
-    subpixel_peak_covariance = np.matmul(jacobian, np.matmul(correlation_covariance, jacobian.T))
-        
-    return subpixel_peak_covariance
-
-
-def export_piv(
-    piv_origins,
-    piv_vectors,
-    geo_transform,
-    output_base_name):
-
-    # Convert from pixels to ground distance
-    piv_origins = np.asarray(piv_origins)        
-    piv_origins *= geo_transform[0,0]  # Scale by pixel ground size
-    piv_origins[:,0] += geo_transform[0,2]  # Offset by leftmost pixel to get ground coordinate
-    piv_origins[:,1] = geo_transform[1,2] - piv_origins[:,1]  # Subtract from uppermost pixel to get ground coordinate    
-    piv_vectors = np.asarray(piv_vectors)
-    piv_vectors *= geo_transform[0,0]  # Scale by pixel ground size
-    
-    origins_vectors = np.concatenate((piv_origins, piv_vectors), axis=1)
-    json.dump(origins_vectors.tolist(), open(output_base_name + "vectors.json", "w"))
-    print("PIV displacement vectors saved to file '{}vectors.json'".format(output_base_name))
-
+def propagate_correlations_into_subpixel_peaks(
+    normalized_cross_correlations,
+    correlation_covariances):
+
+    # propagate stacks of 3x3 correlation arrays and their 9x9 covariances into the
+    # 2x2 covariances of the sub-pixel U and V direction offsets
+    jacobians = get_subpixel_peak_jacobians(normalized_cross_correlations)
+    subpixel_peak_covariances = np.matmul(jacobians, np.matmul(correlation_covariances, jacobians.transpose(0, 2, 1)))
+
+    return subpixel_peak_covariances
+
+
+def get_subpixel_peak_jacobians(normalized_cross_correlations):
+
+    # Closed-form partial derivatives of the get_subpixel_peak offsets with respect to
+    # the 9 correlation values, row-by-row, for a stack of 3x3 correlation arrays. The
+    # finite differences and second derivatives of the fitted quadratic are linear in
+    # the correlation values, with these coefficients:
+    dx_coefficients = np.array([0, 0, 0, -0.5, 0, 0.5, 0, 0, 0])
+    dxx_coefficients = np.array([0, 0, 0, 1, -2, 1, 0, 0, 0])
+    dy_coefficients = np.array([0, -0.5, 0, 0, 0, 0, 0, 0.5, 0])
+    dyy_coefficients = np.array([0, 1, 0, 0, -2, 0, 0, 1, 0])
+    dxy_coefficients = np.array([0.25, 0, -0.25, 0, 0, 0, -0.25, 0, 0.25])
+
+    correlations = normalized_cross_correlations.reshape(-1, 9)
+    dx = (correlations @ dx_coefficients)[:, np.newaxis]
+    dxx = (correlations @ dxx_coefficients)[:, np.newaxis]
+    dy = (correlations @ dy_coefficients)[:, np.newaxis]
+    dyy = (correlations @ dyy_coefficients)[:, np.newaxis]
+    dxy = (correlations @ dxy_coefficients)[:, np.newaxis]
+
+    # hz_delta = -hz_numerator / determinant and vt_delta = -vt_numerator / determinant
+    determinant = dxx*dyy - dxy*dxy
+    hz_numerator = dyy*dx - dxy*dy
+    vt_numerator = dxx*dy - dxy*dx
+    determinant_partials = dyy*dxx_coefficients + dxx*dyy_coefficients - 2*dxy*dxy_coefficients
+    hz_numerator_partials = dx*dyy_coefficients + dyy*dx_coefficients - dy*dxy_coefficients - dxy*dy_coefficients
+    vt_numerator_partials = dy*dxx_coefficients + dxx*dy_coefficients - dx*dxy_coefficients - dxy*dx_coefficients
+
+    jacobians = np.empty((len(correlations), 2, 9))
+    jacobians[:, 0] = -(hz_numerator_partials*determinant - hz_numerator*determinant_partials) / determinant**2
+    jacobians[:, 1] = -(vt_numerator_partials*determinant - vt_numerator*determinant_partials) / determinant**2
+
+    return jacobians
+
+
+def get_montecarlo_peak_covariances(height_templates, uncertainty_templates,
+                                    height_patches, uncertainty_patches,
+                                    number_realizations, random_generator, min_overlap=1.0):
+
+    # Monte Carlo alternative to the linearized propagation: every template and
+    # search patch (the template size + 2*radius square search subarea around the
+    # correlation peak) is perturbed number_realizations times with normal noise
+    # of the standard deviations in the uncertainty stacks, the perturbed pairs are
+    # correlated in one batched FFT, and the 2x2 covariance of each window is the
+    # sample covariance of the sub-pixel peaks of its realizations. Realizations
+    # whose peak reaches the edge of the patch correlation are left out; windows
+    # with fewer than two realizations left get a NaN covariance. Windows are
+    # processed in chunks to bound the memory of the perturbed stacks.
+    number_windows, template_rows, template_columns = height_templates.shape
+    patch_rows, patch_columns = height_patches.shape[1:]
+    peak_covariances = np.full((number_windows, 2, 2), np.nan)
+    chunk_size = max(1, montecarlo_chunk_values // (number_realizations * patch_rows * patch_columns))
+    for chunk_start in range(0, number_windows, chunk_size):
+        chunk = slice(chunk_start, chunk_start+chunk_size)
+        chunk_windows = len(height_templates[chunk])
+        noise_shape = (chunk_windows, number_realizations)
+        templates = (height_templates[chunk, np.newaxis] + uncertainty_templates[chunk, np.newaxis] *
+                     random_generator.standard_normal(noise_shape + (template_rows, template_columns), dtype=height_templates.dtype))
+        patches = (height_patches[chunk, np.newaxis] + uncertainty_patches[chunk, np.newaxis] *
+                   random_generator.standard_normal(noise_shape + (patch_rows, patch_columns), dtype=height_patches.dtype))
+        templates = templates.reshape((-1, template_rows, template_columns))
+        patches = patches.reshape((-1, patch_rows, patch_columns))
+
+        gappy = np.isnan(templates).any(axis=(1,2)) | np.isnan(patches).any(axis=(1,2))
+        template_means = templates.mean(axis=(1,2))
+        template_ssd = np.sum((templates - template_means[:, np.newaxis, np.newaxis])**2, axis=(1,2))
+        normalized_cross_correlations = correlate_windows(
+            patches, templates,
+            get_template_spectra(templates, template_means, (patch_rows, patch_columns)),
+            template_ssd,
+            get_window_sums(patches.astype(np.float64), template_rows, template_columns),
+            get_window_sums(np.square(patches, dtype=np.float64), template_rows, template_columns),
+            gappy, min_overlap)
+
+        interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks = locate_correlation_peaks(normalized_cross_correlations)
+        peaks = np.full((len(interior), 2), np.nan)
+        peaks[interior] = np.column_stack((peak_columns + subpixel_peaks[0], peak_rows + subpixel_peaks[1]))
+        peaks = peaks.reshape(noise_shape + (2,))
+
+        valid = np.isfinite(peaks).all(axis=2)
+        number_valid = np.count_nonzero(valid, axis=1)
+        peaks[~valid] = 0
+        peak_means = peaks.sum(axis=1, keepdims=True) / np.maximum(number_valid, 1)[:, np.newaxis, np.newaxis]
+        deviations = np.where(valid[..., np.newaxis], peaks - peak_means, 0)
+        estimated = number_valid >= 2
+        peak_covariances[chunk][estimated] = (np.einsum('wki,wkj->wij', deviations, deviations)[estimated] /
+                                              (number_valid[estimated] - 1)[:, np.newaxis, np.newaxis])
+
+    return peak_covariances
+
+
+def update_vector_statistics(vector_statistics, tile_vectors):
+
+    # merge the count, mean and sum of squared deviations of a tile's vectors
+    # into the running totals (Chan et al. pairwise update)
+    tile_count = len(tile_vectors)
+    if tile_count == 0:
+        return
+    tile_mean = tile_vectors.mean(axis=0)
+    tile_m2 = np.sum((tile_vectors - tile_mean)**2, axis=0)
+
+    count = vector_statistics['count'] + tile_count
+    delta = tile_mean - vector_statistics['mean']
+    vector_statistics['mean'] = vector_statistics['mean'] + delta*tile_count/count
+    vector_statistics['m2'] = vector_statistics['m2'] + tile_m2 + delta**2*vector_statistics['count']*tile_count/count
+    vector_statistics['count'] = count
+
+
+def get_bias_variance(vector_statistics):
+
+    x_bias_variance, y_bias_variance = vector_statistics['m2'] / vector_statistics['count']
 
-def export_uncertainty(piv_origins,
-                       piv_vectors,
-                       peak_covariance,
-                       geo_transform,
-                       output_base_name):
-
-    # Convert from pixels to ground distance
-    piv_origins = np.asarray(piv_origins)        
-    piv_origins *= geo_transform[0,0]  # Scale by pixel ground size
-    piv_origins[:,0] += geo_transform[0,2]  # Offset by leftmost pixel to get ground coordinate
-    piv_origins[:,1] = geo_transform[1,2] - piv_origins[:,1]  # Subtract from uppermost pixel to get ground coordinate
-    piv_vectors = np.asarray(piv_vectors)
-    piv_vectors *= geo_transform[0,0]  # Scale by pixel ground size
-    peak_covariance = np.asarray(peak_covariance)
-    peak_covariance *= geo_transform[0,0]**2  # Scale by squared pixel ground size
+    return [x_bias_variance, y_bias_variance]
 
-    piv_end_location = piv_origins
-    piv_end_location[:,0] += piv_vectors[:,0]     
-    piv_end_location[:,1] -= piv_vectors[:,1]  # Subtract to convert from dV (positive down) to dY (positive up)
 
-    piv_end_location = piv_end_location.tolist()
-    peak_covariance = peak_covariance.tolist()
-    locations_covariances = []
-    for i in range(len(piv_end_location)):
-        locations_covariances.append([piv_end_location[i], peak_covariance[i]])
+def add_bias_variance(covariance_file, xy_bias_variance):
 
-    json.dump(locations_covariances, open(output_base_name + "covariances.json", "w"))
-    print("PIV covariance matrices saved to file '{}covariances.json'".format(output_base_name))
+    if covariance_file.endswith('.json'):
+        with open(covariance_file, "r") as json_file:
+            covariance_matrices = json.load(json_file)
 
+        for i in range(len(covariance_matrices)):
+            covariance_matrices[i][1][0][0] += xy_bias_variance[0]
+            covariance_matrices[i][1][1][1] += xy_bias_variance[1]
 
-def get_bias_variance(output_base_name):
-    with open(output_base_name + "vectors.json", "r") as json_file:
-        origins_vectors = json.load(json_file)
-    origins_vectors = np.asarray(origins_vectors)
+        with open(covariance_file, "w") as json_file:
+            json.dump(covariance_matrices, json_file)
+    else:
+        # updated in place through a memory map; only the two diagonal terms are touched
+        covariance_records = result_functions.read_covariances(covariance_file, 'r+')
+        add_bias_variance_to_records(covariance_records, xy_bias_variance)
+        covariance_records.flush()
 
-    x_bias_variance = np.var(origins_vectors[:,2])
-    y_bias_variance = np.var(origins_vectors[:,3])
 
-    return [x_bias_variance, y_bias_variance]
+def add_bias_variance_to_records(covariance_records, xy_bias_variance):
 
-
-def add_bias_variance(output_base_name, xy_bias_variance):
-    with open(output_base_name + "covariances.json", "r") as json_file:
-        covariance_matrices = json.load(json_file)
-    
-    for i in range(len(covariance_matrices)):
-        covariance_matrices[i][1][0][0] += xy_bias_variance[0]
-        covariance_matrices[i][1][1][1] += xy_bias_variance[1]
-    
-    json.dump(covariance_matrices, open(output_base_name + "covariances.json", "w"))
\ No newline at end of file
+    covariance_records['covariance'][:,0,0] += xy_bias_variance[0]
+    covariance_records['covariance'][:,1,1] += xy_bias_variance[1]
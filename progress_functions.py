@@ -0,0 +1,147 @@
+import sys
+import time
+
+
+# Reporters receive three calls from run_piv:
+#   start(number_windows, before_height, after_height, template_size, search_size)
+#   update(number_completed, template_location, search_location)
+#   finish()
+# where the locations are the (column, row) pixel indices of the upper left
+# corner of the current template and search area.
+
+
+class NullProgressReporter:
+
+    def start(self, number_windows, before_height, after_height, template_size, search_size):
+        pass
+
+    def update(self, number_completed, template_location, search_location):
+        pass
+
+    def finish(self):
+        pass
+
+
+class TextProgressReporter:
+
+    def __init__(self, stream=None, update_interval=0.5, log_interval=10.0, bar_width=30):
+        self.stream = sys.stderr if stream is None else stream
+        self.bar_width = bar_width
+        # an interactive terminal gets a single redrawn bar, anything else (log files,
+        # batch schedulers) gets one line per report at a much lower rate
+        self.interactive = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.update_interval = update_interval if self.interactive else log_interval
+
+    def start(self, number_windows, before_height, after_height, template_size, search_size):
+        self.number_windows = number_windows
+        self.number_completed = 0
+        self.start_time = time.perf_counter()
+        self.last_report_time = self.start_time
+
+    def update(self, number_completed, template_location, search_location):
+        self.number_completed = number_completed
+        now = time.perf_counter()
+        if now - self.last_report_time >= self.update_interval:
+            self.last_report_time = now
+            self.write_status(now)
+
+    def finish(self):
+        now = time.perf_counter()
+        self.number_completed = self.number_windows
+        self.write_status(now)
+        if self.interactive:
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def write_status(self, now):
+        elapsed = now - self.start_time
+        if self.number_windows > 0:
+            fraction = self.number_completed / self.number_windows
+        else:
+            fraction = 1.0
+        filled = int(round(fraction * self.bar_width))
+        rate = self.number_completed / elapsed if elapsed > 0 else 0.0
+        if rate > 0:
+            eta = format_duration((self.number_windows - self.number_completed) / rate)
+        else:
+            eta = '--:--:--'
+
+        status = '[{}{}] {:5.1f}% {}/{} windows  {:.1f} windows/s  elapsed {}  ETA {}'.format(
+            '#' * filled, '.' * (self.bar_width - filled),
+            100 * fraction, self.number_completed, self.number_windows,
+            rate, format_duration(elapsed), eta)
+
+        if self.interactive:
+            self.stream.write('\r' + status)
+        else:
+            self.stream.write(status + '\n')
+        self.stream.flush()
+
+
+class PlotProgressReporter:
+
+    def __init__(self, max_redraw_rate=2.0):
+        self.minimum_redraw_interval = 1.0 / max_redraw_rate if max_redraw_rate > 0 else 0.0
+
+    def start(self, number_windows, before_height, after_height, template_size, search_size):
+        import matplotlib.pyplot as plt
+        import matplotlib.patches
+
+        self.plt = plt
+        self.figure = plt.figure()
+        before_axis = plt.subplot(1, 2, 1)
+        after_axis = plt.subplot(1, 2, 2)
+
+        # the rasters are drawn once; only the window outlines move afterwards
+        before_axis.set_title('Before')
+        before_axis.imshow(before_height, cmap=plt.cm.gray)
+        self.template_outline = matplotlib.patches.Rectangle(
+            (0, 0),
+            template_size-1,
+            template_size-1,
+            linewidth=1,
+            edgecolor='r',
+            fill=None)
+        before_axis.add_patch(self.template_outline)
+
+        after_axis.set_title('After')
+        after_axis.imshow(after_height, cmap=plt.cm.gray)
+        self.search_outline = matplotlib.patches.Rectangle(
+            (0, 0),
+            search_size-1,
+            search_size-1,
+            linewidth=1,
+            edgecolor='r',
+            fill=None)
+        after_axis.add_patch(self.search_outline)
+
+        self.last_redraw_time = None
+
+    def update(self, number_completed, template_location, search_location):
+        now = time.perf_counter()
+        if (self.last_redraw_time is not None and
+                now - self.last_redraw_time < self.minimum_redraw_interval):
+            return
+        self.last_redraw_time = now
+
+        self.template_outline.set_xy(template_location)
+        self.search_outline.set_xy(search_location)
+        self.figure.canvas.draw_idle()
+        self.plt.pause(0.001)
+
+    def finish(self):
+        self.plt.close(self.figure)
+
+
+def get_progress_reporter(progress, max_redraw_rate=2.0):
+    if progress == 'plot':
+        return PlotProgressReporter(max_redraw_rate)
+    elif progress == 'none':
+        return NullProgressReporter()
+    else:
+        return TextProgressReporter()
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
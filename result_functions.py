@@ -0,0 +1,309 @@
+import numpy as np
+import numpy.lib.recfunctions
+import struct
+import json
+import os
+
+
+# PIV results are stored as one record per vector in ground units:
+#   vectors:     x, y (vector origin), dx, dy (dy is positive down, as in the image),
+#                peak_height (normalized cross correlation at the peak) and
+#                peak_ratio (to the second highest peak, see piv_functions.get_peak_ratios)
+#   covariances: x, y (vector end location), 2x2 covariance matrix
+# The 'npy' format is a NumPy .npy file of structured records that is written
+# incrementally and can be memory mapped; the 'json' format is the original
+# list-of-lists layout ([x, y, dx, dy] rows and [[x, y], covariance] rows) and is
+# held in memory until the writer is closed. The peak heights and ratios of json
+# vectors are written as [peak_height, peak_ratio] rows to a separate file next
+# to them (see get_peak_file_name). The 'memory' format writes no file; the
+# records are kept for a PivResults object.
+
+vector_dtype = np.dtype([('x', 'f8'), ('y', 'f8'), ('dx', 'f8'), ('dy', 'f8'),
+                         ('peak_height', 'f8'), ('peak_ratio', 'f8')])
+covariance_dtype = np.dtype([('x', 'f8'), ('y', 'f8'), ('covariance', 'f8', (2,2))])
+
+# room for the largest possible record count, so the header can be rewritten in place
+npy_header_length = 256
+
+
+def get_result_file_name(output_base_name, result_name, output_format):
+
+    return output_base_name + result_name + '.' + output_format
+
+
+def get_peak_file_name(vector_file):
+
+    # vectors.json -> vectors_peaks.json
+    return vector_file[:-len('.json')] + '_peaks.json'
+
+
+def get_vector_records(piv_origins, piv_vectors, geo_transform, peak_heights=np.nan, peak_ratios=np.nan):
+
+    # Convert from pixels to ground distance
+    records = np.empty(len(piv_origins), dtype=vector_dtype)
+    records['peak_height'] = peak_heights
+    records['peak_ratio'] = peak_ratios
+    records['x'] = piv_origins[:,0]*geo_transform[0,0] + geo_transform[0,2]  # Scale by pixel ground size and offset by leftmost pixel
+    records['y'] = geo_transform[1,2] - piv_origins[:,1]*geo_transform[0,0]  # Subtract from uppermost pixel to get ground coordinate
+    records['dx'] = piv_vectors[:,0]*geo_transform[0,0]  # Scale by pixel ground size
+    records['dy'] = piv_vectors[:,1]*geo_transform[0,0]
+
+    return records
+
+
+def get_covariance_records(piv_origins, piv_vectors, peak_covariance, geo_transform):
+
+    vector_records = get_vector_records(piv_origins, piv_vectors, geo_transform)
+    records = np.empty(len(piv_origins), dtype=covariance_dtype)
+    records['x'] = vector_records['x'] + vector_records['dx']
+    records['y'] = vector_records['y'] - vector_records['dy']  # Subtract to convert from dV (positive down) to dY (positive up)
+    records['covariance'] = peak_covariance * geo_transform[0,0]**2  # Scale by squared pixel ground size
+
+    return records
+
+
+class NpyRecordWriter:
+
+    def __init__(self, file_name, dtype):
+        self.file_name = file_name
+        self.dtype = dtype
+        self.number_records = 0
+        self.file = open(file_name, 'wb')
+        write_npy_header(self.file, self.dtype, 0)
+
+    def write(self, records):
+        np.ascontiguousarray(records, dtype=self.dtype).tofile(self.file)
+        self.number_records += len(records)
+
+    def close(self):
+        self.file.seek(0)
+        write_npy_header(self.file, self.dtype, self.number_records)
+        self.file.close()
+
+
+class JsonRecordWriter:
+
+    def __init__(self, file_name, dtype):
+        self.file_name = file_name
+        self.dtype = dtype
+        self.records = []
+
+    def write(self, records):
+        self.records.append(np.asarray(records, dtype=self.dtype))
+
+    def close(self):
+        records = np.concatenate([np.empty(0, dtype=self.dtype)] + self.records)
+        with open(self.file_name, 'w') as json_file:
+            json.dump(records_to_json(records), json_file)
+        if self.dtype.names == vector_dtype.names:
+            with open(get_peak_file_name(self.file_name), 'w') as json_file:
+                json.dump(np.column_stack((records['peak_height'], records['peak_ratio'])).tolist(), json_file)
+
+
+class MemoryRecordWriter:
+
+    def __init__(self, file_name, dtype):
+        self.file_name = file_name
+        self.dtype = dtype
+        self.records = []
+
+    def write(self, records):
+        self.records.append(np.asarray(records, dtype=self.dtype))
+
+    def close(self):
+        self.records = np.concatenate([np.empty(0, dtype=self.dtype)] + self.records)
+
+
+def open_result_writer(file_name, dtype, output_format):
+
+    if output_format == 'json':
+        return JsonRecordWriter(file_name, dtype)
+    if output_format == 'memory':
+        return MemoryRecordWriter(file_name, dtype)
+    return NpyRecordWriter(file_name, dtype)
+
+
+class PivResults:
+
+    # The results of piv_functions.compute_piv: vector and (optional) covariance
+    # records as described above, plus the run metrics and the window grid the
+    # vectors lie on (a dict of the geo_transform, template_size, step_size and
+    # shape of the grid). Exporting and displaying them are separate steps.
+
+    def __init__(self, vector_records, covariance_records=None, metrics=None, window_grid=None):
+        self.vector_records = vector_records
+        self.covariance_records = covariance_records
+        self.metrics = metrics
+        self.window_grid = window_grid
+
+    def __len__(self):
+        return len(self.vector_records)
+
+    @property
+    def origins(self):
+        # (x, y) vector origins in ground coordinates
+        return np.column_stack((self.vector_records['x'], self.vector_records['y']))
+
+    @property
+    def vectors(self):
+        # (dx, dy) displacements in ground units, dy positive down
+        return np.column_stack((self.vector_records['dx'], self.vector_records['dy']))
+
+    @property
+    def peak_heights(self):
+        return self.vector_records['peak_height']
+
+    @property
+    def peak_ratios(self):
+        return self.vector_records['peak_ratio']
+
+    @property
+    def covariances(self):
+        # 2x2 covariance matrices of the vectors, or None without propagation
+        if self.covariance_records is None:
+            return None
+        return self.covariance_records['covariance']
+
+    def get_vector_grid(self):
+        # (rows, columns, 2) masked array of (dx, dy) on the window grid
+        import filter_functions
+
+        return filter_functions.get_vector_grid(self.vector_records, self.window_grid['geo_transform'],
+                                                self.window_grid['template_size'], self.window_grid['step_size'],
+                                                self.window_grid['shape'])
+
+    def filter_outliers(self, neighbourhood_size=3, threshold=2.0, replacement='remove'):
+        # new results with the outliers of the normalized median test removed or
+        # replaced (see filter_functions.filter_vector_records)
+        import filter_functions
+
+        vector_records, covariance_records, _ = filter_functions.filter_vector_records(
+            self.vector_records, self.covariance_records, self.window_grid['geo_transform'],
+            self.window_grid['template_size'], self.window_grid['step_size'],
+            neighbourhood_size, threshold, replacement)
+        return PivResults(vector_records, covariance_records, self.metrics, self.window_grid)
+
+    def save(self, output_base_name, output_format='npy'):
+        file_names = [get_result_file_name(output_base_name, 'vectors', output_format)]
+        if self.covariance_records is not None:
+            file_names.append(get_result_file_name(output_base_name, 'covariances', output_format))
+        for file_name, records in zip(file_names, (self.vector_records, self.covariance_records)):
+            writer = open_result_writer(file_name, records.dtype, output_format)
+            writer.write(records)
+            writer.close()
+        return file_names
+
+    def show(self, background_image, vector_scale_factor=1, ellipse_scale_factor=1):
+        import show_functions
+
+        show_functions.show(background_image, self.vector_records, self.covariance_records,
+                            vector_scale_factor, ellipse_scale_factor)
+
+
+def write_npy_header(file, dtype, number_records):
+
+    # NumPy format version 1.0 header padded to a fixed length
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), number_records)
+    header = header.ljust(npy_header_length - 10 - 1) + '\n'
+    file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+def records_to_json(records):
+
+    if records.dtype.names == vector_dtype.names:
+        return np.column_stack((records['x'], records['y'], records['dx'], records['dy'])).tolist()
+    return [[[x, y], covariance] for x, y, covariance in zip(records['x'].tolist(),
+                                                             records['y'].tolist(),
+                                                             records['covariance'].tolist())]
+
+
+def json_to_records(json_data, dtype, peak_data=None):
+
+    # peak_data holds the [peak_height, peak_ratio] rows of json vectors; the
+    # peak fields are NaN without it
+    records = np.empty(len(json_data), dtype=dtype)
+    if len(json_data) == 0:
+        return records
+    if dtype.names == vector_dtype.names:
+        json_array = np.asarray(json_data, dtype=float)
+        for i, name in enumerate(('x', 'y', 'dx', 'dy')):
+            records[name] = json_array[:,i]
+        if peak_data is None:
+            records['peak_height'] = np.nan
+            records['peak_ratio'] = np.nan
+        else:
+            peak_array = np.asarray(peak_data, dtype=float)
+            records['peak_height'] = peak_array[:,0]
+            records['peak_ratio'] = peak_array[:,1]
+    else:
+        records['x'] = [location_covariance[0][0] for location_covariance in json_data]
+        records['y'] = [location_covariance[0][1] for location_covariance in json_data]
+        records['covariance'] = [location_covariance[1] for location_covariance in json_data]
+
+    return records
+
+
+def read_records(file_name, dtype, mode='r'):
+
+    # .npy results are memory mapped, so only the fields that are used get read
+    if file_name.endswith('.json'):
+        with open(file_name) as json_file:
+            json_data = json.load(json_file)
+        peak_data = None
+        if dtype.names == vector_dtype.names and os.path.isfile(get_peak_file_name(file_name)):
+            with open(get_peak_file_name(file_name)) as json_file:
+                peak_data = json.load(json_file)
+        return json_to_records(json_data, dtype, peak_data)
+    return np.load(file_name, mmap_mode=mode)
+
+
+def read_vectors(file_name):
+
+    return read_records(file_name, vector_dtype)
+
+
+def read_covariances(file_name, mode='r'):
+
+    return read_records(file_name, covariance_dtype, mode)
+
+
+def get_series_records(records, before_epoch, after_epoch):
+
+    # records of one pair of a time series, tagged with the indices of their epochs
+    series_records = np.empty(len(records), dtype=[('before', 'i4'), ('after', 'i4')] + records.dtype.descr)
+    series_records['before'] = before_epoch
+    series_records['after'] = after_epoch
+    for name in records.dtype.names:
+        series_records[name] = records[name]
+
+    return series_records
+
+
+def write_series(file_name, epoch_files, pairs, vector_records, covariance_records=None):
+
+    # A time series file is an uncompressed .npz archive of the epoch DEM file
+    # names, the (before, after) epoch indices of each pair and the vector (and
+    # covariance) records of all pairs stacked in pair order, each record tagged
+    # with its 'before' and 'after' epoch indices
+    series_arrays = {'epochs': np.asarray(epoch_files, dtype=str),
+                     'pairs': np.asarray(pairs, dtype=int).reshape(-1, 2),
+                     'vectors': vector_records}
+    if covariance_records is not None:
+        series_arrays['covariances'] = covariance_records
+    np.savez(file_name, **series_arrays)
+
+
+def read_series(file_name):
+
+    # dict of the arrays of a time series file (see write_series)
+    with np.load(file_name) as series_file:
+        return {name: series_file[name] for name in series_file.files}
+
+
+def select_series_pair(series_records, before_epoch, after_epoch):
+
+    # the records of one pair, with the vector_dtype or covariance_dtype fields
+    pair_records = series_records[(series_records['before'] == before_epoch) & (series_records['after'] == after_epoch)]
+    return numpy.lib.recfunctions.repack_fields(
+        pair_records[[name for name in pair_records.dtype.names if name not in ('before', 'after')]])
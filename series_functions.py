@@ -0,0 +1,246 @@
+import numpy as np
+import sys
+import math
+import time
+import itertools
+import scipy.fft
+import progress_functions
+import result_functions
+import metrics_functions
+import boundary_functions
+import piv_functions
+
+
+# PIV over a time series of DEMs (epochs) of the same grid. The epochs are read
+# strip by strip, together, and every window row is computed for all pairs of
+# epochs before moving on, so the work that only depends on one DEM is done once
+# per epoch instead of once per pair: reading the strip, its summed-area tables
+# and window statistics, the spectra of its templates and search areas and its
+# bias pass vectors (see the epoch_caches of piv_functions.run_piv_tile). The
+# results of all pairs are written to a single time series file (see
+# result_functions.write_series).
+
+pair_modes = ['consecutive', 'all']
+# number of windows whose template spectra are kept for the pairs of each DEM,
+# which bounds the memory of the shared work; the rows of a tile are computed
+# in groups of about this many windows
+cached_windows = 2**12
+
+
+def get_epoch_pairs(number_epochs, pair_mode):
+
+    # (before, after) epoch indices, in time order
+    if pair_mode == 'consecutive':
+        return [(epoch, epoch+1) for epoch in range(number_epochs-1)]
+    return list(itertools.combinations(range(number_epochs), 2))
+
+
+def series(height_files, uncertainty_files,
+           template_size, step_size, pair_mode, output_base_name,
+           progress_reporter=None, jacobian_method='analytic',
+           min_overlap=1.0, boundary_file=None, min_peak_ratio=1.0,
+           precision='float64', fft_workers=1, montecarlo_realizations=None,
+           montecarlo_seed=0):
+
+    if progress_reporter is None:
+        progress_reporter = progress_functions.TextProgressReporter()
+
+    # every epoch must be on the grid of the first
+    for height_file in height_files[1:]:
+        geo_transform = piv_functions.get_geo_transform(height_files[0], height_file)
+    propagate = len(uncertainty_files) > 0
+
+    if boundary_file:
+        window_selection = piv_functions.get_window_selection(
+            boundary_functions.read_boundary_mask(boundary_file, height_files[0]),
+            template_size, step_size)
+        if not window_selection.any():
+            print("No PIV windows are centered inside the boundary in '{}'.".format(boundary_file))
+            sys.exit()
+    else:
+        window_selection = None
+
+    pairs = get_epoch_pairs(len(height_files), pair_mode)
+    options = piv_functions.get_piv_options(template_size, step_size, propagate, jacobian_method,
+                                            min_overlap=min_overlap, min_peak_ratio=min_peak_ratio,
+                                            precision=precision,
+                                            montecarlo_realizations=montecarlo_realizations,
+                                            montecarlo_seed=montecarlo_seed)
+    if propagate:
+        print("Computing PIV, bias variance and propagating uncertainty for {} pairs of {} DEMs.".format(len(pairs), len(height_files)))
+    else:
+        print("Computing PIV for {} pairs of {} DEMs.".format(len(pairs), len(height_files)))
+    series_result = run_series(height_files, uncertainty_files if propagate else [[]]*len(height_files),
+                               geo_transform, pairs, options, progress_reporter,
+                               window_selection, fft_workers)
+
+    series_file = output_base_name + 'series.npz'
+    result_functions.write_series(series_file, height_files, pairs,
+                                  series_result['vector_records'], series_result['covariance_records'])
+    print("PIV time series of {} pairs saved to file '{}'".format(len(pairs), series_file))
+    metrics_file = output_base_name + 'series_metrics.json'
+    metrics_functions.write_metrics(metrics_file, series_result['metrics'])
+    print("PIV metrics saved to file '{}'".format(metrics_file))
+
+
+def run_series(heights, uncertainties, geo_transform, pairs, options,
+               progress_reporter=None, window_selection=None, fft_workers=1):
+
+    # PIV of every (before, after) pair of epochs with the options of
+    # piv_functions.get_piv_options, without pyramid levels. heights and
+    # uncertainties are lists of GeoTIFF file names or in-memory arrays, one per
+    # epoch (an empty list for a missing uncertainty). Returns a dict of the
+    # stacked vector and covariance (None without propagate) series records, with
+    # the bias variance of its 'before' epoch added to each pair's covariances,
+    # and the run metrics.
+    if progress_reporter is None:
+        progress_reporter = progress_functions.NullProgressReporter()
+    run_start = time.perf_counter()
+    template_size = options['template_size']
+    step_size = options['step_size']
+    propagate = options['propagate']
+    precision = options['precision']
+
+    number_rows, number_columns = piv_functions.get_raster_shape(heights[0])
+    number_vertical_computations, number_horizontal_computations = piv_functions.get_window_grid_shape(
+        (number_rows, number_columns), template_size, step_size)
+    search_size = template_size * 2
+    if window_selection is None:
+        window_selection = np.ones((number_vertical_computations, number_horizontal_computations), dtype=bool)
+    selected_windows = np.cumsum(np.count_nonzero(window_selection, axis=1))
+
+    progress_reporter.start(int(selected_windows[-1])*len(pairs) if selected_windows.size else 0,
+                            heights[0], heights[-1], template_size, search_size)
+
+    # the tiles of a serial run_piv, so each pair gets the vectors piv would give it
+    rows_per_tile = 4 * math.ceil(search_size / step_size)
+    tiles = piv_functions.get_tiles(number_vertical_computations, rows_per_tile, [],
+                                    window_selection.any(axis=1))
+    row_ranges = [piv_functions.get_tile_raster_rows(vt_counts, template_size, step_size, number_rows)
+                  for vt_counts in tiles]
+    # each epoch is read once, strip by strip
+    height_strips = zip(*[piv_functions.iterate_raster_strips(height, row_ranges, True, precision)
+                          for height in heights])
+    uncertainty_strips = zip(*[piv_functions.iterate_raster_strips(uncertainty, row_ranges, False, precision)
+                               for uncertainty in uncertainties])
+
+    metrics = metrics_functions.new_metrics()
+    metrics_functions.add_skipped(metrics, 'outside_boundary', np.count_nonzero(~window_selection)*len(pairs))
+    pair_tile_results = [[] for _ in pairs]
+    run_metrics = metrics_functions.new_metrics()
+    stage_start = time.perf_counter()
+    with scipy.fft.set_workers(fft_workers):
+        for vt_counts, row_range, epoch_heights, epoch_uncertainties in zip(tiles, row_ranges, height_strips, uncertainty_strips):
+            stage_start = metrics_functions.add_stage_time(run_metrics, 'read', stage_start)
+            for pair_index, tile_result in run_series_tile(
+                    epoch_heights, epoch_uncertainties, row_range[0], vt_counts, pairs,
+                    number_horizontal_computations, options,
+                    piv_functions.get_tile_predictors(window_selection, vt_counts)):
+                metrics_functions.merge_metrics(metrics, tile_result['metrics'])
+                pair_tile_results[pair_index].append(tile_result)
+            stage_start = metrics_functions.add_stage_time(run_metrics, 'tiles', stage_start)
+            last_vt_count = vt_counts[-1]
+            progress_reporter.update(int(selected_windows[last_vt_count])*len(pairs),
+                                     (int((number_horizontal_computations-1)*step_size + math.ceil(template_size/2)), int(last_vt_count*step_size + math.ceil(template_size/2))),
+                                     (int((number_horizontal_computations-1)*step_size), int(last_vt_count*step_size)))
+
+    progress_reporter.finish()
+
+    vector_records = []
+    covariance_records = []
+    pair_metrics = []
+    for (before_epoch, after_epoch), tile_results in zip(pairs, pair_tile_results):
+        pair_result = get_pair_records(tile_results, geo_transform, propagate)
+        vector_records.append(result_functions.get_series_records(pair_result['vector_records'], before_epoch, after_epoch))
+        if propagate:
+            covariance_records.append(result_functions.get_series_records(pair_result['covariance_records'], before_epoch, after_epoch))
+        pair_metrics.append({'before': before_epoch, 'after': after_epoch,
+                             'vectors': len(pair_result['vector_records'])})
+    stage_start = metrics_functions.add_stage_time(run_metrics, 'records', stage_start)
+
+    # the tile stage seconds are summed over all pairs, the run seconds are wall clock
+    series_metrics = {
+        'template_size': template_size,
+        'step_size': step_size,
+        'epochs': len(heights),
+        'windows': number_horizontal_computations * number_vertical_computations,
+        'pairs': pair_metrics,
+        'skipped': metrics['skipped'],
+        'tile_stage_seconds': metrics['seconds'],
+        'run_seconds': dict(run_metrics['seconds'], total=time.perf_counter() - run_start)}
+
+    return {'vector_records': np.concatenate(vector_records),
+            'covariance_records': np.concatenate(covariance_records) if propagate else None,
+            'metrics': series_metrics}
+
+
+def run_series_tile(epoch_heights, epoch_uncertainties, strip_row_start, vt_counts, pairs,
+                    number_horizontal_computations, options, window_selection=None):
+
+    # Yields (pair index, run_piv_tile result) for the window rows of a tile and
+    # every pair. The strip statistics of each epoch are shared by all rows and
+    # pairs of the tile; the template and search spectra and bias vectors of a
+    # row are shared by the pairs and dropped once the row is done. The search
+    # spectra of a DEM are only kept when more than one correlation searches it:
+    # the pairs it is the 'after' DEM of, and its bias pass with propagate.
+    # The rows are computed in groups (see cached_windows), whose results are
+    # merged into one result per pair, so the running bias statistics are
+    # updated tile by tile as in run_piv.
+    search_uses = [sum(after_epoch == epoch for _, after_epoch in pairs) +
+                   (options['propagate'] and any(before_epoch == epoch for before_epoch, _ in pairs))
+                   for epoch in range(len(epoch_heights))]
+    epoch_caches = [{'share_search_spectra': uses > 1} for uses in search_uses]
+    rows_per_group = max(1, cached_windows // number_horizontal_computations)
+    group_results = [[] for _ in pairs]
+    for group_start in range(0, len(vt_counts), rows_per_group):
+        group_rows = slice(group_start, group_start + rows_per_group)
+        for pair_index, (before_epoch, after_epoch) in enumerate(pairs):
+            group_results[pair_index].append(piv_functions.run_piv_tile(
+                epoch_heights[before_epoch], epoch_uncertainties[before_epoch],
+                epoch_heights[after_epoch], epoch_uncertainties[after_epoch],
+                strip_row_start, vt_counts[group_rows], number_horizontal_computations,
+                options,
+                window_selection=None if window_selection is None else window_selection[group_rows],
+                epoch_caches=(epoch_caches[before_epoch], epoch_caches[after_epoch])))
+        for epoch_cache in epoch_caches:
+            epoch_cache.pop('rows', None)
+    for pair_index, tile_results in enumerate(group_results):
+        yield pair_index, merge_tile_results(tile_results)
+
+
+def merge_tile_results(tile_results):
+
+    # one run_piv_tile result for the consecutive rows of several results
+    if len(tile_results) == 1:
+        return tile_results[0]
+    merged_result = {'last_vt_count': tile_results[-1]['last_vt_count'],
+                     'metrics': metrics_functions.new_metrics()}
+    for tile_result in tile_results:
+        metrics_functions.merge_metrics(merged_result['metrics'], tile_result['metrics'])
+    for name in tile_results[0]:
+        if name not in merged_result:
+            merged_result[name] = np.concatenate([tile_result[name] for tile_result in tile_results])
+    return merged_result
+
+
+def get_pair_records(tile_results, geo_transform, propagate):
+
+    # vector and covariance records of one pair from its run_piv_tile results,
+    # with the bias variance added to the covariances
+    vector_records = np.concatenate([result_functions.get_vector_records(
+        tile_result['origins'], tile_result['vectors'], geo_transform,
+        tile_result['peak_heights'], tile_result['peak_ratios'])
+        for tile_result in tile_results] + [np.empty(0, dtype=result_functions.vector_dtype)])
+    if not propagate:
+        return {'vector_records': vector_records, 'covariance_records': None}
+
+    covariance_records = np.concatenate([result_functions.get_covariance_records(
+        tile_result['origins'], tile_result['vectors'],
+        tile_result['covariances'], geo_transform)
+        for tile_result in tile_results] + [np.empty(0, dtype=result_functions.covariance_dtype)])
+    bias_statistics = {'count': 0, 'mean': np.zeros(2), 'm2': np.zeros(2)}
+    for tile_result in tile_results:
+        piv_functions.update_vector_statistics(bias_statistics, tile_result['bias_vectors']*geo_transform[0,0])
+    piv_functions.add_bias_variance_to_records(covariance_records, piv_functions.get_bias_variance(bias_statistics))
+
+    return {'vector_records': vector_records, 'covariance_records': covariance_records}
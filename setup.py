@@ -6,7 +6,7 @@ setup(
     description='Geospatial PIV with uncertainty propagation',
     author='Preston Hartzell',
     author_email='preston.hartzell@gmail.com',
-    py_modules=['gpiv', 'piv_functions', 'show_functions'],
+    py_modules=['gpiv', 'piv_functions', 'show_functions', 'progress_functions', 'result_functions', 'checkpoint_functions', 'metrics_functions', 'boundary_functions', 'filter_functions', 'series_functions', 'batch_functions'],
     entry_points='''
         [console_scripts]
         gpiv=gpiv:cli
@@ -1,12 +1,28 @@
 import rasterio
 import rasterio.plot
+import os
+import sys
+import matplotlib
+if not os.environ.get('MPLBACKEND') and sys.platform.startswith('linux') and not (
+        os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+    # without a display (batch jobs, servers) matplotlib would otherwise try, and
+    # fail, to load each interactive backend in turn before falling back to Agg
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
-import math
-from matplotlib.patches import FancyArrow
 from matplotlib.patches import Ellipse
 from matplotlib.patches import Rectangle
-import json
+from matplotlib.collections import EllipseCollection
+import result_functions
+
+
+figure_size = 6 # inches
+# The background is read at twice the pixel size of the figure on screen, which
+# leaves room to zoom in a little before it looks blocky; larger images are
+# decimated when read
+display_oversampling = 2
+# number of background pixels used for the contrast limits
+contrast_sample_size = 2**16
 
 
 def show(image_file, vector_file, ellipse_file, vector_scale_factor, ellipse_scale_factor):
@@ -23,27 +39,52 @@ def show(image_file, vector_file, ellipse_file, vector_scale_factor, ellipse_sca
             ellipse_scale_factor = 1
         plot_ellipses(axes, image_geo_extents, ellipse_file, ellipse_scale_factor)
 
+    # the quiver and ellipse collections would otherwise stretch the axes to fit
+    # arrows and ellipses drawn past the image edges
+    axes.set_xlim(image_geo_extents[0], image_geo_extents[1])
+    axes.set_ylim(image_geo_extents[2], image_geo_extents[3])
+
     plt.show()
 
 
 def get_image_array(image_file):
 
+    # Band 1 at no more than the display resolution. GDAL serves decimated reads
+    # from the GeoTIFF overviews when there are any, so large backgrounds with
+    # overviews are read quickly; without overviews the rows and columns needed
+    # are sampled from the full resolution band.
     image_source = rasterio.open(image_file)
-    image_array = image_source.read(1)
-    image_geo_transform = np.reshape(np.asarray(image_source.transform), (3,3))
+    display_size = int(figure_size * plt.rcParams['figure.dpi'] * display_oversampling)
+    decimation = max(1, max(image_source.height, image_source.width) / display_size)
+    out_shape = (max(1, round(image_source.height / decimation)),
+                 max(1, round(image_source.width / decimation)))
+    image_array = image_source.read(1, out_shape=out_shape)
+    image_geo_transform = np.reshape(np.asarray(image_source.transform * rasterio.Affine.scale(
+        image_source.width / out_shape[1], image_source.height / out_shape[0])), (3,3))
     image_geo_extents = list(rasterio.plot.plotting_extent(image_source)) # [left, right, bottom, top]
     image_source.close()
 
     return image_array, image_geo_extents, image_geo_transform
 
 
+def get_contrast_limits(image_array):
+
+    # 1st and 99th percentiles of an evenly spaced sample of the finite pixels
+    sample = image_array.ravel()[::max(1, image_array.size // contrast_sample_size)]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return None, None
+    image_data_min, image_data_max = np.percentile(sample, [1, 99])
+
+    return image_data_min, image_data_max
+
+
 def plot_image(image_array, image_geo_extents):
 
-    figure = plt.figure(figsize=(6,6))
+    figure = plt.figure(figsize=(figure_size, figure_size))
     axes = plt.gca()
 
-    image_data_min = min(np.percentile(image_array, 1), np.percentile(image_array, 1))
-    image_data_max = max(np.percentile(image_array, 99), np.percentile(image_array, 99))
+    image_data_min, image_data_max = get_contrast_limits(image_array)
     plt.imshow(image_array,
                cmap=plt.cm.gray,
                extent=image_geo_extents,
@@ -55,34 +96,30 @@ def plot_image(image_array, image_geo_extents):
 
 def plot_vectors(axes, image_geo_extents, vector_file, user_scale_factor):
 
-    with open(vector_file) as json_file:
-        origins_vectors = json.load(json_file)
-    origins_vectors_numpy = np.asarray(origins_vectors)
+    # a file written by 'piv' or the records of a PivResults object
+    if isinstance(vector_file, str):
+        vector_records = result_functions.read_vectors(vector_file)
+    else:
+        vector_records = vector_file
+    origins_vectors = np.column_stack((vector_records['x'], vector_records['y'],
+                                       vector_records['dx'], vector_records['dy']))
 
     plot_width_in_pixels = axes.get_window_extent().width
     plot_width_in_ground_units = image_geo_extents[1] - image_geo_extents[0]
     pixels_per_ground_unit = plot_width_in_pixels / plot_width_in_ground_units
     ground_units_per_pixel = plot_width_in_ground_units / plot_width_in_pixels
 
-    vector_lengths_ground = np.linalg.norm(origins_vectors_numpy[:,2:], axis=1)
+    vector_lengths_ground = np.linalg.norm(origins_vectors[:,2:], axis=1)
     vector_lengths_pixels = vector_lengths_ground * pixels_per_ground_unit
 
     arrow_scale_factor = (30*ground_units_per_pixel) / np.median(vector_lengths_ground)
-    arrow_head_scale_factor = 8*ground_units_per_pixel
-
-    for i in range(len(origins_vectors)):
-        arrow = FancyArrow(
-            origins_vectors[i][0],
-            origins_vectors[i][1],
-            origins_vectors[i][2] * arrow_scale_factor * user_scale_factor,
-            -origins_vectors[i][3] * arrow_scale_factor * user_scale_factor,  # Negative sign converts from dV (positive down) to dY (positive up)
-            length_includes_head=True,
-            head_width=arrow_head_scale_factor,
-            overhang=0.8,
-            fc='yellow',
-            ec = 'yellow'
-        )
-        axes.add_artist(arrow)
+
+    draw_arrows(axes,
+                origins_vectors[:,0],
+                origins_vectors[:,1],
+                origins_vectors[:,2] * arrow_scale_factor * user_scale_factor,
+                -origins_vectors[:,3] * arrow_scale_factor * user_scale_factor,  # Negative sign converts from dV (positive down) to dY (positive up)
+                ground_units_per_pixel)
     
     geo_height = image_geo_extents[3] - image_geo_extents[2]
     legend_background = Rectangle((image_geo_extents[0] + geo_height/50, image_geo_extents[2] + geo_height/50),
@@ -93,49 +130,54 @@ def plot_vectors(axes, image_geo_extents, vector_file, user_scale_factor):
              image_geo_extents[2] + geo_height/7,
              '{0:.3f}'.format(np.median(vector_lengths_ground)/user_scale_factor),
              horizontalalignment='center', verticalalignment='top')
-    arrow = FancyArrow(
-        image_geo_extents[0] + geo_height/50 + (geo_height/7 - 30*ground_units_per_pixel)/2,
-        image_geo_extents[2] + geo_height/14,
-        30*ground_units_per_pixel, 0,
-        length_includes_head=True, head_width=arrow_head_scale_factor,
-        overhang=0.8, fc='yellow', ec = 'yellow')
-    axes.add_artist(arrow)
+    draw_arrows(axes,
+                np.array([image_geo_extents[0] + geo_height/50 + (geo_height/7 - 30*ground_units_per_pixel)/2]),
+                np.array([image_geo_extents[2] + geo_height/14]),
+                np.array([30*ground_units_per_pixel]), np.array([0]),
+                ground_units_per_pixel)
+
+
+def draw_arrows(axes, x, y, dx, dy, ground_units_per_pixel):
+
+    # All arrows are drawn by a single quiver in ground units, styled like the
+    # FancyArrows it replaces: a hairline shaft outlined in yellow and a swept
+    # back head (overhang 0.8) 8 plot pixels wide and 12 long that is included
+    # in the arrow length. Quiver head sizes are multiples of the shaft width.
+    shaft_width = ground_units_per_pixel / 10
+    axes.quiver(x, y, dx, dy,
+                angles='xy', scale_units='xy', scale=1,
+                units='xy', width=shaft_width,
+                headwidth=80, headlength=120, headaxislength=120*(1-0.8),
+                color='yellow', edgecolor='yellow', linewidth=1, zorder=2)
 
 
 def plot_ellipses(axes, image_geo_extents, ellipse_file, user_scale_factor):
 
-    with open(ellipse_file) as json_file:
-        locations_covariances = json.load(json_file)
-    
+    if isinstance(ellipse_file, str):
+        covariance_records = result_functions.read_covariances(ellipse_file)
+    else:
+        covariance_records = ellipse_file
+
     plot_width_in_pixels = axes.get_window_extent().width
     plot_width_in_ground_units = image_geo_extents[1] - image_geo_extents[0]
     pixels_per_ground_unit = plot_width_in_pixels / plot_width_in_ground_units
     ground_units_per_pixel = plot_width_in_ground_units / plot_width_in_pixels
 
-    semimajor_lengths_ground = []
-    semimajor_lengths_pixels = []
-    for i in range(len(locations_covariances)):
-        eigenvalues, eigenvectors = np.linalg.eig(locations_covariances[i][1])
-        max_index = np.argmax(eigenvalues)
-        semimajor_lengths_ground.append(math.sqrt(2.298*eigenvalues[max_index]))
+    semimajor_lengths_ground, semiminor_lengths_ground, angles = get_ellipse_axes(
+        np.asarray(covariance_records['covariance']))
     ellipse_scale_factor = (20*ground_units_per_pixel) / np.median(semimajor_lengths_ground)
 
-    for i in range(len(locations_covariances)):
-        eigenvalues, eigenvectors = np.linalg.eig(locations_covariances[i][1])
-        max_index = np.argmax(eigenvalues)
-        min_index = np.argmin(eigenvalues)
-        semimajor = math.sqrt(2.298*eigenvalues[max_index])
-        semiminor = math.sqrt(2.298*eigenvalues[min_index])
-        my_angle = np.degrees(np.arctan(eigenvectors[max_index][1]/eigenvectors[max_index][0]))
-        ellipse = Ellipse(
-            (locations_covariances[i][0][0], locations_covariances[i][0][1]),
-            semimajor * ellipse_scale_factor * user_scale_factor,
-            semiminor * ellipse_scale_factor * user_scale_factor,
-            angle=my_angle,
-            fc='None',
-            ec='red'
-        )
-        axes.add_artist(ellipse)
+    ellipses = EllipseCollection(
+        semimajor_lengths_ground * ellipse_scale_factor * user_scale_factor,
+        semiminor_lengths_ground * ellipse_scale_factor * user_scale_factor,
+        angles,
+        units='xy',
+        offsets=np.column_stack((covariance_records['x'], covariance_records['y'])),
+        offset_transform=axes.transData,
+        facecolors='none',
+        edgecolors='red',
+        zorder=2)
+    axes.add_collection(ellipses)
 
     geo_height = image_geo_extents[3] - image_geo_extents[2]
     legend_background = Rectangle((image_geo_extents[0] + geo_height/50 + geo_height/7 + geo_height/50,
@@ -149,4 +191,24 @@ def plot_ellipses(axes, image_geo_extents, ellipse_file, user_scale_factor):
     ell = Ellipse((image_geo_extents[0] + geo_height/50 + geo_height/7 + geo_height/50 + geo_height/14, image_geo_extents[2] + geo_height/14),
                    20*ground_units_per_pixel, 20*ground_units_per_pixel, 
                    ec='red', fc='none', clip_on=False)
-    axes.add_artist(ell)
\ No newline at end of file
+    axes.add_artist(ell)
+
+
+def get_ellipse_axes(covariances):
+
+    # Closed-form eigen decomposition of a stack of symmetric 2x2 covariance
+    # matrices [[a, b], [b, c]]: the eigenvalues are (a+c)/2 +- sqrt(((a-c)/2)**2 + b**2)
+    # and the major axis is at 0.5*atan2(2b, a-c) from the x axis. The covariances
+    # are of (dx, dy) with dy positive down, so the angle is negated for the y up
+    # plot. Returns the 95% confidence (chi-square 2.298 scaled) semimajor and
+    # semiminor lengths and the angles in degrees.
+    a = covariances[:,0,0]
+    b = covariances[:,0,1]
+    c = covariances[:,1,1]
+    mean = (a + c) / 2
+    radius = np.hypot((a - c) / 2, b)
+    semimajor_lengths = np.sqrt(2.298*(mean + radius))
+    semiminor_lengths = np.sqrt(2.298*np.maximum(mean - radius, 0))
+    angles = -np.degrees(0.5*np.arctan2(2*b, a - c))
+
+    return semimajor_lengths, semiminor_lengths, angles
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import pytest
+import rasterio
+import scipy.ndimage
+
+
+# the gpiv modules are top-level modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_raster(file_name, band):
+
+    with rasterio.open(file_name, 'w', driver='GTiff', width=band.shape[1], height=band.shape[0],
+                       count=1, dtype=band.dtype, transform=rasterio.Affine(2.0, 0.0, 1000.0, 0.0, -2.0, 5000.0)) as raster:
+        raster.write(band, 1)
+
+
+@pytest.fixture
+def dem_files(tmp_path):
+
+    # a small synthetic DEM pair with uncertainty rasters: smooth random terrain
+    # moved 1.5 pixels right and 1 pixel down, so the whole window grid finds the
+    # same displacement
+    random_generator = np.random.default_rng(1)
+    terrain = 50 * scipy.ndimage.gaussian_filter(random_generator.normal(size=(130, 130)), 3)
+    before_height = terrain[4:124, 4:124]
+    after_height = scipy.ndimage.shift(terrain, (1, 1.5), order=3)[4:124, 4:124]
+    files = {'before_height': str(tmp_path / 'before_height.tif'),
+             'after_height': str(tmp_path / 'after_height.tif'),
+             'before_uncertainty': str(tmp_path / 'before_uncertainty.tif'),
+             'after_uncertainty': str(tmp_path / 'after_uncertainty.tif')}
+    write_raster(files['before_height'], before_height)
+    write_raster(files['after_height'], after_height)
+    write_raster(files['before_uncertainty'], np.full(before_height.shape, 0.1))
+    write_raster(files['after_uncertainty'], 0.1 + 0.05*random_generator.random(after_height.shape))
+
+    return files
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import rasterio
+import batch_functions
+
+
+# Batch results are cached under a key of the input file contents and the options
+# that change the results, and the least recently used results are evicted when
+# the cache grows over its size limit.
+
+
+def read_job(tmp_path, **options):
+
+    job = dict({'before': 'before_height.tif', 'after': 'after_height.tif',
+                'template_size': 8, 'step_size': 4}, **options)
+    manifest_file = str(tmp_path / 'batch.json')
+    with open(manifest_file, 'w') as json_file:
+        json.dump({'jobs': [job]}, json_file)
+    return batch_functions.read_batch_manifest(manifest_file)[0]
+
+
+def get_job_key(tmp_path, **options):
+
+    return batch_functions.get_cache_key(batch_functions.get_cache_manifest(read_job(tmp_path, **options), {}))
+
+
+def test_cache_key_follows_input_contents(dem_files, tmp_path):
+
+    key = get_job_key(tmp_path)
+    assert get_job_key(tmp_path, name='other', outname='elsewhere') == key
+
+    # a copy of an input under another name has the same key
+    shutil.copyfile(dem_files['before_height'], tmp_path / 'copy.tif')
+    assert get_job_key(tmp_path, before='copy.tif') == key
+
+    # an edited DEM under the same name does not
+    with rasterio.open(dem_files['before_height'], 'r+') as raster:
+        raster.write(raster.read(1) + 1.0, 1)
+    assert get_job_key(tmp_path) != key
+
+
+def test_cache_key_follows_result_options(dem_files, tmp_path):
+
+    key = get_job_key(tmp_path)
+    changed_keys = [get_job_key(tmp_path, template_size=10),
+                    get_job_key(tmp_path, step_size=8),
+                    get_job_key(tmp_path, min_peak_ratio=1.1),
+                    get_job_key(tmp_path, min_overlap=0.8),
+                    get_job_key(tmp_path, precision='float32'),
+                    get_job_key(tmp_path, levels=2),
+                    get_job_key(tmp_path, format='json')]
+    assert key not in changed_keys
+    assert len(set(changed_keys)) == len(changed_keys)
+
+    # options that do not change the results, or only apply with other options
+    assert get_job_key(tmp_path, stream=True, fft_workers=4) == key
+    assert get_job_key(tmp_path, jacobian='numeric', prop_mode='montecarlo', seed=3) == key
+    assert get_job_key(tmp_path, search_radius=5) == key
+    assert get_job_key(tmp_path, levels=2, search_radius=5) != get_job_key(tmp_path, levels=2)
+
+
+def test_cache_key_follows_uncertainty_files(dem_files, tmp_path):
+
+    key = get_job_key(tmp_path)
+    prop = ['before_uncertainty.tif', 'after_uncertainty.tif']
+    prop_key = get_job_key(tmp_path, prop=prop)
+    assert prop_key != key
+    assert get_job_key(tmp_path, prop=prop[::-1]) != prop_key
+    assert get_job_key(tmp_path, prop=prop, jacobian='numeric') != prop_key
+    montecarlo_key = get_job_key(tmp_path, prop=prop, prop_mode='montecarlo')
+    assert montecarlo_key != prop_key
+    assert get_job_key(tmp_path, prop=prop, prop_mode='montecarlo', seed=3) != montecarlo_key
+    assert get_job_key(tmp_path, prop=prop, prop_mode='montecarlo', realizations=50) != montecarlo_key
+
+    with rasterio.open(dem_files['after_uncertainty'], 'r+') as raster:
+        raster.write(2*raster.read(1), 1)
+    assert get_job_key(tmp_path, prop=prop) != prop_key
+    assert get_job_key(tmp_path) == key
+
+
+def test_file_hashes_are_reused_until_the_file_changes(dem_files, tmp_path):
+
+    hash_index = {}
+    file_hash = batch_functions.get_indexed_sha256(dem_files['before_height'], hash_index)
+    indexed = hash_index[os.path.abspath(dem_files['before_height'])]
+    # a stale hash is returned while the size and modification time are unchanged
+    indexed['sha256'] = 'stale'
+    assert batch_functions.get_indexed_sha256(dem_files['before_height'], hash_index) == 'stale'
+    file_status = os.stat(dem_files['before_height'])
+    os.utime(dem_files['before_height'], ns=(file_status.st_atime_ns, file_status.st_mtime_ns + 10**9))
+    assert batch_functions.get_indexed_sha256(dem_files['before_height'], hash_index) == file_hash
+
+
+def add_cache_entry(cache_directory, key, number_bytes, last_used):
+
+    entry_directory = os.path.join(cache_directory, key)
+    os.makedirs(entry_directory)
+    with open(os.path.join(entry_directory, 'vectors.npy'), 'wb') as result_file:
+        result_file.write(b'\0' * (number_bytes - 2))
+    with open(os.path.join(entry_directory, batch_functions.entry_manifest_name), 'w') as manifest_file:
+        manifest_file.write('{}')
+    os.utime(os.path.join(entry_directory, batch_functions.entry_manifest_name), (last_used, last_used))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+
+    cache_directory = str(tmp_path / 'cache')
+    for key, last_used in (('c', 3000), ('a', 1000), ('d', 4000), ('b', 2000)):
+        add_cache_entry(cache_directory, key, 1000, last_used)
+    # unfinished jobs and the hash index are not cache entries
+    os.makedirs(os.path.join(cache_directory, 'e.partial'))
+    with open(os.path.join(cache_directory, 'e.partial', 'vectors.npy'), 'wb') as result_file:
+        result_file.write(b'\0' * 5000)
+    with open(os.path.join(cache_directory, batch_functions.hash_index_name), 'w') as json_file:
+        json_file.write('{}')
+
+    assert sorted(entry['bytes'] for entry in batch_functions.get_cache_entries(cache_directory)) == [1000] * 4
+    assert batch_functions.evict_cache_entries(cache_directory, 4000) == 0
+    assert batch_functions.evict_cache_entries(cache_directory, 2500) == 2
+    assert sorted(entry['key'] for entry in batch_functions.get_cache_entries(cache_directory)) == ['c', 'd']
+    assert os.path.isdir(os.path.join(cache_directory, 'e.partial'))
+
+    # the entry just stored is kept even if it is the least recently used
+    add_cache_entry(cache_directory, 'f', 1000, 500)
+    assert batch_functions.evict_cache_entries(cache_directory, 2000, kept_key='f') == 1
+    assert sorted(entry['key'] for entry in batch_functions.get_cache_entries(cache_directory)) == ['d', 'f']
+    assert batch_functions.evict_cache_entries(cache_directory, 0, kept_key='f') == 1
+    assert [entry['key'] for entry in batch_functions.get_cache_entries(cache_directory)] == ['f']
@@ -0,0 +1,85 @@
+import json
+import os
+import pytest
+import rasterio
+import piv_functions
+import progress_functions
+
+
+# An interrupted run resumed from its checkpoint must write the same files as an
+# uninterrupted run, and a checkpoint must not be resumed with other inputs or
+# parameters.
+
+
+class RunInterrupted(Exception):
+    pass
+
+
+class InterruptingProgressReporter(progress_functions.NullProgressReporter):
+
+    # stops the run after the first tile has been saved to the checkpoint
+    def update(self, number_completed, template_location, search_location):
+        raise RunInterrupted()
+
+
+def run_interrupted_piv(dem_files, output_base_name, template_size=8, step_size=4):
+
+    with pytest.raises(RunInterrupted):
+        run_piv_files(dem_files, output_base_name, template_size, step_size,
+                      progress_reporter=InterruptingProgressReporter())
+    assert len(os.listdir(output_base_name + 'checkpoint')) == 2 # manifest and one tile
+
+
+def run_piv_files(dem_files, output_base_name, template_size=8, step_size=4, **arguments):
+
+    piv_functions.piv(dem_files['before_height'], dem_files['after_height'],
+                      template_size, step_size,
+                      dem_files['before_uncertainty'], dem_files['after_uncertainty'],
+                      True, output_base_name, display=False, **arguments)
+
+
+def read_bytes(file_name):
+
+    with open(file_name, 'rb') as result_file:
+        return result_file.read()
+
+
+def test_resumed_run_matches_uninterrupted_run(dem_files, tmp_path):
+
+    uninterrupted_base = str(tmp_path / 'uninterrupted_')
+    resumed_base = str(tmp_path / 'resumed_')
+    run_piv_files(dem_files, uninterrupted_base, progress_reporter=progress_functions.NullProgressReporter())
+    run_interrupted_piv(dem_files, resumed_base)
+    run_piv_files(dem_files, resumed_base, resume=True,
+                  progress_reporter=progress_functions.NullProgressReporter())
+
+    assert not os.path.exists(resumed_base + 'checkpoint')
+    with open(resumed_base + 'metrics.json') as metrics_file:
+        assert json.load(metrics_file)['resumed_tiles'] == 1
+    for file_name in ('vectors.npy', 'covariances.npy'):
+        assert read_bytes(resumed_base + file_name) == read_bytes(uninterrupted_base + file_name)
+
+
+def test_mismatched_checkpoint_is_refused(dem_files, tmp_path):
+
+    output_base_name = str(tmp_path / 'run_')
+    run_interrupted_piv(dem_files, output_base_name)
+    manifest = read_bytes(output_base_name + 'checkpoint/manifest.json')
+
+    # an existing checkpoint is only continued with --resume
+    with pytest.raises(SystemExit):
+        run_piv_files(dem_files, output_base_name)
+    # different parameters
+    with pytest.raises(SystemExit):
+        run_piv_files(dem_files, output_base_name, step_size=8, resume=True)
+    with pytest.raises(SystemExit):
+        run_piv_files(dem_files, output_base_name, min_peak_ratio=1.2, resume=True)
+    # an edited input file under the same name
+    with rasterio.open(dem_files['after_uncertainty'], 'r+') as raster:
+        raster.write(2*raster.read(1), 1)
+    with pytest.raises(SystemExit):
+        run_piv_files(dem_files, output_base_name, resume=True)
+
+    # the refused resumes left the checkpoint as it was
+    assert len(os.listdir(output_base_name + 'checkpoint')) == 2
+    assert read_bytes(output_base_name + 'checkpoint/manifest.json') == manifest
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+import rasterio
+import piv_functions
+import result_functions
+
+
+# compute_piv on in-memory arrays must give the records that 'gpiv piv' writes
+# for the same DEM files.
+
+
+def read_arrays(dem_files):
+
+    arrays = {}
+    for name, file_name in dem_files.items():
+        with rasterio.open(file_name) as raster:
+            arrays[name] = raster.read(1)
+            geo_transform = raster.transform
+    return arrays, geo_transform
+
+
+def assert_records_equal(records, expected_records):
+
+    assert records.dtype == expected_records.dtype
+    for name in expected_records.dtype.names:
+        np.testing.assert_array_equal(records[name], expected_records[name])
+
+
+@pytest.mark.parametrize('propagate', [False, True])
+@pytest.mark.parametrize('options', [{},
+                                     {'pyramid_levels': 2, 'search_radius': 2},
+                                     {'min_peak_ratio': 1.05, 'min_overlap': 0.8}])
+def test_compute_piv_matches_piv_files(dem_files, tmp_path, propagate, options):
+
+    output_base_name = str(tmp_path / 'run_')
+    piv_functions.piv(dem_files['before_height'], dem_files['after_height'], 8, 4,
+                      dem_files['before_uncertainty'], dem_files['after_uncertainty'],
+                      propagate, output_base_name, display=False, **options)
+
+    arrays, geo_transform = read_arrays(dem_files)
+    if propagate:
+        uncertainties = {'before_uncertainty': arrays['before_uncertainty'],
+                         'after_uncertainty': arrays['after_uncertainty']}
+    else:
+        uncertainties = {}
+    results = piv_functions.compute_piv(arrays['before_height'], arrays['after_height'], geo_transform,
+                                        8, 4, **uncertainties, **options)
+
+    assert len(results) > 0
+    assert_records_equal(results.vector_records, np.load(output_base_name + 'vectors.npy'))
+    if propagate:
+        assert_records_equal(results.covariance_records, np.load(output_base_name + 'covariances.npy'))
+    else:
+        assert results.covariances is None
+    # the displacement is 1.5 pixels right and 1 down, in 2 m pixels
+    np.testing.assert_allclose(np.median(results.vectors, axis=0), [3.0, 2.0], atol=0.1)
+
+    # saving the results writes the same files as piv
+    saved_base_name = str(tmp_path / 'saved_')
+    for file_name in results.save(saved_base_name):
+        with open(file_name, 'rb') as saved_file, open(file_name.replace(saved_base_name, output_base_name), 'rb') as piv_file:
+            assert saved_file.read() == piv_file.read()
+    # and they read back as the same records
+    assert_records_equal(result_functions.read_vectors(saved_base_name + 'vectors.npy'), results.vector_records)
+
+
+def test_compute_piv_rejects_inconsistent_arrays(dem_files):
+
+    arrays, geo_transform = read_arrays(dem_files)
+    with pytest.raises(ValueError):
+        piv_functions.compute_piv(arrays['before_height'], arrays['after_height'][:-1], geo_transform, 8, 4)
+    with pytest.raises(ValueError):
+        piv_functions.compute_piv(arrays['before_height'], arrays['after_height'], geo_transform, 8, 4,
+                                  before_uncertainty=arrays['before_uncertainty'])
+    with pytest.raises(ValueError):
+        piv_functions.compute_piv(arrays['before_height'], arrays['after_height'], geo_transform, 8, 4,
+                                  arrays['before_uncertainty'], arrays['after_uncertainty'][:, :-1])
+    # too many pyramid levels for the DEM size
+    with pytest.raises(ValueError):
+        piv_functions.compute_piv(arrays['before_height'], arrays['after_height'], geo_transform, 8, 4,
+                                  pyramid_levels=6)
@@ -0,0 +1,124 @@
+import numpy as np
+import scipy.ndimage
+import piv_functions
+
+
+# The batched FFT correlation must match a direct, spatial domain normalized
+# cross correlation, and run_piv_tile must skip the windows its guards reject.
+
+
+def get_direct_correlations(template, search):
+
+    # zero-normalized cross correlation of the template with every template-sized
+    # subarea of the search area
+    number_rows, number_columns = template.shape
+    output_rows = search.shape[0] - number_rows + 1
+    output_columns = search.shape[1] - number_columns + 1
+    zero_mean_template = template - template.mean()
+    correlations = np.empty((output_rows, output_columns))
+    for row in range(output_rows):
+        for column in range(output_columns):
+            subarea = search[row:row+number_rows, column:column+number_columns]
+            zero_mean_subarea = subarea - subarea.mean()
+            correlations[row, column] = (np.sum(zero_mean_template * zero_mean_subarea) /
+                                         np.sqrt(np.sum(zero_mean_template**2) * np.sum(zero_mean_subarea**2)))
+
+    return correlations
+
+
+def get_surface(random_generator, shape):
+
+    # smooth random terrain
+    return 50 * scipy.ndimage.gaussian_filter(random_generator.normal(size=shape), 2)
+
+
+def test_window_stacks_match_direct_correlation():
+
+    random_generator = np.random.default_rng(2)
+    template_size, search_size = 9, 19
+    searches = np.stack([get_surface(random_generator, (search_size, search_size)) for _ in range(12)])
+    # templates cut from the search areas at known positions, plus noise
+    positions = random_generator.integers(0, search_size-template_size+1, size=(12, 2))
+    templates = np.stack([search[row:row+template_size, column:column+template_size]
+                          for search, (row, column) in zip(searches, positions)])
+    templates = templates + random_generator.normal(scale=0.5, size=templates.shape)
+
+    template_means = templates.mean(axis=(1,2))
+    template_ssd = np.sum((templates - template_means[:, np.newaxis, np.newaxis])**2, axis=(1,2))
+    normalized_cross_correlations = piv_functions.correlate_window_stacks(
+        searches,
+        piv_functions.get_template_spectra(templates, template_means, (search_size, search_size)),
+        template_ssd, (template_size, template_size),
+        piv_functions.get_window_sums(searches, template_size, template_size),
+        piv_functions.get_window_sums(searches**2, template_size, template_size))
+    direct_correlations = np.stack([get_direct_correlations(template, search)
+                                    for template, search in zip(templates, searches)])
+    np.testing.assert_allclose(normalized_cross_correlations, direct_correlations, rtol=0, atol=1e-10)
+
+    interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks = piv_functions.locate_correlation_peaks(
+        normalized_cross_correlations)
+    direct_peaks = np.array(np.unravel_index(np.argmax(direct_correlations.reshape(12, -1), axis=1),
+                                             direct_correlations.shape[1:])).T
+    np.testing.assert_array_equal(direct_peaks, positions)
+    on_edge = (positions == 0).any(axis=1) | (positions == search_size-template_size).any(axis=1)
+    np.testing.assert_array_equal(interior, ~on_edge)
+    np.testing.assert_array_equal(peak_rows, positions[interior, 0])
+    np.testing.assert_array_equal(peak_columns, positions[interior, 1])
+    np.testing.assert_allclose(peak_correlations[:,1,1], direct_correlations[interior, peak_rows, peak_columns], atol=1e-10)
+
+
+def test_locate_correlation_peaks_rejects_edge_and_nan_neighbours():
+
+    normalized_cross_correlations = np.zeros((4, 5, 5))
+    normalized_cross_correlations[0, 2, 3] = 1 # interior
+    normalized_cross_correlations[1, 0, 2] = 1 # top edge
+    normalized_cross_correlations[2, 3, 4] = 1 # right edge
+    normalized_cross_correlations[3, 2, 2] = 1 # interior, but next to a NaN correlation
+    normalized_cross_correlations[3, 1, 1] = np.nan
+
+    interior, peak_rows, peak_columns, peak_correlations, subpixel_peaks = piv_functions.locate_correlation_peaks(
+        normalized_cross_correlations)
+
+    np.testing.assert_array_equal(interior, [True, False, False, False])
+    np.testing.assert_array_equal(peak_rows, [2])
+    np.testing.assert_array_equal(peak_columns, [3])
+
+
+def test_run_piv_tile_skips_flat_and_nan_windows():
+
+    random_generator = np.random.default_rng(3)
+    template_size = step_size = 8
+    surface = get_surface(random_generator, (72, 72))
+    # the 'after' DEM is the 'before' DEM moved 2 pixels right and 1 pixel down
+    before_height = surface[4:68, 4:68].copy()
+    after_height = surface[3:67, 2:66].copy()
+    grid_shape = piv_functions.get_window_grid_shape(before_height.shape, template_size, step_size)
+    assert grid_shape == (6, 6)
+
+    # template starts are window starts + 4, search area starts are window starts
+    before_height[12:20, 12:20] = 5.0 # flat template of window (1, 1)
+    before_height[22, 30] = np.nan # NaN in the template of window (2, 3)
+    after_height[36, 12] = np.nan # NaN in the search areas of windows (3-4, 0-1)
+    after_height[40:56, 40:56] = 5.0 # flat search area of window (5, 5)
+
+    tile_result = piv_functions.run_piv_tile(
+        before_height, None, after_height, None,
+        0, np.arange(grid_shape[0]), grid_shape[1],
+        piv_functions.get_piv_options(template_size, step_size))
+
+    skipped = tile_result['metrics']['skipped']
+    assert skipped['template_flat'] == 1
+    assert skipped['template_nan'] == 1
+    assert skipped['search_nan'] == 4
+    assert skipped['search_flat'] == 1
+    assert skipped['search_outside'] == 0
+
+    # window (v, h) has its origin at (h*8 + 7.5, v*8 + 7.5)
+    computed = {(int(y - 7.5) // step_size, int(x - 7.5) // step_size) for x, y in tile_result['origins']}
+    rejected = {(1, 1), (2, 3), (3, 0), (3, 1), (4, 0), (4, 1), (5, 5)}
+    assert not computed & rejected
+    assert len(computed) + skipped['edge_peak'] + skipped['weak_peak'] == 36 - len(rejected)
+    # windows away from the defects recover the (whole pixel) shift
+    undisturbed = np.array([(y - 7.5) // step_size in (0, 1) and (x - 7.5) // step_size in (3, 4, 5)
+                            for x, y in tile_result['origins']])
+    np.testing.assert_array_equal(np.rint(tile_result['vectors'][undisturbed]), [[2, 1]] * np.count_nonzero(undisturbed))
@@ -0,0 +1,188 @@
+import numpy as np
+import pytest
+import filter_functions
+import result_functions
+
+
+# The normalized median test must flag exactly the vectors that differ from their
+# neighbourhood, at the grid edges and around gaps too, and each replacement
+# method must give the expected vectors.
+
+
+def get_smooth_grid(random_generator, shape=(6, 7)):
+
+    # a linear displacement field with a little correlation noise, in pixels
+    rows, columns = np.mgrid[:shape[0], :shape[1]]
+    vector_grid = np.stack((0.1*columns + 0.05*rows, 0.02*columns), axis=-1)
+    vector_grid += random_generator.normal(scale=0.01, size=vector_grid.shape)
+    return np.ma.masked_invalid(vector_grid)
+
+
+def get_direct_outliers(vector_grid, neighbourhood_size, threshold, epsilon):
+
+    # the normalized median test, one vector at a time
+    grid = vector_grid.filled(np.nan)
+    half_size = neighbourhood_size // 2
+    outliers = np.zeros(grid.shape[:2], dtype=bool)
+    for row in range(grid.shape[0]):
+        for column in range(grid.shape[1]):
+            if np.isnan(grid[row, column, 0]):
+                continue
+            neighbourhood = grid[max(0, row-half_size):row+half_size+1, max(0, column-half_size):column+half_size+1].copy()
+            neighbourhood[row - max(0, row-half_size), column - max(0, column-half_size)] = np.nan
+            neighbours = neighbourhood.reshape(-1, 2)
+            neighbours = neighbours[~np.isnan(neighbours[:, 0])]
+            if len(neighbours) < 2:
+                continue
+            neighbour_median = np.median(neighbours, axis=0)
+            residual_median = np.median(np.abs(neighbours - neighbour_median), axis=0)
+            normalized_residual = np.abs(grid[row, column] - neighbour_median) / (residual_median + epsilon)
+            outliers[row, column] = np.sqrt(np.sum(normalized_residual**2)) > threshold
+
+    return outliers
+
+
+def test_planted_outlier_is_the_only_outlier():
+
+    vector_grid = get_smooth_grid(np.random.default_rng(5))
+    vector_grid[2, 3] += [3.0, -2.0]
+
+    outliers = filter_functions.get_median_test_outliers(vector_grid)
+
+    expected = np.zeros(vector_grid.shape[:2], dtype=bool)
+    expected[2, 3] = True
+    np.testing.assert_array_equal(outliers, expected)
+
+
+@pytest.mark.parametrize('neighbourhood_size', [3, 5])
+def test_outliers_at_edges_and_gaps_match_direct_test(neighbourhood_size):
+
+    random_generator = np.random.default_rng(6)
+    vector_grid = get_smooth_grid(random_generator, (9, 11))
+    # outliers in a corner, on an edge, next to a gap and in a cluster
+    vector_grid[0, 0] += [2.0, 0.0]
+    vector_grid[4, 10] += [0.0, -1.5]
+    vector_grid[5, 3] += [1.0, 1.0]
+    vector_grid[7, 7:9] += [-2.0, 2.0]
+    vector_grid[4:6, 4] = np.ma.masked
+    vector_grid[8, 0] = np.ma.masked
+    # isolated vector whose neighbours are all missing but one
+    vector_grid[0:3, 8:11] = np.ma.masked
+    vector_grid[1, 9] = [5.0, 5.0]
+    vector_grid[0, 10] = [0.0, 0.0]
+
+    outliers = filter_functions.get_median_test_outliers(vector_grid, neighbourhood_size)
+
+    np.testing.assert_array_equal(outliers, get_direct_outliers(vector_grid, neighbourhood_size, 2.0, 0.1))
+    assert outliers[0, 0] and outliers[4, 10] and outliers[5, 3]
+    if neighbourhood_size == 3:
+        # a single neighbour is not enough for the test
+        assert not outliers[1, 9]
+    assert not outliers[vector_grid.mask[..., 0]].any()
+
+
+def get_outlier_grid():
+
+    vector_grid = get_smooth_grid(np.random.default_rng(7))
+    vector_grid[2, 3] += [3.0, -2.0] # interior
+    vector_grid[0, 6] += [-3.0, 0.0] # corner
+    vector_grid[3, 2] = np.ma.masked # gap next to the interior outlier
+    outliers = np.zeros(vector_grid.shape[:2], dtype=bool)
+    outliers[2, 3] = outliers[0, 6] = True
+    return vector_grid, outliers
+
+
+def test_remove_masks_the_outliers():
+
+    vector_grid, outliers = get_outlier_grid()
+
+    replaced_grid = filter_functions.replace_outliers(vector_grid, outliers, method='remove')
+
+    np.testing.assert_array_equal(replaced_grid.mask[..., 0], vector_grid.mask[..., 0] | outliers)
+    np.testing.assert_array_equal(replaced_grid[~outliers], vector_grid[~outliers])
+
+
+def test_median_uses_the_valid_neighbours():
+
+    vector_grid, outliers = get_outlier_grid()
+
+    replaced_grid = filter_functions.replace_outliers(vector_grid, outliers, method='median')
+
+    grid = vector_grid.filled(np.nan)
+    # 7 valid neighbours around (2, 3) (one is the gap), 3 in the corner
+    interior_neighbours = np.delete(grid[1:4, 2:5].reshape(-1, 2), [4, 6], axis=0)
+    corner_neighbours = np.delete(grid[0:2, 5:7].reshape(-1, 2), 1, axis=0)
+    np.testing.assert_allclose(replaced_grid[2, 3], np.median(interior_neighbours, axis=0))
+    np.testing.assert_allclose(replaced_grid[0, 6], np.median(corner_neighbours, axis=0))
+    np.testing.assert_array_equal(replaced_grid[~outliers], vector_grid[~outliers])
+
+
+def test_interpolate_fills_clusters_from_their_edges():
+
+    vector_grid, outliers = get_outlier_grid()
+    # a cluster of outliers surrounded by outliers and gaps is filled in two passes
+    vector_grid[4:6, 5:7] += [4.0, 4.0]
+    outliers[4:6, 5:7] = True
+
+    replaced_grid = filter_functions.replace_outliers(vector_grid, outliers, method='interpolate')
+
+    grid = vector_grid.filled(np.nan)
+    grid[outliers] = np.nan
+    np.testing.assert_allclose(replaced_grid[2, 3], np.nanmean(grid[1:4, 2:5].reshape(-1, 2), axis=0))
+    np.testing.assert_allclose(replaced_grid[0, 6], np.nanmean(grid[0:2, 5:7].reshape(-1, 2), axis=0))
+    # the cluster corner (5, 6) only has cluster neighbours, so it is filled in the
+    # second pass from the cells filled in the first
+    first_pass = grid.copy()
+    for row, column in zip(*np.nonzero(outliers)):
+        if (row, column) != (5, 6):
+            first_pass[row, column] = np.nanmean(grid[max(0, row-1):row+2, max(0, column-1):column+2].reshape(-1, 2), axis=0)
+    first_pass[5, 6] = np.mean(first_pass[4:6, 5:7].reshape(-1, 2)[:3], axis=0)
+    np.testing.assert_allclose(replaced_grid[outliers], first_pass[outliers])
+    assert not replaced_grid.mask[outliers].any()
+
+
+def test_interpolate_masks_outliers_without_neighbours():
+
+    vector_grid = np.ma.masked_all((5, 5, 2))
+    vector_grid[2, 2] = [1.0, 1.0]
+    outliers = np.zeros((5, 5), dtype=bool)
+    outliers[2, 2] = True
+
+    replaced_grid = filter_functions.replace_outliers(vector_grid, outliers, method='interpolate')
+
+    assert replaced_grid.mask.all()
+
+
+@pytest.mark.parametrize('method', filter_functions.replacement_methods)
+def test_filter_vector_records(method):
+
+    geo_transform = np.array([[2.0, 0.0, 1000.0], [0.0, -2.0, 5000.0], [0.0, 0.0, 1.0]])
+    template_size, step_size = 8, 4
+    vector_grid, outliers = get_outlier_grid()
+    rows, columns = np.nonzero(~vector_grid.mask[..., 0])
+    # window origins are the template centers (see run_piv_tile)
+    origins = np.column_stack((columns*step_size + template_size - 0.5, rows*step_size + template_size - 0.5))
+    vectors = vector_grid[rows, columns].filled()
+    vector_records = result_functions.get_vector_records(origins, vectors, geo_transform,
+                                                         np.full(len(rows), 0.9), np.full(len(rows), 2.0))
+    covariance_records = result_functions.get_covariance_records(origins, vectors, np.tile(np.eye(2), (len(rows), 1, 1)), geo_transform)
+
+    filtered_vectors, filtered_covariances, number_outliers = filter_functions.filter_vector_records(
+        vector_records, covariance_records, geo_transform, template_size, step_size, method=method)
+
+    assert number_outliers == 2
+    record_outliers = outliers[rows, columns]
+    if method == 'remove':
+        np.testing.assert_array_equal(filtered_vectors, vector_records[~record_outliers])
+        np.testing.assert_array_equal(filtered_covariances, covariance_records[~record_outliers])
+    else:
+        replaced_grid = filter_functions.replace_outliers(vector_grid*geo_transform[0,0], outliers, method=method)
+        np.testing.assert_allclose(filtered_vectors['dx'], replaced_grid[rows, columns, 0])
+        np.testing.assert_allclose(filtered_vectors['dy'], replaced_grid[rows, columns, 1])
+        assert np.isnan(filtered_vectors['peak_height'][record_outliers]).all()
+        assert np.isnan(filtered_vectors['peak_ratio'][record_outliers]).all()
+        np.testing.assert_array_equal(filtered_vectors['peak_height'][~record_outliers], 0.9)
+        # the covariances move with the replaced vectors
+        np.testing.assert_allclose(filtered_covariances['x'], filtered_vectors['x'] + filtered_vectors['dx'])
+        np.testing.assert_allclose(filtered_covariances['y'], filtered_vectors['y'] - filtered_vectors['dy'])
+        np.testing.assert_array_equal(filtered_covariances['covariance'], covariance_records['covariance'])
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import piv_functions
+
+
+# The closed-form correlation Jacobians must match the finite difference
+# reference of '--jacobian numeric'.
+
+numeric_partial_derivative_increment = 0.000001
+
+
+def get_cell_correlations(template, search):
+
+    # 3x3 zero-normalized cross correlations over the pixels valid in both the
+    # template and each search subarea
+    number_rows, number_columns = template.shape
+    correlations = np.empty((3, 3))
+    for row in range(3):
+        for column in range(3):
+            search_subarea = search[row:row+number_rows, column:column+number_columns]
+            overlap = ~np.isnan(template) & ~np.isnan(search_subarea)
+            cell_template = template[overlap]
+            cell_search = search_subarea[overlap]
+            correlations[row, column] = np.mean(
+                (cell_template - cell_template.mean()) / cell_template.std()
+                * (cell_search - cell_search.mean()) / cell_search.std())
+
+    return correlations
+
+
+def get_random_windows(random_generator, number_windows, template_size, gap_fraction):
+
+    templates = random_generator.normal(size=(number_windows, template_size, template_size))
+    searches = random_generator.normal(size=(number_windows, template_size+2, template_size+2))
+    # correlated windows, like those around a correlation peak
+    searches[:, 1:-1, 1:-1] += 2*templates
+    templates[random_generator.random(templates.shape) < gap_fraction] = np.nan
+    searches[random_generator.random(searches.shape) < gap_fraction] = np.nan
+
+    return templates, searches
+
+
+@pytest.mark.parametrize('gap_fraction', [0, 0.1])
+def test_analytic_jacobians_match_numeric(gap_fraction):
+
+    templates, searches = get_random_windows(np.random.default_rng(0), 4, 7, gap_fraction)
+
+    analytic_jacobians = piv_functions.get_correlation_jacobians(templates, searches)
+    for template, search, analytic_jacobian in zip(templates, searches, analytic_jacobians):
+        numeric_jacobian = piv_functions.get_numeric_correlation_jacobian(
+            template, search, get_cell_correlations(template, search),
+            numeric_partial_derivative_increment)
+        np.testing.assert_allclose(analytic_jacobian, numeric_jacobian, rtol=0, atol=1e-7)
+
+
+def test_analytic_jacobians_with_window_statistics():
+
+    # the statistics passed by the PIV pass give the same Jacobians
+    templates, searches = get_random_windows(np.random.default_rng(1), 4, 7, 0)
+    search_subareas = np.lib.stride_tricks.sliding_window_view(searches, (7, 7), axis=(1,2))
+    window_statistics = [templates.mean(axis=(1,2)), templates.std(axis=(1,2)),
+                         search_subareas.mean(axis=(3,4)), search_subareas.std(axis=(3,4))]
+
+    np.testing.assert_allclose(piv_functions.get_correlation_jacobians(templates, searches, window_statistics),
+                               piv_functions.get_correlation_jacobians(templates, searches),
+                               rtol=0, atol=1e-12)
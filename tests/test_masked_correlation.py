@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import piv_functions
+
+
+# The FFT masked correlation must match a direct normalized cross correlation
+# over the pixels valid in both the template and each search subarea, and reject
+# the positions where too few pixels overlap.
+
+
+def get_direct_masked_correlations(template, search, min_overlap):
+
+    number_rows, number_columns = template.shape
+    output_rows = search.shape[0] - number_rows + 1
+    output_columns = search.shape[1] - number_columns + 1
+    correlations = np.full((output_rows, output_columns), np.nan)
+    for row in range(output_rows):
+        for column in range(output_columns):
+            subarea = search[row:row+number_rows, column:column+number_columns]
+            overlap = ~np.isnan(template) & ~np.isnan(subarea)
+            if np.count_nonzero(overlap) < min_overlap * template.size:
+                continue
+            zero_mean_template = template[overlap] - template[overlap].mean()
+            zero_mean_subarea = subarea[overlap] - subarea[overlap].mean()
+            correlations[row, column] = (np.sum(zero_mean_template * zero_mean_subarea) /
+                                         np.sqrt(np.sum(zero_mean_template**2) * np.sum(zero_mean_subarea**2)))
+
+    return correlations
+
+
+@pytest.mark.parametrize('min_overlap', [0.25, 0.5, 0.75])
+def test_masked_correlation_matches_direct_correlation(min_overlap):
+
+    random_generator = np.random.default_rng(4)
+    template_size, search_size = 8, 16
+    searches = random_generator.normal(size=(6, search_size, search_size))
+    templates = searches[:, 3:3+template_size, 5:5+template_size] + random_generator.normal(scale=0.3, size=(6, template_size, template_size))
+    # scattered gaps and a block gap (a missing strip of the DEM)
+    templates[random_generator.random(templates.shape) < 0.1] = np.nan
+    searches[random_generator.random(searches.shape) < 0.1] = np.nan
+    searches[0, :, 10:] = np.nan
+    templates[1, :3, :] = np.nan
+
+    normalized_cross_correlations = piv_functions.correlate_masked_window_stacks(searches, templates, min_overlap)
+    direct_correlations = np.stack([get_direct_masked_correlations(template, search, min_overlap)
+                                    for template, search in zip(templates, searches)])
+
+    # the same positions are rejected
+    np.testing.assert_array_equal(np.isnan(normalized_cross_correlations), np.isnan(direct_correlations))
+    assert np.isnan(direct_correlations).any()
+    assert not np.isnan(direct_correlations).all()
+    np.testing.assert_allclose(normalized_cross_correlations, direct_correlations, rtol=0, atol=1e-10)
+
+
+def test_masked_correlation_rejects_flat_overlaps():
+
+    template = np.arange(16.0).reshape(4, 4)
+    template[:, 2:] = np.nan
+    search = np.full((6, 6), 3.0)
+    search[:, :2] = np.nan
+
+    normalized_cross_correlations = piv_functions.correlate_masked_window_stacks(
+        search[np.newaxis], template[np.newaxis], 0.25)
+
+    # every overlap is flat in the search area (or too small)
+    assert np.isnan(normalized_cross_correlations).all()
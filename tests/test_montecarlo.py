@@ -0,0 +1,101 @@
+import numpy as np
+import rasterio
+import piv_functions
+
+
+# The Monte Carlo propagation must give finite covariances of the same order as
+# the linearized propagation, reproducibly for a seed and whatever the tiling.
+
+
+def read_arrays(dem_files):
+
+    arrays = {}
+    for name, file_name in dem_files.items():
+        with rasterio.open(file_name) as raster:
+            arrays[name] = raster.read(1)
+    return arrays
+
+
+def run_tile(arrays, vt_counts, **options):
+
+    grid_shape = piv_functions.get_window_grid_shape(arrays['before_height'].shape, 8, 8)
+    return piv_functions.run_piv_tile(
+        arrays['before_height'], arrays['before_uncertainty'],
+        arrays['after_height'], arrays['after_uncertainty'],
+        0, vt_counts, grid_shape[1], piv_functions.get_piv_options(8, 8, True, **options))
+
+
+def test_montecarlo_covariances_match_linear_ones(dem_files):
+
+    arrays = read_arrays(dem_files)
+    vt_counts = np.arange(piv_functions.get_window_grid_shape(arrays['before_height'].shape, 8, 8)[0])
+    linear_result = run_tile(arrays, vt_counts)
+    montecarlo_result = run_tile(arrays, vt_counts, montecarlo_realizations=200, montecarlo_seed=1)
+
+    # the same vectors, with a covariance for each
+    np.testing.assert_array_equal(montecarlo_result['vectors'], linear_result['vectors'])
+    covariances = montecarlo_result['covariances']
+    assert covariances.shape == (len(linear_result['vectors']), 2, 2)
+    assert np.isfinite(covariances).all()
+    np.testing.assert_array_equal(covariances, np.swapaxes(covariances, 1, 2))
+    assert (np.linalg.eigvalsh(covariances) > 0).all()
+
+    # standard deviations of the same order as the linearized ones; the linearized
+    # propagation underestimates those of the smoothest windows, whose peaks move
+    # further than a linear model of the correlation predicts
+    standard_deviation_ratios = np.sqrt(np.diagonal(covariances, axis1=1, axis2=2) /
+                                        np.diagonal(linear_result['covariances'], axis1=1, axis2=2))
+    assert 0.8 < np.median(standard_deviation_ratios) < 1.5
+    assert np.mean((standard_deviation_ratios > 0.5) & (standard_deviation_ratios < 2.5)) > 0.8
+    assert (standard_deviation_ratios > 0.5).all()
+
+
+def test_montecarlo_covariances_are_seeded_by_row(dem_files):
+
+    arrays = read_arrays(dem_files)
+    vt_counts = np.arange(piv_functions.get_window_grid_shape(arrays['before_height'].shape, 8, 8)[0])
+    options = {'montecarlo_realizations': 20, 'montecarlo_seed': 3}
+    covariances = run_tile(arrays, vt_counts, **options)['covariances']
+
+    np.testing.assert_array_equal(run_tile(arrays, vt_counts, **options)['covariances'], covariances)
+    # tiles of other rows get the same noise for each row
+    split_covariances = np.concatenate([run_tile(arrays, vt_counts[:5], **options)['covariances'],
+                                        run_tile(arrays, vt_counts[5:], **options)['covariances']])
+    np.testing.assert_array_equal(split_covariances, covariances)
+    # another seed draws other noise
+    other_covariances = run_tile(arrays, vt_counts, montecarlo_realizations=20, montecarlo_seed=4)['covariances']
+    assert not np.array_equal(other_covariances, covariances)
+
+
+def test_montecarlo_without_noise_has_zero_covariance():
+
+    random_generator = np.random.default_rng(9)
+    height_patches = random_generator.normal(size=(4, 14, 14))
+    height_templates = height_patches[:, 3:11, 3:11].copy()
+
+    peak_covariances = piv_functions.get_montecarlo_peak_covariances(
+        height_templates, np.zeros(height_templates.shape),
+        height_patches, np.zeros(height_patches.shape),
+        10, random_generator)
+
+    np.testing.assert_allclose(peak_covariances, 0, atol=1e-20)
+
+
+def test_compute_piv_matches_piv_files(dem_files, tmp_path):
+
+    output_base_name = str(tmp_path / 'run_')
+    options = {'montecarlo_realizations': 20, 'montecarlo_seed': 5}
+    piv_functions.piv(dem_files['before_height'], dem_files['after_height'], 8, 8,
+                      dem_files['before_uncertainty'], dem_files['after_uncertainty'],
+                      True, output_base_name, display=False, **options)
+
+    arrays = read_arrays(dem_files)
+    with rasterio.open(dem_files['before_height']) as raster:
+        geo_transform = raster.transform
+    results = piv_functions.compute_piv(arrays['before_height'], arrays['after_height'], geo_transform, 8, 8,
+                                        arrays['before_uncertainty'], arrays['after_uncertainty'], **options)
+
+    for records, file_name in ((results.vector_records, 'vectors.npy'), (results.covariance_records, 'covariances.npy')):
+        expected_records = np.load(output_base_name + file_name)
+        for name in expected_records.dtype.names:
+            np.testing.assert_array_equal(records[name], expected_records[name])
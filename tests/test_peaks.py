@@ -0,0 +1,114 @@
+import json
+import numpy as np
+import rasterio
+import piv_functions
+import result_functions
+
+
+# Peak ratios compare each correlation peak with the highest other local maximum,
+# vectors with a low ratio are rejected before their uncertainty is propagated,
+# and the peaks of JSON vectors are kept in a separate file.
+
+
+def test_peak_ratios_use_the_second_local_maximum():
+
+    normalized_cross_correlations = np.zeros((5, 7, 7))
+    # main peak with a slope next to it, which is not a second peak
+    normalized_cross_correlations[0, 3, 3] = 0.9
+    normalized_cross_correlations[0, 3, 4] = 0.8
+    normalized_cross_correlations[0, 1, 5] = 0.6
+    # second peak on the edge of the array
+    normalized_cross_correlations[1, 2, 2] = 0.8
+    normalized_cross_correlations[1, 6, 0] = 0.4
+    # no other positive local maximum
+    normalized_cross_correlations[2] = -0.5
+    normalized_cross_correlations[2, 3, 3] = 0.7
+    # NaN correlations are ignored; a plateau next to the peak is a local maximum
+    normalized_cross_correlations[3, 4, 4] = 0.9
+    normalized_cross_correlations[3, 0, 0] = np.nan
+    normalized_cross_correlations[3, 1, 1] = 0.3
+    normalized_cross_correlations[4, 2, 3] = 0.5
+    normalized_cross_correlations[4, 2, 4] = 0.5
+
+    interior, peak_rows, peak_columns, _, _ = piv_functions.locate_correlation_peaks(normalized_cross_correlations)
+    peak_ratios = piv_functions.get_peak_ratios(normalized_cross_correlations, peak_rows, peak_columns)
+
+    assert interior.all()
+    np.testing.assert_array_equal(peak_columns, [3, 2, 3, 4, 3])
+    np.testing.assert_allclose(peak_ratios, [0.9/0.6, 0.8/0.4, np.inf, 0.9/0.3, 1.0])
+
+
+def test_weak_peaks_are_rejected_before_propagation(dem_files, monkeypatch):
+
+    # counts the windows whose uncertainty is propagated
+    propagated_windows = []
+    propagate_pixels_into_correlations = piv_functions.propagate_pixels_into_correlations
+    def count_propagated_windows(height_templates, *arguments):
+        propagated_windows.append(len(height_templates))
+        return propagate_pixels_into_correlations(height_templates, *arguments)
+    monkeypatch.setattr(piv_functions, 'propagate_pixels_into_correlations', count_propagated_windows)
+
+    arrays = {}
+    for name, file_name in dem_files.items():
+        with rasterio.open(file_name) as raster:
+            arrays[name] = raster.read(1)
+    grid_shape = piv_functions.get_window_grid_shape(arrays['before_height'].shape, 8, 4)
+
+    def run_tile(min_peak_ratio):
+        return piv_functions.run_piv_tile(
+            arrays['before_height'], arrays['before_uncertainty'],
+            arrays['after_height'], arrays['after_uncertainty'],
+            0, np.arange(grid_shape[0]), grid_shape[1],
+            piv_functions.get_piv_options(8, 4, True, min_peak_ratio=min_peak_ratio))
+
+    all_peaks = run_tile(1.0)
+    assert sum(propagated_windows) == len(all_peaks['vectors'])
+    min_peak_ratio = np.median(all_peaks['peak_ratios'])
+    propagated_windows.clear()
+    strong_peaks = run_tile(min_peak_ratio)
+    assert sum(propagated_windows) == len(strong_peaks['vectors'])
+
+    strong = all_peaks['peak_ratios'] >= min_peak_ratio
+    assert 0 < np.count_nonzero(strong) < len(strong)
+    assert strong_peaks['metrics']['skipped']['weak_peak'] == np.count_nonzero(~strong)
+    assert all_peaks['metrics']['skipped']['weak_peak'] == 0
+    for name in ('origins', 'vectors', 'peak_heights', 'peak_ratios'):
+        np.testing.assert_array_equal(strong_peaks[name], all_peaks[name][strong])
+    # the propagation of smaller batches may round differently
+    np.testing.assert_allclose(strong_peaks['covariances'], all_peaks['covariances'][strong], rtol=1e-10, atol=0)
+    assert len(strong_peaks['covariances']) == len(strong_peaks['vectors'])
+
+
+def test_json_vectors_keep_their_layout(tmp_path):
+
+    vector_file = str(tmp_path / 'run_vectors.json')
+    vector_records = result_functions.get_vector_records(
+        np.array([[10.5, 20.5], [14.5, 20.5], [18.5, 20.5]]),
+        np.array([[1.0, -0.5], [1.25, 0.0], [0.75, 0.5]]),
+        np.array([[2.0, 0.0, 1000.0], [0.0, -2.0, 5000.0], [0.0, 0.0, 1.0]]),
+        np.array([0.95, 0.9, np.nan]), np.array([1.5, np.inf, np.nan]))
+
+    writer = result_functions.open_result_writer(vector_file, result_functions.vector_dtype, 'json')
+    writer.write(vector_records[:2])
+    writer.write(vector_records[2:])
+    writer.close()
+
+    with open(vector_file) as json_file:
+        assert json.load(json_file) == [[1021.0, 4959.0, 2.0, -1.0],
+                                        [1029.0, 4959.0, 2.5, 0.0],
+                                        [1037.0, 4959.0, 1.5, 1.0]]
+    assert result_functions.get_peak_file_name(vector_file) == str(tmp_path / 'run_vectors_peaks.json')
+    with open(tmp_path / 'run_vectors_peaks.json') as json_file:
+        peak_text = json_file.read()
+    assert peak_text == '[[0.95, 1.5], [0.9, Infinity], [NaN, NaN]]'
+
+    read_records = result_functions.read_vectors(vector_file)
+    for name in result_functions.vector_dtype.names:
+        np.testing.assert_array_equal(read_records[name], vector_records[name])
+
+    # without the peaks file, the vectors are read with NaN peaks
+    (tmp_path / 'run_vectors_peaks.json').unlink()
+    read_records = result_functions.read_vectors(vector_file)
+    for name in ('x', 'y', 'dx', 'dy'):
+        np.testing.assert_array_equal(read_records[name], vector_records[name])
+    assert np.isnan(read_records['peak_height']).all() and np.isnan(read_records['peak_ratio']).all()
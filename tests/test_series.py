@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import scipy.ndimage
+import piv_functions
+import result_functions
+import series_functions
+
+
+# Every pair of a time series run must get the vectors and covariances that a
+# separate PIV run of that pair gets, although the series shares the work of each
+# DEM between its pairs.
+
+
+def get_epochs(number_epochs):
+
+    # smooth random terrain moving a little further in every epoch, with a gap in
+    # the last one, and uncertainty rasters
+    random_generator = np.random.default_rng(8)
+    terrain = 50 * scipy.ndimage.gaussian_filter(random_generator.normal(size=(110, 110)), 3)
+    heights = [scipy.ndimage.shift(terrain, (0.7*epoch, 1.2*epoch), order=3)[5:105, 5:105]
+               for epoch in range(number_epochs)]
+    heights[-1][40:44, 60:70] = np.nan
+    uncertainties = [0.1 + 0.05*random_generator.random(height.shape) for height in heights]
+    return heights, uncertainties
+
+
+def get_pair_records(heights, uncertainties, geo_transform, before_epoch, after_epoch, propagate, min_overlap):
+
+    # the records of a 'gpiv piv' run of the pair, bias variance included
+    run_result = piv_functions.run_piv(
+        heights[before_epoch], uncertainties[before_epoch] if propagate else [],
+        heights[after_epoch], uncertainties[after_epoch] if propagate else [],
+        geo_transform, piv_functions.get_piv_options(8, 4, propagate, min_overlap=min_overlap), None)
+    if propagate:
+        piv_functions.add_bias_variance_to_records(
+            run_result['covariance_records'],
+            piv_functions.get_bias_variance(run_result['vector_statistics']['bias_vectors']))
+    return run_result['vector_records'], run_result['covariance_records']
+
+
+@pytest.mark.parametrize('propagate', [False, True])
+@pytest.mark.parametrize('pair_mode', series_functions.pair_modes)
+@pytest.mark.parametrize('cached_windows', [series_functions.cached_windows, 50])
+def test_series_pairs_match_separate_runs(propagate, pair_mode, cached_windows, monkeypatch):
+
+    # a small cache splits the tiles into groups of rows
+    monkeypatch.setattr(series_functions, 'cached_windows', cached_windows)
+    heights, uncertainties = get_epochs(3)
+    geo_transform = np.array([[2.0, 0.0, 1000.0], [0.0, -2.0, 5000.0], [0.0, 0.0, 1.0]])
+    pairs = series_functions.get_epoch_pairs(3, pair_mode)
+    min_overlap = 0.8
+
+    series_result = series_functions.run_series(
+        heights, uncertainties if propagate else [[]]*3, geo_transform, pairs,
+        piv_functions.get_piv_options(8, 4, propagate, min_overlap=min_overlap))
+
+    for before_epoch, after_epoch in pairs:
+        vector_records, covariance_records = get_pair_records(
+            heights, uncertainties, geo_transform, before_epoch, after_epoch, propagate, min_overlap)
+        series_vectors = result_functions.select_series_pair(series_result['vector_records'], before_epoch, after_epoch)
+        assert len(vector_records) > 0
+        for name in result_functions.vector_dtype.names:
+            np.testing.assert_array_equal(series_vectors[name], vector_records[name])
+        if propagate:
+            series_covariances = result_functions.select_series_pair(series_result['covariance_records'], before_epoch, after_epoch)
+            for name in result_functions.covariance_dtype.names:
+                np.testing.assert_array_equal(series_covariances[name], covariance_records[name])
+        else:
+            assert series_result['covariance_records'] is None
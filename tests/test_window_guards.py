@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import piv_functions
+
+
+# The summed-area table window guards must skip the windows the original
+# per-window checks skipped: flat windows, whose heights span less than 1e-10,
+# and windows with too few valid pixels.
+
+
+def get_direct_guards(height_strip, vt_starts, hz_starts, window_size, min_valid_pixels):
+
+    flat_windows = []
+    nan_windows = []
+    for vt_start, hz_start in zip(vt_starts, hz_starts):
+        window = height_strip[vt_start:vt_start+window_size, hz_start:hz_start+window_size]
+        valid = window[~np.isnan(window)]
+        nan_windows.append(valid.size < min_valid_pixels)
+        flat_windows.append(not nan_windows[-1] and np.max(valid) - np.min(valid) < 1e-10)
+    return np.array(flat_windows), np.array(nan_windows)
+
+
+@pytest.mark.parametrize('window_size', [5, 8])
+@pytest.mark.parametrize('min_valid_fraction', [0.5, 1.0])
+def test_window_guards_match_direct_checks(window_size, min_valid_fraction):
+
+    random_generator = np.random.default_rng(10)
+    height_strip = random_generator.normal(size=(40, 50))
+    height_strip[2:14, 3:17] = 7.0 # flat area
+    # a ramp whose neighbouring pixels differ by less than 1e-10 but which is
+    # not flat over a window
+    height_strip[20:32, 0:14] = 3.0 + 4e-11*np.arange(14)
+    height_strip[20:32, 30:44] = 3.0 + 1e-12*np.arange(14) # flat ramp
+    # gaps in a flat area and in a rough one
+    height_strip[4:6, 5:7] = np.nan
+    height_strip[30:40, 20:26] = np.nan
+    height_strip[random_generator.random(height_strip.shape) < 0.02] = np.nan
+
+    strip_statistics = piv_functions.get_strip_statistics(height_strip, 8)
+    vt_starts, hz_starts = np.mgrid[:height_strip.shape[0]-window_size+1, :height_strip.shape[1]-window_size+1]
+    vt_starts, hz_starts = vt_starts.ravel(), hz_starts.ravel()
+    min_valid_pixels = min_valid_fraction * window_size * window_size
+
+    flat_windows, nan_windows = piv_functions.get_flat_and_nan_windows(
+        strip_statistics, vt_starts, hz_starts, window_size, min_valid_pixels)
+
+    direct_flat_windows, direct_nan_windows = get_direct_guards(height_strip, vt_starts, hz_starts, window_size, min_valid_pixels)
+    np.testing.assert_array_equal(nan_windows, direct_nan_windows)
+    np.testing.assert_array_equal(flat_windows, direct_flat_windows)
+    assert flat_windows.any() and nan_windows.any()
+    # the steep ramp is not flat, the shallow one is
+    ramp_windows = (vt_starts >= 20) & (vt_starts + window_size <= 32) & (hz_starts + window_size <= 14)
+    assert not flat_windows[ramp_windows].any()
+    ramp_windows = (vt_starts >= 20) & (vt_starts + window_size <= 32) & (hz_starts >= 30) & (hz_starts + window_size <= 44)
+    assert flat_windows[ramp_windows & ~nan_windows].all()